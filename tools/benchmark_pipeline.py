@@ -0,0 +1,395 @@
+import os
+import io
+import json
+import time
+import zlib
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import census_cache
+import census_fetch
+import census_manifest
+import fetch_color_ranges
+import fetch_nhts_data
+
+# Roughly one county, California and the whole US
+SCALES = [1, 58, 3143]
+
+# Tracts per county at each scale, so totals land near LA (~2.5k), CA (~9k) and the US (~85k)
+TRACTS_PER_COUNTY = {1: 2500, 58: 160, 3143: 27}
+
+# Rows in the synthetic national LATCH file
+LATCH_ROWS = 85_000
+
+PIPELINES = ["fetch_all_data", "fetch_state_data", "color_ranges", "nhts"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="benchmark the data pipeline offline against synthetic Census API responses"
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        type=int,
+        default=SCALES,
+        help="Numbers of counties to benchmark (default: 1 58 3143)",
+    )
+    parser.add_argument(
+        "--pipelines",
+        nargs="+",
+        choices=PIPELINES,
+        default=PIPELINES,
+        help="Pipelines to time (default: all)",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="Simulated round-trip latency of each Census API request (default: 0)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Also record peak traced memory (runs every pipeline a second time under tracemalloc)",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Results JSON (default: data/benchmarks/pipeline_<commit>.json)",
+    )
+    parser.add_argument(
+        "--compare", default=None, help="Earlier results JSON to compare against"
+    )
+    return parser.parse_args()
+
+
+def synthetic_counties(n_counties):
+    """(state, county) FIPS pairs: California first, then spread over the other states"""
+    if n_counties <= 58:
+        return [("06", f"{2 * i + 1:03d}") for i in range(n_counties)]
+
+    states = [f"{s:02d}" for s in range(1, 57)]
+    return [
+        (states[i % len(states)], f"{2 * (i // len(states)) + 1:03d}")
+        for i in range(n_counties)
+    ]
+
+
+def tract_codes(tracts_per_county):
+    return [f"{100 * (t + 1):06d}" for t in range(tracts_per_county)]
+
+
+class FakeResponse:
+    def __init__(self, content, timings):
+        self.content = content
+        self.status_code = 200
+        self._timings = timings
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        started = time.perf_counter()
+        data = json.loads(self.content)
+        self._timings["json_decode"] += time.perf_counter() - started
+        return data
+
+
+class FakeSession:
+    """Stands in for requests.Session, answering ACS tract requests with deterministic synthetic payloads"""
+
+    def __init__(self, counties, tracts_per_county, latency_ms, timings):
+        self.counties_by_state = {}
+        for state_number, county_number in counties:
+            self.counties_by_state.setdefault(state_number, []).append(county_number)
+        self.tracts = tract_codes(tracts_per_county)
+        self.latency = latency_ms / 1000
+        self.timings = timings
+        self.requests = 0
+
+    def payload(self, variables, state_number, counties):
+        rows = [variables + ["state", "county", "tract"]]
+        for county_number in counties:
+            seed = zlib.crc32(f"{state_number}{county_number}".encode())
+            values = np.random.default_rng(seed).integers(
+                0, 5000, size=(len(self.tracts), len(variables))
+            )
+            for tract, row in zip(self.tracts, values.astype(str).tolist()):
+                rows.append(row + [state_number, county_number, tract])
+        return json.dumps(rows).encode()
+
+    def get(self, url, params=None, **kwargs):
+        self.requests += 1
+        geography = dict(part.split(":") for part in params["in"].split())
+        state_number = geography["state"]
+        counties = (
+            [geography["county"]]
+            if "county" in geography
+            else self.counties_by_state[state_number]
+        )
+        # Building the payload is the fake server's work, so it's timed apart and
+        # taken out of the pipeline's time
+        started = time.perf_counter()
+        content = self.payload(params["get"].split(","), state_number, counties)
+        self.timings["synthesis"] += time.perf_counter() - started
+
+        # Only the simulated round trip counts as HTTP time
+        started = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        self.timings["http"] += time.perf_counter() - started
+        return FakeResponse(content, self.timings)
+
+
+@contextlib.contextmanager
+def patched(module, name, stage, timings):
+    """Time every call to module.name under a stage"""
+    original = getattr(module, name)
+
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            timings[stage] += time.perf_counter() - started
+
+    setattr(module, name, timed)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+def write_latch_file(file_path, counties, tracts_per_county):
+    """Synthetic national LATCH csv holding every benchmark tract plus filler tracts from other states"""
+    geocodes = [
+        int(f"{s}{c}{t}") for s, c in counties for t in tract_codes(tracts_per_county)
+    ]
+    filler = max(LATCH_ROWS - len(geocodes), 0)
+    geocodes += [72_000_000_000 + i for i in range(filler)]
+
+    rng = np.random.default_rng(0)
+    pd.DataFrame(
+        {
+            "geocode": geocodes,
+            "urban_group": rng.integers(1, 4, len(geocodes)),
+            "est_vmiles": rng.gamma(2, 20, len(geocodes)),
+            "est_ptrp": rng.random(len(geocodes)),
+        }
+    ).to_csv(file_path, index=False)
+
+
+def run_pipeline(pipeline, counties, tracts_per_county, latency_ms):
+    """Run one pipeline in the current directory and return (seconds, stage seconds, requests)"""
+    timings = {
+        "synthesis": 0.0,
+        "http": 0.0,
+        "json_decode": 0.0,
+        "request": 0.0,
+        "derivation": 0.0,
+        "write": 0.0,
+        "load": 0.0,
+        "compute": 0.0,
+    }
+    session = FakeSession(counties, tracts_per_county, latency_ms, timings)
+    census_fetch._session = session
+    states = sorted({s for s, _ in counties})
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(patched(census_fetch, "request_acs", "request", timings))
+        stack.enter_context(
+            patched(census_fetch, "derive_metrics", "derivation", timings)
+        )
+        stack.enter_context(patched(census_fetch, "write_csv", "write", timings))
+        stack.enter_context(
+            patched(fetch_color_ranges, "load_county_metrics", "load", timings)
+        )
+        stack.enter_context(
+            patched(fetch_color_ranges, "summarize", "compute", timings)
+        )
+        stack.enter_context(
+            patched(fetch_color_ranges, "write_color_ranges", "write", timings)
+        )
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+
+        started = time.perf_counter()
+        if pipeline == "fetch_all_data":
+            for state_number, county_number in counties:
+                census_fetch.fetch_all_data(
+                    state_number, county_number, "2023", rebuild=True
+                )
+        elif pipeline == "fetch_state_data":
+            for state_number in states:
+                census_fetch.fetch_state_data(state_number, "2023", rebuild=True)
+        elif pipeline == "color_ranges":
+            for state_number in states:
+                fetch_color_ranges.calculate_all_color_ranges(
+                    state_number, [c for s, c in counties if s == state_number]
+                )
+        elif pipeline == "nhts":
+            fetch_nhts_data.get_nhts_data(
+                [f"{s}{c}" for s, c in counties], "data/raw/latch_2017-b.csv"
+            )
+        census_manifest.flush()
+        seconds = time.perf_counter() - started - timings["synthesis"]
+
+    stages = {}
+    if timings["request"]:
+        # What request_acs spends beyond the round trip and decode is building the DataFrame
+        stages["http"] = timings["http"]
+        stages["json_decode"] = timings["json_decode"]
+        stages["dataframe_build"] = (
+            timings["request"]
+            - timings["synthesis"]
+            - timings["http"]
+            - timings["json_decode"]
+        )
+    for stage in ["derivation", "load", "compute", "write"]:
+        if timings[stage]:
+            stages[stage] = timings[stage]
+
+    return seconds, {k: round(v, 4) for k, v in stages.items()}, session.requests
+
+
+def benchmark_scale(n_counties, pipelines, latency_ms, memory):
+    counties = synthetic_counties(n_counties)
+    tracts_per_county = TRACTS_PER_COUNTY.get(n_counties, max(25, 9100 // n_counties))
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            os.makedirs("data/census")
+            os.makedirs("data/raw")
+            if "nhts" in pipelines:
+                write_latch_file(
+                    "data/raw/latch_2017-b.csv", counties, tracts_per_county
+                )
+
+            # color_ranges reads what the fetch pipelines wrote
+            ordered = [p for p in PIPELINES if p in pipelines]
+            if "color_ranges" in ordered and not {
+                "fetch_all_data",
+                "fetch_state_data",
+            } & set(ordered):
+                ordered.insert(0, "fetch_state_data")
+
+            for pipeline in ordered:
+                seconds, stages, requests = run_pipeline(
+                    pipeline, counties, tracts_per_county, latency_ms
+                )
+                result = {
+                    "pipeline": pipeline,
+                    "counties": n_counties,
+                    "tracts": n_counties * tracts_per_county,
+                    "seconds": round(seconds, 4),
+                    "requests": requests,
+                    "stages": stages,
+                }
+
+                if memory:
+                    tracemalloc.start()
+                    run_pipeline(pipeline, counties, tracts_per_county, latency_ms)
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    result["peak_memory_mb"] = round(peak / (1024 * 1024), 2)
+
+                if pipeline in pipelines:
+                    results.append(result)
+                print(
+                    f"{pipeline:>18} {n_counties:>6} counties {result['seconds']:>9.3f}s {requests:>6} requests"
+                )
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["pipeline"], r["counties"]): r for r in baseline["results"]}
+
+    print(f"\nCompared with {baseline_path} ({baseline['commit']})")
+    for r in results:
+        old = previous.get((r["pipeline"], r["counties"]))
+        if old is None:
+            continue
+        ratio = old["seconds"] / r["seconds"] if r["seconds"] else float("inf")
+        print(
+            f"{r['pipeline']:>18} {r['counties']:>6} counties {old['seconds']:>9.3f}s -> {r['seconds']:>9.3f}s ({ratio:.2f}x)"
+        )
+
+
+def run_benchmarks(
+    scales=SCALES,
+    pipelines=PIPELINES,
+    latency_ms=0,
+    memory=False,
+    output=None,
+    baseline=None,
+):
+    """Time each pipeline at each scale offline and save the results as JSON"""
+    # Every request should reach the (fake) API rather than a response cache
+    census_cache.settings["enabled"] = False
+    commit = git_commit()
+
+    results = []
+    for n_counties in scales:
+        results += benchmark_scale(n_counties, pipelines, latency_ms, memory)
+
+    report = {
+        "commit": commit,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "latency_ms": latency_ms,
+        "results": results,
+    }
+
+    if output is None:
+        output = f"data/benchmarks/pipeline_{commit}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nBenchmark results saved to {output}")
+
+    if baseline:
+        compare(results, baseline)
+
+    return report
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_benchmarks(
+        args.scales,
+        args.pipelines,
+        args.latency_ms,
+        args.memory,
+        args.output,
+        args.compare,
+    )
@@ -0,0 +1,156 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+# Raw Census API responses, keyed by endpoint + year + variables + geography
+settings = {
+    "enabled": True,
+    "cache_dir": "data/cache/census",
+    "ttl_seconds": None,
+    "max_bytes": 500 * 1024 * 1024,
+}
+
+# Eviction trims the cache to this share of max_bytes, so it doesn't rerun on the next write
+EVICT_TO = 0.9
+
+# Size of the cache directory, counted once and then kept up to date by every write
+usage = {"cache_dir": None, "bytes": 0}
+usage_lock = threading.Lock()
+
+
+def add_cache_args(parser):
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always request from the Census API instead of the local response cache",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=settings["cache_dir"],
+        help=f"Response cache directory (default: {settings['cache_dir']})",
+    )
+    parser.add_argument(
+        "--cache-ttl-hours",
+        type=float,
+        default=None,
+        help="Re-request cached responses older than this (default: never expire)",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=settings["max_bytes"] / (1024 * 1024),
+        help="Evict least recently used responses above this size (default: 500)",
+    )
+
+
+def configure_from_args(args):
+    settings["enabled"] = not args.no_cache
+    settings["cache_dir"] = args.cache_dir
+    settings["ttl_seconds"] = (
+        args.cache_ttl_hours * 3600 if args.cache_ttl_hours is not None else None
+    )
+    settings["max_bytes"] = int(args.cache_max_mb * 1024 * 1024)
+
+
+def cache_key(url, params):
+    request = json.dumps({"url": url, "params": params}, sort_keys=True)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(settings["cache_dir"], key[:2], f"{key}.json.gz")
+
+
+def read_cache(url, params):
+    """Return the cached response for a request, or None on a miss or expired entry"""
+    if not settings["enabled"]:
+        return None
+
+    path = cache_path(cache_key(url, params))
+    try:
+        with gzip.open(path, "rt") as f:
+            entry = json.load(f)
+    except (FileNotFoundError, EOFError, OSError, json.JSONDecodeError):
+        return None
+
+    ttl = settings["ttl_seconds"]
+    if ttl is not None and time.time() - entry["fetched_at"] > ttl:
+        return None
+
+    # mtime tracks last use so eviction drops the least recently used responses
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+    return entry["data"]
+
+
+def write_cache(url, params, data):
+    if not settings["enabled"]:
+        return None
+
+    path = cache_path(cache_key(url, params))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    entry = {"url": url, "params": params, "fetched_at": time.time(), "data": data}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+        json.dump(entry, f)
+    size = os.path.getsize(tmp_path)
+
+    with usage_lock:
+        if usage["cache_dir"] != settings["cache_dir"]:
+            usage["cache_dir"] = settings["cache_dir"]
+            usage["bytes"] = cache_entries()[1]
+        try:
+            usage["bytes"] -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        usage["bytes"] += size
+
+        # The directory is only walked again once the running total passes the limit
+        if usage["bytes"] > settings["max_bytes"]:
+            usage["bytes"] = evict(int(settings["max_bytes"] * EVICT_TO))
+    return None
+
+
+def cache_entries():
+    """(mtime, size, path) of every cached response and their total size"""
+    entries = []
+    total_bytes = 0
+    for root, _, files in os.walk(settings["cache_dir"]):
+        for name in files:
+            if not name.endswith(".json.gz"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+    return entries, total_bytes
+
+
+def evict(target_bytes=None):
+    """Delete least recently used responses until the cache fits in target_bytes
+    (max_bytes by default) and return its size"""
+    if target_bytes is None:
+        target_bytes = settings["max_bytes"]
+    entries, total_bytes = cache_entries()
+
+    for _, size, path in sorted(entries):
+        if total_bytes <= target_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+    return total_bytes
@@ -1,457 +1,737 @@
 import os
+import json
+import shutil
+import hashlib
+import tempfile
 import requests
 import numpy as np
 import pandas as pd
 import argparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import census_cache
+import census_manifest
+import census_profile
+import geoid_codec
 
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="fetch census data for any county for any year"
-    )
-    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
-    parser.add_argument("--county", required=True, help="County FIPS code (e.g., 037)")
-    parser.add_argument("--year", default="2023", help="Census year (default: 2023)")
-    return parser.parse_args()
+ACS_URL = "https://api.census.gov/data/{year}/acs/acs5"
 
+# The Census API rejects a `get=` list with more than 50 variables
+MAX_VARIABLES_PER_REQUEST = 50
 
-def fetch_median_household_income(state_number, county_number, year):
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_median_household_income.csv"
-    ):
-        # Median Household Income in the Past 12 Months (in 2023 Inflation-Adjusted Dollars)
-        # ['B19013_001E', 'NAME', 'state', 'county', 'tract']
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B19013_001E",
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
-        }
-
-        response = requests.get(url, params=params)
-        data = response.json()
+GEOGRAPHY_COLUMNS = ["state", "county", "tract"]
 
-        df = pd.DataFrame(data[1:], columns=data[0])
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
+COLUMNAR_FORMATS = ["parquet", "feather"]
 
-        df = df.drop(["state", "county", "tract"], axis=1)
+# Shared by every fetch so concurrent county pipelines reuse keep-alive connections
+_session = None
 
-        df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_median_household_income.csv",
-            index=False,
-        )
-    else:
-        print("Median income data exists")
+# Bump when a derivation function's code changes so --incremental recomputes its outputs
+DERIVATIONS_VERSION = 1
 
-    return None
-
-
-def fetch_avg_household_size(state_number, county_number, year):
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_avg_household_size.csv"
-    ):
+# Every metric the fetcher produces, keyed by its output name.
+# "derivation" picks the vectorized function in DERIVATIONS that turns the
+# metric's ACS variables into the `column` written to its CSV.
+METRICS = {
+    "median_household_income": {
+        # Median Household Income in the Past 12 Months (in 2023 Inflation-Adjusted Dollars)
+        "derivation": "value",
+        "column": "B19013_001E",
+        "variable": "B19013_001E",
+    },
+    "avg_household_size": {
         # Average Household Size of Occupied Housing Units by Tenure
-        # ["B25010_001E","NAME","state","county","tract"]
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B25010_001E",
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
-        }
-
-        response = requests.get(url, params=params)
-        data = response.json()
+        "derivation": "value",
+        "column": "B25010_001E",
+        "variable": "B25010_001E",
+    },
+    "vehicles_per_household": {
+        # B25044_001E is total occupied households
+        # 004E  1 vehicle and same logic through 008E which is 5+ vehicles and same for renting 1-5+
+        "derivation": "weighted_ratio",
+        "column": "avg_vehicles_per_household",
+        "weights": {
+            "B25044_004E": 1,
+            "B25044_005E": 2,
+            "B25044_006E": 3,
+            "B25044_007E": 4,
+            "B25044_008E": 5,
+            "B25044_011E": 1,
+            "B25044_012E": 2,
+            "B25044_013E": 3,
+            "B25044_014E": 4,
+            "B25044_015E": 5,
+        },
+        "denominator": "B25044_001E",
+        "round": 2,
+    },
+    "median_rooms_per_household": {
+        # B25018_001E Median number of rooms
+        "derivation": "value",
+        "column": "B25018_001E",
+        "variable": "B25018_001E",
+    },
+    "college_attainment": {
+        # B15003_001E is total number of 25 year olds in tract
+        # rest of the codes are highest degree attained, bachelors, masters, etc.
+        "derivation": "weighted_ratio",
+        "column": "college_attainment_rate",
+        "weights": {
+            "B15003_022E": 1,
+            "B15003_023E": 1,
+            "B15003_024E": 1,
+            "B15003_025E": 1,
+        },
+        "denominator": "B15003_001E",
+        "round": 2,
+    },
+    "home_ownership_rate": {
+        # B25003_001E is total number of occupied housing units
+        # B25003_002E is owner occupied units
+        "derivation": "weighted_ratio",
+        "column": "home_ownership_rate",
+        "weights": {"B25003_002E": 1},
+        "denominator": "B25003_001E",
+        "round": 2,
+    },
+    "car_commute_time": {
+        # B08134_011E is total car commuters, 012E-020E are commuters per travel time bucket
+        "derivation": "midpoint_mean",
+        "column": "car_avg_travel_time",
+        "midpoints": {
+            "B08134_012E": 7.5,
+            "B08134_013E": 12,
+            "B08134_014E": 17,
+            "B08134_015E": 22,
+            "B08134_016E": 27,
+            "B08134_017E": 32,
+            "B08134_018E": 39.5,
+            "B08134_019E": 52,
+            "B08134_020E": 75,
+        },
+        "total": "B08134_011E",
+        "round": 2,
+    },
+    "car_commuter_percentage": {
+        # B08301_001E is total commuters
+        # B08301_002E is car, truck, or van commuters
+        "derivation": "weighted_ratio",
+        "column": "vehicle_usage_rate",
+        "weights": {"B08301_002E": 1},
+        "denominator": "B08301_001E",
+        "round": 2,
+    },
+    "car_transport_emissions_per_household": {
+        # B25001_001E is total households, B08134_011E is total car commuters
+        "derivation": "commute_emissions",
+        "column": "car_co2_metric_tons_per_household",
+        "depends_on": ["car_commute_time"],
+        "households": "B25001_001E",
+        "commuters": "B08134_011E",
+        # 200 g CO₂/min × 2 trips/day × 250 days/year ÷ 1,000,000 g/ton
+        "tons_per_commuter_minute": 0.1,
+        "round": 3,
+    },
+}
 
-        df = pd.DataFrame(data[1:], columns=data[0])
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
 
-        df = df.drop(["state", "county", "tract"], axis=1)
-        df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_avg_household_size.csv",
-            index=False,
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="fetch census data for any county for any year"
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument("--county", help="County FIPS code (e.g., 037)")
+    parser.add_argument("--year", default="2023", help="Census year (default: 2023)")
+    parser.add_argument(
+        "--statewide",
+        action="store_true",
+        help="Fetch every tract in the state at once and split the outputs by county",
+    )
+    parser.add_argument(
+        "--columnar",
+        choices=COLUMNAR_FORMATS,
+        help="Also write every metric into one parquet/feather table per county (requires pyarrow)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Recompute only outputs whose request, derivation or contents changed since the last run",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Re-derive outputs that already exist (served from the response cache)",
+    )
+    census_cache.add_cache_args(parser)
+    census_profile.add_profile_args(parser)
+    args = parser.parse_args()
+    if args.county is None and not args.statewide:
+        parser.error("--county is required unless --statewide is given")
+    return args
+
+
+def output_path(state_number, county_number, metric_name, year=None):
+    """The metric's CSV for a year, or without a year the current copy the dashboard reads"""
+    county_dir = f"data/census/{state_number}{county_number}"
+    if year is not None:
+        county_dir = f"{county_dir}/{year}"
+    return f"{county_dir}/{state_number}{county_number}_{metric_name}.csv"
+
+
+def get_session(pool_size=10):
+    """Return the shared Census API session, retrying 429/5xx responses with backoff"""
+    global _session
+    if _session is None:
+        retry = Retry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
         )
-
-    else:
-        print("Average household size data exists")
-
-    return None
-
-
-def fetch_vehicles_per_household(state_number, county_number, year):
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_vehicles_per_household.csv"
-    ):
-        # B25044_001E is total occupied households
-        # 004E  1 vehicle and same logic through 008E which is 5+ vehicles and same for renting 1-5+
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B25044_001E,B25044_004E,B25044_005E,B25044_006E,B25044_007E,B25044_008E,B25044_011E,B25044_012E,B25044_013E,B25044_014E,B25044_015E",
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
-        }
-        response = requests.get(url, params=params)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        _session = session
+    return _session
+
+
+def get_json(url, params):
+    """GET a Census API response, reusing the local response cache when possible"""
+    with census_profile.stage("cache_read") as record:
+        data = census_cache.read_cache(url, params)
+        record["hit"] = data is not None
+    if data is not None:
+        census_profile.count("cache_hits")
+        return data
+
+    census_profile.count("cache_misses")
+    with census_profile.stage("http", geography=params["in"]) as record:
+        response = get_session().get(url, params=params)
+        response.raise_for_status()
+        record["bytes"] = len(response.content)
+    with census_profile.stage("json_decode") as record:
         data = response.json()
-
-        df = pd.DataFrame(data[1:], columns=data[0])
-
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
-
-        numeric_cols = [
-            "B25044_001E",
-            "B25044_004E",
-            "B25044_005E",
-            "B25044_006E",
-            "B25044_007E",
-            "B25044_008E",
-            "B25044_011E",
-            "B25044_012E",
-            "B25044_013E",
-            "B25044_014E",
-            "B25044_015E",
-        ]
-
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-
-        df["total_vehicles"] = (
-            1 * df["B25044_004E"]
-            + 2 * df["B25044_005E"]
-            + 3 * df["B25044_006E"]
-            + 4 * df["B25044_007E"]
-            + 5 * df["B25044_008E"]
-            + 1 * df["B25044_011E"]
-            + 2 * df["B25044_012E"]
-            + 3 * df["B25044_013E"]
-            + 4 * df["B25044_014E"]
-            + 5 * df["B25044_015E"]
+        record["rows_out"] = len(data) - 1
+    with census_profile.stage("cache_write"):
+        census_cache.write_cache(url, params, data)
+    return data
+
+
+def write_csv(df, file_path):
+    # Write beside the target and rename so an interrupted run never leaves a partial CSV
+    with census_profile.stage("write_csv", rows_in=len(df)) as record:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+        with os.fdopen(fd, "w", newline="") as f:
+            df.to_csv(f, index=False)
+        os.replace(tmp_path, file_path)
+        record["bytes"] = os.path.getsize(file_path)
+
+
+def newest_year(state_number, county_number):
+    """The latest year with any metric CSV in the county's year directories, or None"""
+    county_dir = f"data/census/{state_number}{county_number}"
+    if not os.path.isdir(county_dir):
+        return None
+    years = [
+        int(name)
+        for name in os.listdir(county_dir)
+        if name.isdigit()
+        and any(
+            os.path.exists(output_path(state_number, county_number, m, name))
+            for m in METRICS
         )
-
-        df["avg_vehicles_per_household"] = (
-            df["total_vehicles"] / df["B25044_001E"]
-        ).round(2)
-
-        df["avg_vehicles_per_household"] = df["avg_vehicles_per_household"].fillna(0)
-
-        final_df = df[["avg_vehicles_per_household", "GEOID"]].copy()
-
-        os.makedirs("data/census", exist_ok=True)
-        final_df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_vehicles_per_household.csv",
-            index=False,
+    ]
+    return max(years, default=None)
+
+
+def publish_year(state_number, county_number, year):
+    """Make the year's CSVs the current ones, hard linked so they take no extra space.
+
+    Only the newest fetched year is published, so fetching an older year for
+    comparison never rolls the current files back."""
+    newest = newest_year(state_number, county_number)
+    if newest is not None and int(year) < newest:
+        print(f"Keeping {newest} as the current year of {state_number}{county_number}")
+        return
+    for metric_name in METRICS:
+        year_path = output_path(state_number, county_number, metric_name, year)
+        if not os.path.exists(year_path):
+            continue
+        current_path = output_path(state_number, county_number, metric_name)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(current_path), suffix=".tmp"
+        )
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            os.link(year_path, tmp_path)
+        except OSError:
+            shutil.copyfile(year_path, tmp_path)
+        # write_csv always replaces files, so the link never sees the current copy rewritten in place
+        os.replace(tmp_path, current_path)
+
+
+def metrics_table_path(state_number, county_number, fmt):
+    if county_number is None:
+        return f"data/census/{state_number}_metrics.{fmt}"
+    return f"data/census/{state_number}{county_number}/{state_number}{county_number}_metrics.{fmt}"
+
+
+def metrics_table_current(state_number, county_number, fmt):
+    """Whether the table exists and was written after every current metric CSV.
+
+    Publishing a year relinks the CSVs (a ctime change even when the year's
+    files are old), so a table left from another year or run reads as stale."""
+    table_path = metrics_table_path(state_number, county_number, fmt)
+    if not os.path.exists(table_path):
+        return False
+    table_time = os.stat(table_path).st_mtime
+    for metric_name in METRICS:
+        file_path = output_path(state_number, county_number, metric_name)
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            if max(stat.st_mtime, stat.st_ctime) > table_time:
+                return False
+    return True
+
+
+def remove_metrics_tables(state_number, county_number):
+    """Drop columnar tables a run without --columnar would otherwise leave stale"""
+    for fmt in COLUMNAR_FORMATS:
+        table_path = metrics_table_path(state_number, county_number, fmt)
+        if os.path.exists(table_path):
+            os.remove(table_path)
+            print(f"Removed stale metrics table {table_path}")
+
+
+def load_metric_frames(state_number, county_number, derived=None, year=None):
+    """Collect every metric's frame, reading the CSV for any metric not derived in this run"""
+    frames = dict(derived or {})
+    for metric_name in METRICS:
+        file_path = output_path(state_number, county_number, metric_name, year)
+        if metric_name not in frames and os.path.exists(file_path):
+            frames[metric_name] = pd.read_csv(file_path, dtype={"GEOID": str})
+    return frames
+
+
+def build_metrics_table(frames):
+    """Join metric frames into one wide table keyed by GEOID with a numeric column per metric.
+
+    Every frame is lined up on one sorted index of int64 GEOID codes (the union
+    of their tracts) instead of merging string keys frame by frame."""
+    codes = {m: geoid_codec.encode(df["GEOID"]) for m, df in frames.items()}
+    index = np.unique(np.concatenate(list(codes.values())))
+
+    columns = {"GEOID": geoid_codec.decode(index)}
+    for metric_name, final_df in frames.items():
+        value_column = final_df.columns.drop("GEOID")[0]
+        values = pd.to_numeric(final_df[value_column], errors="coerce")
+        columns[metric_name] = geoid_codec.align(codes[metric_name], values, index)
+    return pd.DataFrame(columns)
+
+
+def write_metrics_table(table, file_path, fmt):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError(
+            "pyarrow is required for parquet/feather output (pip install pyarrow)"
         )
 
-    else:
-        print("Vehicles per household data already exists ")
-    return None
+    table = table.reset_index(drop=True)
+    table["GEOID"] = table["GEOID"].astype("category")
 
+    with census_profile.stage(f"write_{fmt}", rows_in=len(table)) as record:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+        os.close(fd)
+        if fmt == "parquet":
+            table.to_parquet(tmp_path, index=False)
+        else:
+            # Uncompressed so readers can memory-map the file
+            table.to_feather(tmp_path, compression="uncompressed")
+        os.replace(tmp_path, file_path)
+        record["bytes"] = os.path.getsize(file_path)
 
-def fetch_rooms_per_household(state_number, county_number, year):
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_median_rooms_per_household.csv"
-    ):
-        # B25018_001E Median number of rooms
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B25018_001E",
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
-        }
-        response = requests.get(url, params=params)
-        data = response.json()
 
-        df = pd.DataFrame(data[1:], columns=data[0])
+def read_metrics_table(file_path):
+    """Read a parquet/feather metrics table, memory-mapping the file"""
+    if file_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
 
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
+        table = pq.read_table(file_path, memory_map=True)
+    else:
+        import pyarrow.feather as feather
 
-        df = df.drop(["state", "county", "tract"], axis=1)
+        table = feather.read_table(file_path, memory_map=True)
+    return table.to_pandas()
 
-        df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_median_rooms_per_household.csv",
-            index=False,
-        )
-    else:
-        print("Rooms per household data exists")
 
+def request_acs(state_number, county_number, year, variables):
+    """Request ACS variables for every tract in a county (or the whole state if county_number is None) as one wide DataFrame"""
+    url = ACS_URL.format(year=year)
+    variables = list(dict.fromkeys(variables))
 
-def fetch_college_degree_attainment(state_number, county_number, year):
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_college_attainment.csv"
-    ):
-        # B15003_001E is total number of 25 year olds in tract
-        # rest of the codes are highest degree attained, bachelors, masters, etc.
-        # Educational attainment refers to the highest level of education that an individual has completed.
-        # This is distinct from the level of schooling that an individual is attending.
+    geography = f"state:{state_number}"
+    if county_number is not None:
+        geography += f" county:{county_number}"
 
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
+    df = None
+    for i in range(0, len(variables), MAX_VARIABLES_PER_REQUEST):
         params = {
-            "get": "B15003_001E,B15003_022E,B15003_023E,B15003_024E,B15003_025E",
+            "get": ",".join(variables[i : i + MAX_VARIABLES_PER_REQUEST]),
             "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
+            "in": geography,
         }
-        response = requests.get(url, params=params)
-        data = response.json()
-
-        df = pd.DataFrame(data[1:], columns=data[0])
+        data = get_json(url, params)
 
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
+        with census_profile.stage("dataframe_build", rows_in=len(data) - 1) as record:
+            batch_df = pd.DataFrame(data[1:], columns=data[0])
+            batch_codes = geoid_codec.encode_parts(
+                batch_df["state"], batch_df["county"], batch_df["tract"]
+            )
+            if df is None:
+                df, codes = batch_df, batch_codes
+            else:
+                # Line later batches up with the first by GEOID code, keeping tracts every batch has
+                order = np.argsort(batch_codes, kind="stable")
+                rows = geoid_codec.positions(batch_codes[order], codes)
+                found = rows >= 0
+                batch_df = batch_df.drop(columns=GEOGRAPHY_COLUMNS)
+                df = pd.concat(
+                    [
+                        df[found].reset_index(drop=True),
+                        batch_df.iloc[order[rows[found]]].reset_index(drop=True),
+                    ],
+                    axis=1,
+                )
+                codes = codes[found]
+            record["rows_out"] = len(df)
+
+    df["GEOID"] = geoid_codec.decode(codes).to_numpy()
 
-        numeric_cols = [
-            "B15003_001E",
-            "B15003_022E",
-            "B15003_023E",
-            "B15003_024E",
-            "B15003_025E",
-        ]
+    return df.drop(GEOGRAPHY_COLUMNS, axis=1)
 
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
 
-        df["total_college_degrees"] = (
-            df["B15003_022E"]
-            + df["B15003_023E"]
-            + df["B15003_024E"]
-            + df["B15003_025E"]
-        )
+def numeric(df, columns):
+    return df[columns].apply(pd.to_numeric, errors="coerce")
+
+
+def derive_value(df, spec, derived):
+    # Published as-is so the CSV keeps the API's formatting
+    return df[spec["variable"]]
+
 
-        df["college_attainment_rate"] = (
-            df["total_college_degrees"] / df["B15003_001E"]
-        ).round(2)
+def derive_weighted_ratio(df, spec, derived):
+    weights = spec["weights"]
+    numerator = numeric(df, list(weights)).to_numpy() @ list(weights.values())
+    denominator = numeric(df, [spec["denominator"]]).iloc[:, 0]
+
+    ratio = pd.Series(numerator, index=df.index) / denominator
+    return ratio.round(spec["round"]).fillna(0)
+
+
+def derive_midpoint_mean(df, spec, derived):
+    midpoints = spec["midpoints"]
+    counts = numeric(df, list(midpoints)).fillna(0).to_numpy()
+    total = numeric(df, [spec["total"]]).iloc[:, 0].fillna(0)
+
+    total_weighted = pd.Series(counts @ list(midpoints.values()), index=df.index)
+    mean = (total_weighted / total.replace(0, 1)).round(spec["round"])
+    mean[total == 0] = 0
+    return mean
+
+
+def derive_commute_emissions(df, spec, derived):
+    households = numeric(df, [spec["households"]]).iloc[:, 0].fillna(0)
+    commuters = numeric(df, [spec["commuters"]]).iloc[:, 0].fillna(0)
+
+    car_time = derived[spec["depends_on"][0]].iloc[:, 0]
+    total_co2 = car_time * commuters * spec["tons_per_commuter_minute"]
+
+    return (total_co2 / households.replace(0, 1)).round(spec["round"])
+
+
+DERIVATIONS = {
+    "value": derive_value,
+    "weighted_ratio": derive_weighted_ratio,
+    "midpoint_mean": derive_midpoint_mean,
+    "commute_emissions": derive_commute_emissions,
+}
+
+
+def metric_variables(metric_name):
+    """ACS variables a metric's own derivation reads"""
+    spec = METRICS[metric_name]
+    derivation = spec["derivation"]
+    if derivation == "value":
+        return [spec["variable"]]
+    if derivation == "weighted_ratio":
+        return [spec["denominator"]] + list(spec["weights"])
+    if derivation == "midpoint_mean":
+        return [spec["total"]] + list(spec["midpoints"])
+    if derivation == "commute_emissions":
+        return [spec["households"], spec["commuters"]]
+    raise ValueError(f"Unknown derivation {derivation} for {metric_name}")
+
+
+def plan_metrics(metric_names):
+    """Order metrics after their dependencies and collect the deduplicated ACS variables they need"""
+    ordered = []
+
+    def visit(metric_name):
+        for dependency in METRICS[metric_name].get("depends_on", []):
+            visit(dependency)
+        if metric_name not in ordered:
+            ordered.append(metric_name)
+
+    for metric_name in metric_names:
+        visit(metric_name)
+
+    variables = [v for metric_name in ordered for v in metric_variables(metric_name)]
+    return ordered, list(dict.fromkeys(variables))
+
+
+def derive_metrics(df, metric_names):
+    """Derive each planned metric (and its dependencies) from one wide frame of ACS variables"""
+    ordered, _ = plan_metrics(metric_names)
 
-        df["college_attainment_rate"] = df["college_attainment_rate"].fillna(0)
+    derived = {}
+    for metric_name in ordered:
+        spec = METRICS[metric_name]
+        with census_profile.stage(
+            "derivation", metric=metric_name, rows_in=len(df)
+        ) as record:
+            values = DERIVATIONS[spec["derivation"]](df, spec, derived)
+            derived[metric_name] = pd.DataFrame(
+                {spec["column"]: values, "GEOID": df["GEOID"]}
+            )
+            record["rows_out"] = len(derived[metric_name])
 
-        final_df = df[["college_attainment_rate", "GEOID"]].copy()
+    return derived
 
-        final_df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_college_attainment.csv",
-            index=False,
-        )
-    else:
-        print("college attainment data exists")
-    return None
 
+def request_fingerprint(state_number, county_number, year, metric_name):
+    """Identify the ACS request a metric (and its dependencies) is derived from"""
+    _, variables = plan_metrics([metric_name])
+    request = {
+        "url": ACS_URL.format(year=year),
+        "in": f"state:{state_number} county:{county_number}",
+        "variables": sorted(variables),
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
 
-def fetch_home_ownership_rate(state_number, county_number, year):
-    # B25003_001E is total number of occupied housing units
-    # B25003_002E is owner occupied units
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_home_ownership_rate.csv"
-    ):
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B25003_001E,B25003_002E",
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
+
+def derivation_version(metric_name):
+    """Identify a metric's derivation, including the derivations it depends on"""
+    spec = METRICS[metric_name]
+    version = {
+        "spec": spec,
+        "derivations_version": DERIVATIONS_VERSION,
+        "depends_on": [derivation_version(d) for d in spec.get("depends_on", [])],
+    }
+    return hashlib.sha256(json.dumps(version, sort_keys=True).encode()).hexdigest()
+
+
+def stale_metrics(state_number, county_number, year, manifest):
+    """Metrics whose manifest entry is missing or out of date, or whose dependencies are stale, in dependency order"""
+    ordered, _ = plan_metrics(METRICS)
+
+    stale = []
+    for metric_name in ordered:
+        entry = census_manifest.metric_entry(
+            manifest, f"{state_number}{county_number}", year, metric_name
+        )
+        fresh = census_manifest.is_fresh(
+            entry,
+            request_fingerprint(state_number, county_number, year, metric_name),
+            derivation_version(metric_name),
+            output_path(state_number, county_number, metric_name, year),
+        )
+        dependencies = METRICS[metric_name].get("depends_on", [])
+        if not fresh or any(d in stale for d in dependencies):
+            stale.append(metric_name)
+
+    return stale
+
+
+def pending_metrics(state_number, county_number, year, rebuild, incremental, manifest):
+    if rebuild:
+        return list(METRICS)
+    if incremental:
+        return stale_metrics(state_number, county_number, year, manifest)
+    return [
+        metric_name
+        for metric_name in METRICS
+        if not os.path.exists(
+            output_path(state_number, county_number, metric_name, year)
+        )
+    ]
+
+
+def record_metrics(state_number, county_number, year, derived, metric_names):
+    entries = {}
+    for metric_name in metric_names:
+        entries[metric_name] = {
+            "request_fingerprint": request_fingerprint(
+                state_number, county_number, year, metric_name
+            ),
+            "derivation_version": derivation_version(metric_name),
+            "rows": len(derived[metric_name]),
+            "content_hash": census_manifest.file_hash(
+                output_path(state_number, county_number, metric_name, year)
+            ),
         }
-        response = requests.get(url, params=params)
-        data = response.json()
-
-        df = pd.DataFrame(data[1:], columns=data[0])
-
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
-
-        numeric_cols = ["B25003_001E", "B25003_002E"]
-
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
+    census_manifest.record_metrics(f"{state_number}{county_number}", year, entries)
 
-        df["home_ownership_rate"] = (df["B25003_002E"] / df["B25003_001E"]).round(2)
 
-        df["home_ownership_rate"] = df["home_ownership_rate"].fillna(0)
+def fetch_all_data(
+    state_number,
+    county_number,
+    year,
+    rebuild=False,
+    columnar=None,
+    incremental=False,
+):
+    """Fetch all census data, requesting the variables every pending metric needs once.
 
-        final_df = df[["home_ownership_rate", "GEOID"]].copy()
-
-        os.makedirs("data/census", exist_ok=True)
-        final_df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_home_ownership_rate.csv",
-            index=False,
-        )
-    else:
-        print("home ownership rate data exists")
-    return None
+    Returns the metrics that were written."""
 
+    print(
+        f"Fetching all census data for county:{county_number} in state:{state_number} for year:{year}"
+    )
+    os.makedirs(f"data/census/{state_number}{county_number}/{year}", exist_ok=True)
 
-def fetch_car_commute_time(state_number, county_number, year):
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_car_commute_time.csv"
+    manifest = census_manifest.load_manifest() if incremental else None
+    pending = pending_metrics(
+        state_number, county_number, year, rebuild, incremental, manifest
+    )
+    for metric_name in METRICS:
+        if metric_name not in pending:
+            print(f"{metric_name} data is up to date")
+
+    derived = {}
+    if pending:
+        _, variables = plan_metrics(pending)
+        df = request_acs(state_number, county_number, year, variables)
+
+        derived = derive_metrics(df, pending)
+        for metric_name in pending:
+            write_csv(
+                derived[metric_name],
+                output_path(state_number, county_number, metric_name, year),
+            )
+        record_metrics(state_number, county_number, year, derived, pending)
+    publish_year(state_number, county_number, year)
+
+    if columnar and (
+        pending
+        or not incremental
+        or not metrics_table_current(state_number, county_number, columnar)
     ):
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B08134_011E,B08134_012E,B08134_013E,B08134_014E,B08134_015E,B08134_016E,B08134_017E,B08134_018E,B08134_019E,B08134_020E",
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
-        }
-        response = requests.get(url, params=params)
-        data = response.json()
-        df = pd.DataFrame(data[1:], columns=data[0])
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
-
-        travel_time_cols = [
-            "B08134_011E",
-            "B08134_012E",
-            "B08134_013E",
-            "B08134_014E",
-            "B08134_015E",
-            "B08134_016E",
-            "B08134_017E",
-            "B08134_018E",
-            "B08134_019E",
-            "B08134_020E",
-        ]
-
-        for col in travel_time_cols:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-            df[col] = df[col].fillna(0)
-
-        time_midpoints = {
-            "B08134_012E": 7.5,
-            "B08134_013E": 12,
-            "B08134_014E": 17,
-            "B08134_015E": 22,
-            "B08134_016E": 27,
-            "B08134_017E": 32,
-            "B08134_018E": 39.5,
-            "B08134_019E": 52,
-            "B08134_020E": 75,
-        }
+        frames = load_metric_frames(state_number, county_number, derived)
+        write_metrics_table(
+            build_metrics_table(frames),
+            metrics_table_path(state_number, county_number, columnar),
+            columnar,
+        )
+    elif not columnar:
+        remove_metrics_tables(state_number, county_number)
 
-        total_weighted_time = 0
-        total_car_commuters = df["B08134_011E"]
+    print("All census data fetch complete!")
+    return pending
 
-        for col, midpoint in time_midpoints.items():
-            total_weighted_time += df[col] * midpoint
 
-        df["car_avg_travel_time"] = (
-            total_weighted_time / total_car_commuters.replace(0, 1)
-        ).round(2)
+def fetch_state_data(
+    state_number, year, rebuild=False, columnar=None, incremental=False
+):
+    """Fetch all census data for every tract in a state at once and split it into the per-county layout.
 
-        df.loc[total_car_commuters == 0, "car_avg_travel_time"] = 0
+    Returns {county_number: metrics written}."""
 
-        final_df = df[["car_avg_travel_time", "GEOID"]].copy()
+    print(
+        f"Fetching all census data for every county in state:{state_number} for year:{year}"
+    )
 
-        os.makedirs("data/census", exist_ok=True)
-        final_df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_car_commute_time.csv",
-            index=False,
-        )
-    else:
-        print("car commute time data exists")
-    return None
+    # The manifest can't tell which counties a state has, so the (cached) statewide
+    # request always runs and freshness is decided per county below
+    manifest = census_manifest.load_manifest() if incremental else None
 
+    metric_names, variables = plan_metrics(METRICS)
+    df = request_acs(state_number, None, year, variables)
 
-def fetch_car_commute_percentage(state_number, county_number, year):
-    # B08301_001E is total commuters
-    # B08301_002E is car, truck, or van commuters
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_car_commuter_percentage.csv"
-    ):
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B08301_001E,B08301_002E",
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
-        }
-        response = requests.get(url, params=params)
-        data = response.json()
-        df = pd.DataFrame(data[1:], columns=data[0])
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
-        numeric_cols = ["B08301_001E", "B08301_002E"]
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-        df["vehicle_usage_rate"] = (df["B08301_002E"] / df["B08301_001E"]).round(2)
-        df["vehicle_usage_rate"] = df["vehicle_usage_rate"].fillna(0)
-        final_df = df[["vehicle_usage_rate", "GEOID"]].copy()
-        os.makedirs("data/census", exist_ok=True)
-        final_df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_car_commuter_percentage.csv",
-            index=False,
-        )
-    else:
-        print("Car commuter data percentage")
-    return None
+    derived = derive_metrics(df, metric_names)
 
+    counties = geoid_codec.county_codes(geoid_codec.encode(df["GEOID"])) % 1000
+    county_rows = pd.Series(counties).groupby(counties).indices
+    print(f"Splitting {len(df)} tracts into {len(county_rows)} counties")
 
-def fetch_car_transport_emissions_per_household(state_number, county_number, year):
-    if not os.path.exists(
-        f"data/census/{state_number}{county_number}/{state_number}{county_number}_car_transport_emissions_per_household.csv"
-    ):
-        url = f"https://api.census.gov/data/{year}/acs/acs5"
-        params = {
-            "get": "B25001_001E,B08134_011E",  # Total households + total car commuters
-            "for": "tract:*",
-            "in": f"state:{state_number} county:{county_number}",
+    written = {}
+    for county_code, rows in sorted(county_rows.items()):
+        county_number = f"{county_code:03d}"
+        county_derived = {
+            metric_name: final_df.iloc[rows]
+            for metric_name, final_df in derived.items()
         }
-        response = requests.get(url, params=params)
-        data = response.json()
-        df = pd.DataFrame(data[1:], columns=data[0])
-        df["GEOID"] = df["state"] + df["county"] + df["tract"]
-
-        df["B25001_001E"] = pd.to_numeric(df["B25001_001E"], errors="coerce")
-        df["B08134_011E"] = pd.to_numeric(df["B08134_011E"], errors="coerce")
-        df["B25001_001E"] = df["B25001_001E"].fillna(0)
-        df["B08134_011E"] = df["B08134_011E"].fillna(0)
-
-        households_df = df[["B25001_001E", "B08134_011E", "GEOID"]].copy()
-        households_df.rename(
-            columns={
-                "B25001_001E": "total_households",
-                "B08134_011E": "total_car_commuters",
-            },
-            inplace=True,
-        )
-
-        # Load car commute time CSV
-        car_time_df = pd.read_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_car_commute_time.csv",
-            dtype={"GEOID": str},
-        )
-
-        households_df["GEOID"] = households_df["GEOID"].astype(str)
-
-        merged_df = households_df.merge(car_time_df, on="GEOID", how="inner")
 
-        total_co2 = (
-            merged_df["car_avg_travel_time"]
-            * merged_df["total_car_commuters"]
-            * 0.1  # 200 g CO₂/min × 2 trips/day × 250 days/year ÷ 1,000,000 g/ton
+        pending = pending_metrics(
+            state_number, county_number, year, rebuild, incremental, manifest
         )
-
-        merged_df["car_co2_metric_tons_per_household"] = (
-            total_co2 / merged_df["total_households"].replace(0, 1)
-        ).round(3)
-
-        final_df = merged_df[["car_co2_metric_tons_per_household", "GEOID"]].copy()
-
-        os.makedirs("data/census", exist_ok=True)
-        final_df.to_csv(
-            f"data/census/{state_number}{county_number}/{state_number}{county_number}_car_transport_emissions_per_household.csv",
-            index=False,
+        if pending:
+            os.makedirs(
+                f"data/census/{state_number}{county_number}/{year}", exist_ok=True
+            )
+            for metric_name in pending:
+                write_csv(
+                    county_derived[metric_name],
+                    output_path(state_number, county_number, metric_name, year),
+                )
+            record_metrics(state_number, county_number, year, county_derived, pending)
+            written[county_number] = pending
+        publish_year(state_number, county_number, year)
+        if not columnar:
+            remove_metrics_tables(state_number, county_number)
+
+    if columnar and (written or not incremental):
+        table = build_metrics_table(derived)
+        write_metrics_table(
+            table, metrics_table_path(state_number, None, columnar), columnar
         )
-    else:
-        print("car transport emissions per household data exists")
-    return None
-
-
-def fetch_all_data(state_number, county_number, year):
-    """Fetch all census data"""
-
-    print(
-        f"Fetching all census data for county:{county_number} in state:{state_number} for year:{year}"
-    )
-    os.makedirs(f"data/census/{state_number}{county_number}", exist_ok=True)
-
-    fetch_median_household_income(state_number, county_number, year)
-    fetch_avg_household_size(state_number, county_number, year)
-    fetch_vehicles_per_household(state_number, county_number, year)
-    fetch_rooms_per_household(state_number, county_number, year)
-    fetch_college_degree_attainment(state_number, county_number, year)
-    fetch_home_ownership_rate(state_number, county_number, year)
-    fetch_car_commute_time(state_number, county_number, year)
-    fetch_car_commute_percentage(state_number, county_number, year)
-    fetch_car_transport_emissions_per_household(state_number, county_number, year)
-
+        # The table is sorted by GEOID, so each county is one contiguous block of rows
+        codes = geoid_codec.encode(table["GEOID"])
+        for county_code in np.unique(geoid_codec.county_codes(codes)):
+            geoid_prefix = f"{county_code:05d}"
+            write_metrics_table(
+                table.iloc[geoid_codec.prefix_rows(codes, geoid_prefix)],
+                metrics_table_path(state_number, geoid_prefix[2:], columnar),
+                columnar,
+            )
+    elif not columnar:
+        remove_metrics_tables(state_number, None)
+
+    census_manifest.flush()
     print("All census data fetch complete!")
+    return written
 
 
 if __name__ == "__main__":
     args = parse_args()
-    fetch_all_data(args.state, args.county, args.year)
+    census_cache.configure_from_args(args)
+    census_profile.configure_from_args(args)
+    if args.statewide:
+        fetch_state_data(
+            args.state, args.year, args.rebuild, args.columnar, args.incremental
+        )
+    else:
+        fetch_all_data(
+            args.state,
+            args.county,
+            args.year,
+            args.rebuild,
+            args.columnar,
+            args.incremental,
+        )
+    census_manifest.flush()
+    census_profile.write_report()
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import tempfile
+import threading
+
+MANIFEST_PATH = "data/census/manifest.json"
+
+# Rewriting the whole manifest after every county is quadratic at national scale,
+# so updates are kept in memory and saved at most this often (and by flush())
+SAVE_INTERVAL_SECONDS = 10
+
+# County pipelines run on a thread pool and all update the same manifest
+_lock = threading.RLock()
+
+# Loaded manifests keyed by absolute path, and the paths with unsaved updates
+_manifests = {}
+_dirty = set()
+_last_saved = {}
+
+
+def file_hash(file_path):
+    """sha256 of a file's contents, or None if it does not exist"""
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest():
+    """Return the manifest for the current data directory (shared and kept in memory)"""
+    path = os.path.abspath(MANIFEST_PATH)
+    with _lock:
+        if path not in _manifests:
+            if os.path.exists(path):
+                with open(path) as f:
+                    _manifests[path] = json.load(f)
+            else:
+                _manifests[path] = {}
+            _last_saved[path] = time.time()
+        return _manifests[path]
+
+
+def save_manifest(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        # One-shot compact dumps is the only form json encodes in C
+        f.write(json.dumps(_manifests[path], separators=(",", ":"), sort_keys=True))
+    os.replace(tmp_path, path)
+    _dirty.discard(path)
+    _last_saved[path] = time.time()
+
+
+def mark_updated():
+    path = os.path.abspath(MANIFEST_PATH)
+    _dirty.add(path)
+    if time.time() - _last_saved[path] > SAVE_INTERVAL_SECONDS:
+        save_manifest(path)
+
+
+def flush():
+    """Save every manifest with unsaved updates"""
+    with _lock:
+        for path in list(_dirty):
+            save_manifest(path)
+
+
+# An interrupted run loses at most the updates since the last save, which
+# only makes those outputs look stale to the next --incremental run
+atexit.register(flush)
+
+
+def metric_entry(manifest, geoid_prefix, year, metric_name):
+    return (
+        manifest.get(geoid_prefix, {})
+        .get("metrics", {})
+        .get(str(year), {})
+        .get(metric_name)
+    )
+
+
+def is_fresh(entry, request_fingerprint, derivation_version, file_path):
+    """True if an output was produced from the same request and derivation and has not changed on disk since"""
+    return (
+        entry is not None
+        and entry["request_fingerprint"] == request_fingerprint
+        and entry["derivation_version"] == derivation_version
+        and entry["content_hash"] == file_hash(file_path)
+    )
+
+
+def record_metrics(geoid_prefix, year, entries):
+    """Record {metric_name: entry} for the outputs a county pipeline just wrote"""
+    with _lock:
+        manifest = load_manifest()
+        county = manifest.setdefault(geoid_prefix, {})
+        year_entries = county.setdefault("metrics", {}).setdefault(str(year), {})
+        for metric_name, entry in entries.items():
+            year_entries[metric_name] = dict(entry, updated_at=time.time())
+        mark_updated()
+
+
+def color_ranges_entry(manifest, geoid_prefix):
+    return manifest.get(geoid_prefix, {}).get("color_ranges")
+
+
+def record_color_ranges(geoid_prefix, inputs, content_hash):
+    with _lock:
+        manifest = load_manifest()
+        manifest.setdefault(geoid_prefix, {})["color_ranges"] = {
+            "inputs": inputs,
+            "content_hash": content_hash,
+            "updated_at": time.time(),
+        }
+        mark_updated()
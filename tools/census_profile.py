@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+import tracemalloc
+
+# Opt-in per-stage instrumentation, enabled by --profile or CENSUS_PROFILE=1
+settings = {
+    "enabled": os.environ.get("CENSUS_PROFILE", "") not in ("", "0"),
+    "report_path": os.environ.get("CENSUS_PROFILE_REPORT"),
+    "memory": False,
+}
+
+# Stages are recorded from the fetch_counties worker threads too
+_lock = threading.Lock()
+_events = []
+_counters = {}
+_started = time.time()
+
+
+def add_profile_args(parser):
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record per-stage timings, bytes, rows and memory and write a run report (or set CENSUS_PROFILE=1)",
+    )
+    parser.add_argument(
+        "--profile-report",
+        default=None,
+        help="Run report NDJSON (default: data/census/profile/run_<time>.ndjson)",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Also trace Python allocations per stage with tracemalloc (slower)",
+    )
+
+
+def configure_from_args(args):
+    settings["enabled"] = settings["enabled"] or args.profile or args.profile_memory
+    settings["report_path"] = args.profile_report or settings["report_path"]
+    settings["memory"] = args.profile_memory
+    if settings["memory"] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Time a pipeline stage. Yields a dict the caller can add rows_in, rows_out, bytes (or anything else) to."""
+    if not settings["enabled"]:
+        yield {}
+        return
+
+    record = {"stage": name, **fields}
+    if settings["memory"]:
+        allocated_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - started, 6)
+        record["thread"] = threading.current_thread().name
+        record["peak_rss_mb"] = peak_rss_mb()
+        if settings["memory"]:
+            allocated = tracemalloc.get_traced_memory()[0] - allocated_before
+            record["allocated_mb"] = round(allocated / (1024 * 1024), 3)
+        with _lock:
+            _events.append(record)
+
+
+def count(name, n=1):
+    if settings["enabled"]:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def summarize_stages(events):
+    """Per stage totals, in the order stages first ran"""
+    totals = {}
+    for event in events:
+        total = totals.setdefault(
+            event["stage"],
+            {"calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0, "bytes": 0},
+        )
+        total["calls"] += 1
+        total["seconds"] += event["seconds"]
+        for key in ["rows_in", "rows_out", "bytes"]:
+            total[key] += event.get(key, 0)
+    return totals
+
+
+def print_summary(totals, seconds):
+    print(
+        f"\n{'stage':<20} {'calls':>7} {'seconds':>9} {'share':>6} {'rows in':>10} {'rows out':>10} {'MB':>9}"
+    )
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]["seconds"]):
+        share = total["seconds"] / seconds if seconds else 0
+        print(
+            f"{name:<20} {total['calls']:>7} {total['seconds']:>9.3f} {share:>6.0%} "
+            f"{total['rows_in']:>10} {total['rows_out']:>10} {total['bytes'] / (1024 * 1024):>9.2f}"
+        )
+    # Stages run concurrently on fetch_counties' thread pool, so shares can add up past 100%
+    print(f"wall time {seconds:.3f}s, peak RSS {peak_rss_mb()} MB")
+    if _counters:
+        print(", ".join(f"{name} {n}" for name, n in sorted(_counters.items())))
+
+
+def write_report(report_path=None):
+    """Write the run report (a run line, then one line per stage) and print a summary table"""
+    if not settings["enabled"]:
+        return None
+
+    report_path = report_path or settings["report_path"]
+    if report_path is None:
+        report_path = f"data/census/profile/run_{time.strftime('%Y%m%d-%H%M%S', time.localtime(_started))}.ndjson"
+
+    with _lock:
+        events = list(_events)
+        counters = dict(_counters)
+    seconds = time.time() - _started
+    totals = summarize_stages(events)
+
+    run = {
+        "type": "run",
+        "argv": sys.argv,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_started)),
+        "seconds": round(seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "counters": counters,
+        "stages": {
+            name: dict(total, seconds=round(total["seconds"], 6))
+            for name, total in totals.items()
+        },
+    }
+
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    with open(report_path, "w") as f:
+        f.write(json.dumps(run) + "\n")
+        for event in events:
+            f.write(json.dumps(dict(event, type="stage")) + "\n")
+
+    print_summary(totals, seconds)
+    print(f"Run report saved to {report_path}")
+    return report_path
@@ -0,0 +1,187 @@
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import census_cache
+from census_fetch import (
+    METRICS,
+    derive_midpoint_mean,
+    numeric,
+    plan_metrics,
+    request_acs,
+)
+
+# The assumptions behind tons_per_commuter_minute in census_fetch.METRICS:
+# 400 g CO2/mi at 30 mph, 2 trips a day, 250 working days, no EVs (= 0.1)
+BASELINE = {
+    "grams_per_mile": 400.0,
+    "speed_mph": 30.0,
+    "trips_per_day": 2.0,
+    "days_per_year": 250.0,
+    "ev_share": 0.0,
+}
+
+PARAMETERS = list(BASELINE)
+
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+EMISSIONS_METRIC = "car_transport_emissions_per_household"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="evaluate grids of commute emission assumptions for every tract at once"
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument(
+        "--counties",
+        nargs="+",
+        default=None,
+        help="County FIPS codes (default: every tract in the state)",
+    )
+    parser.add_argument("--year", default="2023", help="ACS year (default: 2023)")
+    for parameter, value in BASELINE.items():
+        parser.add_argument(
+            f"--{parameter.replace('_', '-')}",
+            nargs="+",
+            type=float,
+            default=[value],
+            help=f"Values to sweep (default: {value:g})",
+        )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Scenario cube (default: data/scenarios/{state}_{year}_scenarios.npz)",
+    )
+    census_cache.add_cache_args(parser)
+    return parser.parse_args()
+
+
+def load_commute_inputs(state_number, counties, year):
+    """Per tract GEOID, households and daily one-way car commute minutes, from the
+    (cached) ACS request the fetch pipeline makes"""
+    # The full registry plan, so the request and its cache key match the fetch run's
+    _, variables = plan_metrics(METRICS)
+    if counties is None:
+        df = request_acs(state_number, None, year, variables)
+    else:
+        df = pd.concat(
+            [request_acs(state_number, c, year, variables) for c in counties],
+            ignore_index=True,
+        )
+
+    spec = METRICS[EMISSIONS_METRIC]
+    # Same rounded mean the pipeline writes, so the baseline scenario matches its CSVs
+    car_time = derive_midpoint_mean(df, METRICS[spec["depends_on"][0]], {})
+    commuters = numeric(df, [spec["commuters"]]).iloc[:, 0].fillna(0)
+    households = numeric(df, [spec["households"]]).iloc[:, 0].fillna(0)
+
+    return (
+        df["GEOID"].to_numpy(),
+        households.to_numpy(dtype=float),
+        (car_time * commuters).to_numpy(dtype=float),
+    )
+
+
+def scenario_grid(grids):
+    """Every combination of the parameter grids as one flat array per parameter"""
+    mesh = np.meshgrid(
+        *[np.asarray(grids[p], dtype=float) for p in PARAMETERS], indexing="ij"
+    )
+    return {p: values.reshape(-1) for p, values in zip(PARAMETERS, mesh)}
+
+
+def tons_per_commuter_minute(scenarios):
+    """Annual metric tons of CO2 per daily one-way commute minute, for each scenario"""
+    miles_per_minute = scenarios["speed_mph"] / 60
+    return (
+        scenarios["grams_per_mile"]
+        * miles_per_minute
+        * scenarios["trips_per_day"]
+        * scenarios["days_per_year"]
+        * (1 - scenarios["ev_share"])
+        / 1_000_000
+    )
+
+
+def minutes_per_household(households, commute_minutes):
+    return commute_minutes / np.where(households == 0, 1, households)
+
+
+def evaluate(households, commute_minutes, scenarios):
+    """(tract, scenario) tons of CO2 per household, in one broadcast"""
+    base = minutes_per_household(households, commute_minutes)
+    factors = tons_per_commuter_minute(scenarios)
+    return (base[:, None] * factors[None, :]).astype(np.float32)
+
+
+def summarize(households, commute_minutes, scenarios):
+    """One row per scenario: its parameters, household-weighted mean and tract quantiles.
+
+    Every scenario scales each tract's minutes per household by the same
+    non-negative factor, so means and quantiles scale with it too and are
+    computed once over the tracts instead of over the whole cube."""
+    base = minutes_per_household(households, commute_minutes)
+    factors = tons_per_commuter_minute(scenarios)
+
+    summary = pd.DataFrame(scenarios)
+    summary["tons_per_commuter_minute"] = factors
+
+    total_households = households.sum()
+    total_minutes = households @ base
+    summary["total_tons"] = total_minutes * factors
+    summary["mean_tons_per_household"] = (
+        total_minutes / total_households * factors if total_households else np.nan
+    )
+
+    # Tracts without households are not part of the distribution
+    quantiles = np.quantile(base[households > 0], QUANTILES)
+    for q, value in zip(QUANTILES, quantiles):
+        summary[f"p{round(q * 100)}"] = value * factors
+    return summary.round(4)
+
+
+def run_scenarios(state_number, counties, year, grids, output=None):
+    """Evaluate every combination of grids for every tract and save the cube and its summary"""
+    output = output or f"data/scenarios/{state_number}_{year}_scenarios.npz"
+
+    geoids, households, commute_minutes = load_commute_inputs(
+        state_number, counties, year
+    )
+    scenarios = scenario_grid(grids)
+
+    started = time.perf_counter()
+    cube = evaluate(households, commute_minutes, scenarios)
+    summary = summarize(households, commute_minutes, scenarios)
+    elapsed = time.perf_counter() - started
+    print(
+        f"Evaluated {cube.shape[1]} scenarios x {cube.shape[0]} tracts in {elapsed:.2f}s"
+    )
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    np.savez_compressed(
+        output,
+        geoid=geoids.astype("U11"),
+        households=households,
+        tons_per_household=cube,
+        **{parameter: values for parameter, values in scenarios.items()},
+    )
+    summary_path = os.path.splitext(output)[0] + "_summary.csv"
+    summary.to_csv(summary_path, index=False)
+    print(f"Scenario cube saved to {output}, summary to {summary_path}")
+    return summary
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    census_cache.configure_from_args(args)
+    run_scenarios(
+        args.state,
+        args.counties,
+        args.year,
+        {parameter: getattr(args, parameter) for parameter in PARAMETERS},
+        args.output,
+    )
@@ -0,0 +1,320 @@
+import os
+import glob
+import gzip
+import json
+import math
+import time
+import hashlib
+import argparse
+import tempfile
+
+import pandas as pd
+
+from census_fetch import build_metrics_table, load_metric_frames
+from fetch_color_ranges import color_ranges_path, list_fetched_counties
+from hvmt_model import hvmt_emissions_path
+
+BUNDLE_DIR = "public/data/bundles"
+BUNDLE_INDEX = "index.json"
+
+# Decimal places kept in the bundle, matching what the dashboard displays
+# (rates are shown as percentages with one decimal, so they keep three)
+DISPLAY_PRECISION = {
+    "median_household_income": 0,
+    "avg_household_size": 2,
+    "vehicles_per_household": 2,
+    "median_rooms_per_household": 1,
+    "college_attainment": 3,
+    "home_ownership_rate": 3,
+    "car_commute_time": 1,
+    "car_commuter_percentage": 3,
+    "car_transport_emissions_per_household": 2,
+    "latch_emissions": 2,
+    "hvmt_emissions": 2,
+}
+
+# Tract properties carried over from the TIGER GeoJSON, everything else is dropped
+TRACT_PROPERTIES = ["GEOID", "NAME"]
+
+# Characters of the content hash used in bundle filenames
+HASH_LENGTH = 12
+
+# How long a superseded bundle stays on disk, so clients holding a cached index can still fetch it
+GRACE_HOURS = 24
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="export one precompressed GeoJSON bundle per county with every metric and its color ranges"
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument(
+        "--counties",
+        nargs="+",
+        required=True,
+        help="County FIPS codes (e.g., 037 075), or * for every fetched county in the state",
+    )
+    parser.add_argument(
+        "--geojson",
+        default=None,
+        help="Tract GeoJSON to use (default: data/processed/{state}_{county}_*census_tracts.geojson)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=BUNDLE_DIR,
+        help=f"Bundle directory (default: {BUNDLE_DIR})",
+    )
+    parser.add_argument(
+        "--grace-hours",
+        type=float,
+        default=GRACE_HOURS,
+        help=f"Hours superseded bundles are kept before they are deleted (default: {GRACE_HOURS})",
+    )
+    args = parser.parse_args()
+    if args.geojson and (len(args.counties) > 1 or args.counties == ["*"]):
+        parser.error("--geojson can only be given for a single county")
+    return args
+
+
+def find_tracts_geojson(state_number, county_number):
+    """The tract GeoJSON fetch_all_data.sh extracted for the county"""
+    matches = sorted(
+        glob.glob(
+            f"data/processed/{state_number}_{county_number}_*census_tracts.geojson"
+        )
+    )
+    if not matches:
+        raise FileNotFoundError(
+            f"No tract GeoJSON for {state_number}{county_number} in data/processed"
+        )
+    return matches[0]
+
+
+def latch_emissions_path(state_number, county_number):
+    return f"data/census/{state_number}{county_number}_latch_emissions.csv"
+
+
+def load_county_table(state_number, county_number):
+    """Every metric of the county (plus LATCH and HVMT model emissions when present) as one table keyed by GEOID"""
+    frames = load_metric_frames(state_number, county_number)
+
+    latch_path = latch_emissions_path(state_number, county_number)
+    if os.path.exists(latch_path):
+        frames["latch_emissions"] = pd.read_csv(latch_path, dtype={"GEOID": str})
+    hvmt_path = hvmt_emissions_path(f"{state_number}{county_number}")
+    if os.path.exists(hvmt_path):
+        frames["hvmt_emissions"] = pd.read_csv(hvmt_path, dtype={"GEOID": str})
+
+    if not frames:
+        raise FileNotFoundError(
+            f"No metric files for {state_number}{county_number}, run census_fetch.py first"
+        )
+    return build_metrics_table(frames)
+
+
+def display_value(value, precision):
+    if not math.isfinite(value):
+        return None
+    if precision == 0:
+        return int(value)
+    return value
+
+
+def display_values(table):
+    """{GEOID: {metric: value}} rounded to display precision, with None for missing values"""
+    columns = [c for c in table.columns if c != "GEOID"]
+    precisions = [DISPLAY_PRECISION.get(c, 2) for c in columns]
+    rounded = [table[c].round(p).tolist() for c, p in zip(columns, precisions)]
+
+    values = {}
+    for i, geoid in enumerate(table["GEOID"]):
+        values[geoid] = {
+            column: display_value(column_values[i], precision)
+            for column, column_values, precision in zip(columns, rounded, precisions)
+        }
+    return values
+
+
+def finite_json(value):
+    """A copy of parsed JSON with NaN and infinities (which JSON.parse rejects) as None"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {k: finite_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [finite_json(v) for v in value]
+    return value
+
+
+def build_bundle(state_number, county_number, geojson_path):
+    """Join the tract shapes, every metric and the color ranges into one FeatureCollection"""
+    with open(geojson_path) as f:
+        tracts = json.load(f)
+
+    values = display_values(load_county_table(state_number, county_number))
+    empty = dict.fromkeys(next(iter(values.values()), {}))
+
+    features = []
+    for feature in tracts["features"]:
+        properties = feature["properties"]
+        geoid = properties.get("GEOID") or properties.get("geoid")
+        bundle_properties = {
+            name: properties[name] for name in TRACT_PROPERTIES if name in properties
+        }
+        bundle_properties["GEOID"] = geoid
+        bundle_properties.update(values.get(geoid, empty))
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": feature["geometry"],
+                "properties": bundle_properties,
+            }
+        )
+
+    color_ranges = {}
+    ranges_path = color_ranges_path(f"{state_number}{county_number}")
+    if os.path.exists(ranges_path):
+        with open(ranges_path) as f:
+            # A degenerate metric can leave NaN or Infinity in its ranges
+            color_ranges = finite_json(json.load(f))
+
+    return {
+        "type": "FeatureCollection",
+        "metrics": list(empty),
+        "color_ranges": color_ranges,
+        "features": features,
+    }
+
+
+def compress(content):
+    """{extension: bytes} for every encoding the dashboard can be served with"""
+    # mtime=0 keeps the gzip bytes identical for identical content
+    encoded = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+    except ImportError:
+        print("brotli not installed, skipping .br output (pip install brotli)")
+    else:
+        encoded[".br"] = brotli.compress(content, quality=11)
+    return encoded
+
+
+def write_file(file_path, content):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    # mkstemp creates files readable only by their owner, these are served publicly
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, file_path)
+
+
+def load_index(output_dir):
+    index_path = os.path.join(output_dir, BUNDLE_INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            return json.load(f)
+    return {}
+
+
+def write_bundle(geoid_prefix, bundle, output_dir, index):
+    """Write the bundle under a content-hashed name (safe to cache forever) and record it in the index"""
+    # Fail here rather than ship a bundle the browser can't parse
+    content = json.dumps(bundle, separators=(",", ":"), allow_nan=False).encode()
+    content_hash = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    file_name = f"{geoid_prefix}.{content_hash}.geojson"
+
+    write_file(os.path.join(output_dir, file_name), content)
+    encoded = compress(content)
+    for extension, data in encoded.items():
+        write_file(os.path.join(output_dir, file_name + extension), data)
+
+    # The previous bundle stays until prune_bundles, since clients may still hold an index pointing at it
+    entry = index.get(geoid_prefix, {})
+    superseded = [s for s in entry.get("superseded", []) if s["file"] != file_name]
+    previous = entry.get("file")
+    if previous and previous != file_name:
+        superseded.append({"file": previous, "superseded_at": int(time.time())})
+
+    index[geoid_prefix] = {
+        "file": file_name,
+        "encodings": sorted(encoded),
+        "bytes": len(content),
+        "features": len(bundle["features"]),
+    }
+    if superseded:
+        index[geoid_prefix]["superseded"] = superseded
+    sizes = ", ".join(
+        f"{ext} {len(data) / 1024:.0f} KB" for ext, data in encoded.items()
+    )
+    print(
+        f"Bundle saved to {os.path.join(output_dir, file_name)} ({len(content) / 1024:.0f} KB, {sizes})"
+    )
+
+
+def expire_superseded(index, grace_hours):
+    """Drop superseded bundles older than the grace period from the index and return their files"""
+    cutoff = time.time() - grace_hours * 3600
+    expired = []
+    for entry in index.values():
+        kept = []
+        for superseded in entry.pop("superseded", []):
+            if superseded["superseded_at"] <= cutoff:
+                expired.append(superseded["file"])
+            else:
+                kept.append(superseded)
+        if kept:
+            entry["superseded"] = kept
+    return expired
+
+
+def prune_bundles(files, output_dir):
+    for file_name in files:
+        for extension in ["", ".gz", ".br"]:
+            stale_path = os.path.join(output_dir, file_name + extension)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+    if files:
+        print(f"Removed {len(files)} superseded bundles")
+
+
+def export_bundles(
+    state_number,
+    counties,
+    geojson_path=None,
+    output_dir=BUNDLE_DIR,
+    grace_hours=GRACE_HOURS,
+):
+    if counties == ["*"]:
+        counties = list_fetched_counties(state_number)
+
+    os.makedirs(output_dir, exist_ok=True)
+    index = load_index(output_dir)
+    for county_number in counties:
+        geoid_prefix = f"{state_number}{county_number}"
+        try:
+            bundle = build_bundle(
+                state_number,
+                county_number,
+                geojson_path or find_tracts_geojson(state_number, county_number),
+            )
+        except FileNotFoundError as e:
+            print(f"Skipping {geoid_prefix}: {e}")
+            continue
+        write_bundle(geoid_prefix, bundle, output_dir, index)
+
+    # The index is the only unhashed file, so it is the one to serve with a short cache lifetime.
+    # Expired bundles are deleted only after it is written, so it never points at a missing file
+    expired = expire_superseded(index, grace_hours)
+    write_file(
+        os.path.join(output_dir, BUNDLE_INDEX),
+        json.dumps(index, indent=2, sort_keys=True).encode(),
+    )
+    prune_bundles(expired, output_dir)
+    return index
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    export_bundles(
+        args.state, args.counties, args.geojson, args.output_dir, args.grace_hours
+    )
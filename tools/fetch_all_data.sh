@@ -32,24 +32,16 @@ for county_name in "${!counties[@]}"; do
 
 done
 
-echo "fetching relevant csvs"
+echo "fetching relevant csvs and generating color ranges"
 
-for county_name in "${!counties[@]}"; do
-    fips=${counties[$county_name]}
-    echo "Processing $county_name (FIPS: ${STATE}${fips})..."
-    
-    venv/bin/python tools/census_fetch.py \
-        --state "$STATE" \
-        --county "$fips" \
-        --year "$YEAR"
-done
+venv/bin/python tools/fetch_counties.py \
+    --state "$STATE" \
+    --counties "${counties[@]}" \
+    --years "$YEAR" \
+    --color-ranges
 
-echo "generating color ranges"
-for county_name in "${!counties[@]}"; do
-    fips=${counties[$county_name]}
-    echo "Generating color ranges for $county_name (FIPS: ${STATE}${fips})..."
-    venv/bin/python tools/fetch_color_ranges.py \
-        --state "$STATE" \
-        --county "$fips"
-    echo "✓ Generated color ranges for ${STATE}${fips}"
-done
\ No newline at end of file
+echo "exporting map bundles"
+
+venv/bin/python tools/export_bundles.py \
+    --state "$STATE" \
+    --counties "${counties[@]}"
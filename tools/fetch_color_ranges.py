@@ -4,73 +4,307 @@ import os
 import argparse
 import json
 
-file_arr = [
-    "median_household_income.csv",
-    "vehicles_per_household.csv",
-    "car_commuter_percentage.csv",
-    "college_attainment.csv",
-    "home_ownership_rate.csv",
-    "median_rooms_per_household.csv",
-    "car_commute_time.csv",
-    "vehicle_usage_rate.csv",
-    "car_transport_emissions_per_household.csv",
-]
+import census_manifest
+import census_profile
+from census_fetch import (
+    COLUMNAR_FORMATS,
+    METRICS,
+    metrics_table_current,
+    metrics_table_path,
+    output_path,
+    read_metrics_table,
+)
+
+
+# 11 interior breaks splitting each metric into 12 color classes
+PERCENTILES = np.linspace(0, 1, 13)[1:-1]
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
-        description="fetch census data for any county for any year"
+        description="calculate color ranges for one or many counties and their state"
     )
     parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
-    parser.add_argument("--county", required=True, help="County FIPS code (e.g., 037)")
+    parser.add_argument(
+        "--counties",
+        "--county",
+        nargs="+",
+        required=True,
+        help="County FIPS codes (e.g., 037 075), or * for every fetched county in the state",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip counties whose metric files have not changed since their color ranges were generated",
+    )
+    census_profile.add_profile_args(parser)
     return parser.parse_args()
 
 
-def calculate_color_ranges(state_number, county_number):
-    results = {}
+def load_metrics_table(state_number, county_number):
+    """Read the county's columnar metrics table if one was written after its CSVs, else None"""
+    for fmt in COLUMNAR_FORMATS:
+        if metrics_table_current(state_number, county_number, fmt):
+            return read_metrics_table(
+                metrics_table_path(state_number, county_number, fmt)
+            )
+    return None
+
+
+def color_ranges_inputs(state_number, county_number):
+    """Content hashes of every metric file the color ranges are computed from"""
+    paths = [output_path(state_number, county_number, m) for m in METRICS]
+    paths += [
+        metrics_table_path(state_number, county_number, fmt) for fmt in COLUMNAR_FORMATS
+    ]
+
+    inputs = {}
+    for file_path in paths:
+        content_hash = census_manifest.file_hash(file_path)
+        if content_hash is not None:
+            inputs[os.path.basename(file_path)] = content_hash
+    return inputs
+
+
+def color_ranges_path(geoid_prefix):
+    if len(geoid_prefix) == 2:
+        return f"data/census/color_ranges_{geoid_prefix}.json"
+    return f"data/census/{geoid_prefix}/color_ranges_{geoid_prefix}.json"
+
+
+def color_ranges_fresh(geoid_prefix, inputs):
+    manifest = census_manifest.load_manifest()
+    entry = census_manifest.color_ranges_entry(manifest, geoid_prefix)
+    return (
+        entry is not None
+        and entry["inputs"] == inputs
+        and entry["content_hash"]
+        == census_manifest.file_hash(color_ranges_path(geoid_prefix))
+    )
+
 
-    for x in file_arr:
-        file_path = f"data/census/{state_number}{county_number}/{state_number}{county_number}_{x}"
-        if not os.path.exists(file_path):
+def load_county_metrics(state_number, county_number):
+    """Return {metric_name: values} for every metric the county has, read once from its table or CSVs"""
+    table = load_metrics_table(state_number, county_number)
+
+    columns = {}
+    for metric_name in METRICS:
+        file_path = output_path(state_number, county_number, metric_name)
+        if table is not None and metric_name in table.columns:
+            values = table[metric_name]
+        elif os.path.exists(file_path):
+            try:
+                values = pd.read_csv(file_path).iloc[:, 0]
+            except Exception as e:
+                print(f"Error processing {file_path}: {e}")
+                continue
+        else:
             print(f"File not found: {file_path}")
             continue
 
-        try:
-            df = pd.read_csv(file_path)
+        columns[metric_name] = pd.to_numeric(values, errors="coerce").to_numpy(
+            dtype=float
+        )
+    return columns
+
+
+def build_metric_cube(county_metrics):
+    """Stack every county's metrics into one NaN-padded (county, tract, metric) array.
+
+    Negative values (the ACS uses large negative sentinels for missing estimates)
+    are treated like missing values. Returns the cube and the row count of each
+    county/metric file, which is -1 where a county has no file for a metric."""
+    metric_names = list(METRICS)
+    max_rows = max(
+        [len(v) for columns in county_metrics.values() for v in columns.values()],
+        default=0,
+    )
+
+    cube = np.full((len(county_metrics), max_rows, len(metric_names)), np.nan)
+    total_counts = np.full((len(county_metrics), len(metric_names)), -1)
+    for i, columns in enumerate(county_metrics.values()):
+        for j, metric_name in enumerate(metric_names):
+            if metric_name in columns:
+                values = columns[metric_name]
+                cube[i, : len(values), j] = values
+                total_counts[i, j] = len(values)
+
+    with np.errstate(invalid="ignore"):
+        cube[~(cube >= 0)] = np.nan
+
+    return cube, total_counts
+
+
+def nan_quantiles(values, percentiles, axis):
+    """np.nanquantile(values, percentiles, axis=axis) (linear method) for every column at once.
+
+    np.nanquantile falls back to a Python loop over columns when NaNs are present,
+    so this sorts once (NaNs sort last) and interpolates between the order
+    statistics of each column's own valid count."""
+    sorted_values = np.sort(values, axis=axis)
+    counts = np.sum(~np.isnan(values), axis=axis, keepdims=True)
 
-            clean_data = pd.to_numeric(df.iloc[:, 0], errors="coerce")
-            clean_data = clean_data[clean_data >= 0]
-            clean_data = clean_data.dropna()
+    shape = [1] * values.ndim
+    shape[axis] = len(percentiles)
+    positions = (counts - 1) * np.reshape(percentiles, shape)
+    positions = np.clip(positions, 0, None)
 
-            average = clean_data.mean()
-            percentiles = np.linspace(0, 1, 13)[1:-1]
-            breaks = clean_data.quantile(percentiles).round(2)
+    lower_index = np.floor(positions).astype(int)
+    upper_index = np.minimum(lower_index + 1, np.maximum(counts - 1, 0))
+    fraction = positions - lower_index
 
-            metric_name = x.replace(".csv", "")
-            results[metric_name] = {
-                "breaks": breaks.tolist(),
-                "average": round(average, 2),
-                "clean_count": len(clean_data),
-                "total_count": len(df),
-            }
+    lower = np.take_along_axis(sorted_values, lower_index, axis=axis)
+    upper = np.take_along_axis(sorted_values, upper_index, axis=axis)
 
+    # Same interpolation as numpy's quantile
+    with np.errstate(invalid="ignore"):
+        diff = upper - lower
+        quantiles = np.where(
+            fraction >= 0.5, upper - diff * (1 - fraction), lower + diff * fraction
+        )
+    return np.where(counts > 0, quantiles, np.nan)
+
+
+def summarize(cube, axis):
+    """Breaks, averages and clean counts of every metric, reducing the tract axis"""
+    clean_counts = np.sum(~np.isnan(cube), axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = np.nansum(cube, axis=axis) / clean_counts
+    breaks = nan_quantiles(cube, PERCENTILES, axis=axis)
+    return breaks, averages, clean_counts
+
+
+def range_results(breaks, averages, clean_counts, total_counts, label=None):
+    results = {}
+    for j, metric_name in enumerate(METRICS):
+        if total_counts[j] < 0:
+            continue
+
+        average = float(averages[j])
+        results[metric_name] = {
+            "breaks": np.round(breaks[:, j], 2).tolist(),
+            "average": round(average, 2),
+            "clean_count": int(clean_counts[j]),
+            "total_count": int(total_counts[j]),
+        }
+
+        if label is not None:
             print(
-                f"Processed {metric_name}: {len(clean_data)}/{len(df)} records, avg: {average:.2f}"
+                f"Processed {label} {metric_name}: {clean_counts[j]}/{total_counts[j]} records, avg: {average:.2f}"
             )
+    return results
+
+
+def write_color_ranges(geoid_prefix, results, inputs):
+    output_file = color_ranges_path(geoid_prefix)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with census_profile.stage("write_color_ranges") as record:
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=2)
+        record["bytes"] = os.path.getsize(output_file)
+
+    census_manifest.record_color_ranges(
+        geoid_prefix, inputs, census_manifest.file_hash(output_file)
+    )
+    print(f"Color ranges saved to {output_file}")
+
 
-        except Exception as e:
-            print(f"Error processing {file_path}: {e}")
+def list_fetched_counties(state_number):
+    if not os.path.isdir("data/census"):
+        return []
+    return sorted(
+        name[2:]
+        for name in os.listdir("data/census")
+        if len(name) == 5 and name.startswith(state_number) and name.isdigit()
+    )
+
+
+def calculate_all_color_ranges(
+    state_number, counties, incremental=False, state_ranges=True
+):
+    """Compute per-county color ranges for many counties in one vectorized pass.
+
+    The state-level ranges always cover every fetched county of the state, not
+    only the ones given, so a partial run can't narrow them to a subset."""
+    fetched = list_fetched_counties(state_number)
+    if counties == ["*"]:
+        counties = fetched
+    state_counties = sorted(set(fetched) | set(counties)) if state_ranges else []
+
+    inputs = {
+        c: color_ranges_inputs(state_number, c) for c in set(counties + state_counties)
+    }
+    changed = [
+        c
+        for c in counties
+        if not incremental or not color_ranges_fresh(f"{state_number}{c}", inputs[c])
+    ]
+
+    state_inputs = {
+        f"{state_number}{c}/{name}": content_hash
+        for c in state_counties
+        for name, content_hash in inputs[c].items()
+    }
+    state_changed = state_ranges and (
+        not incremental or not color_ranges_fresh(state_number, state_inputs)
+    )
 
-    output_dir = f"data/census/{state_number}{county_number}"
-    os.makedirs(output_dir, exist_ok=True)
+    if not changed and not state_changed:
+        print(f"Color ranges for {len(counties)} counties are up to date")
+        return None
 
-    output_file = f"{output_dir}/color_ranges_{state_number}{county_number}.json"
-    with open(output_file, "w") as f:
-        json.dump(results, f, indent=2)
+    # The state-level ranges need every county, otherwise only the changed ones
+    loaded = state_counties if state_changed else changed
+    with census_profile.stage("load_metrics", counties=len(loaded)) as record:
+        county_metrics = {c: load_county_metrics(state_number, c) for c in loaded}
+        record["rows_out"] = sum(
+            len(v) for columns in county_metrics.values() for v in columns.values()
+        )
 
-    print(f"\nColor ranges saved to {output_file}")
+    with census_profile.stage("color_ranges", rows_in=record.get("rows_out", 0)):
+        cube, total_counts = build_metric_cube(county_metrics)
+        breaks, averages, clean_counts = summarize(cube, axis=1)
+    for i, county_number in enumerate(loaded):
+        if county_number not in changed:
+            continue
+        results = range_results(
+            breaks[i],
+            averages[i],
+            clean_counts[i],
+            total_counts[i],
+            label=f"{state_number}{county_number}",
+        )
+        write_color_ranges(
+            f"{state_number}{county_number}", results, inputs[county_number]
+        )
+
+    if state_changed:
+        state_cube = cube.reshape(-1, cube.shape[2])
+        state_breaks, state_averages, state_clean_counts = summarize(state_cube, axis=0)
+        # A metric counts toward the state when at least one county has it
+        has_metric = total_counts >= 0
+        state_total_counts = np.where(
+            has_metric.any(axis=0),
+            np.where(has_metric, total_counts, 0).sum(axis=0),
+            -1,
+        )
+        results = range_results(
+            state_breaks, state_averages, state_clean_counts, state_total_counts
+        )
+        write_color_ranges(state_number, results, state_inputs)
+
+    census_manifest.flush()
+    return None
+
+
+def calculate_color_ranges(state_number, county_number, incremental=False):
+    calculate_all_color_ranges(
+        state_number, [county_number], incremental=incremental, state_ranges=False
+    )
 
 
 if __name__ == "__main__":
     args = parse_args()
-    calculate_color_ranges(args.state, args.county)
+    census_profile.configure_from_args(args)
+    calculate_all_color_ranges(args.state, args.counties, args.incremental)
+    census_profile.write_report()
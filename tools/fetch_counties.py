@@ -0,0 +1,238 @@
+import os
+import time
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import census_cache
+import census_manifest
+import census_profile
+from census_fetch import (
+    ACS_URL,
+    COLUMNAR_FORMATS,
+    fetch_all_data,
+    fetch_state_data,
+    get_json,
+    get_session,
+)
+from fetch_color_ranges import calculate_all_color_ranges
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="fetch census data for many counties and years concurrently"
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument(
+        "--counties",
+        nargs="+",
+        default=["*"],
+        help="County FIPS codes (e.g., 037 075), or * for every county in the state (default: *)",
+    )
+    parser.add_argument(
+        "--years", nargs="+", default=["2023"], help="Census years (default: 2023)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of counties fetched at once (default: 8)",
+    )
+    parser.add_argument(
+        "--statewide",
+        action="store_true",
+        help="Fetch each year for the whole state in one pass before the per-county stages",
+    )
+    parser.add_argument(
+        "--columnar",
+        choices=COLUMNAR_FORMATS,
+        help="Also write every metric into one parquet/feather table per county (requires pyarrow)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Recompute only outputs (and color ranges) whose inputs changed since the last run",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Re-derive outputs that already exist (served from the response cache)",
+    )
+    parser.add_argument(
+        "--color-ranges",
+        action="store_true",
+        help="Generate per-county and state-level color ranges after fetching",
+    )
+    parser.add_argument(
+        "--report",
+        default="data/census/fetch_report.json",
+        help="Where to write the run summary (default: data/census/fetch_report.json)",
+    )
+    census_cache.add_cache_args(parser)
+    census_profile.add_profile_args(parser)
+    return parser.parse_args()
+
+
+def list_counties(state_number, year):
+    """List the FIPS codes of every county in a state"""
+    params = {"get": "NAME", "for": "county:*", "in": f"state:{state_number}"}
+    data = get_json(ACS_URL.format(year=year), params)
+
+    county_index = data[0].index("county")
+    return sorted(row[county_index] for row in data[1:])
+
+
+def run_statewide(state_number, counties, years, options):
+    """Fetch every year for the whole state at once and summarize the outcome per county.
+
+    A single request covers every county, so they all share its status and time."""
+    written = {}
+    started = time.time()
+    try:
+        for year in years:
+            written[year] = fetch_state_data(state_number, year, **options)
+        status = {"status": "ok"}
+    except Exception as e:
+        status = {"status": "error", "error": str(e)}
+    elapsed = round(time.time() - started, 2)
+
+    print(f"Statewide fetch for state:{state_number} {status['status']} ({elapsed}s)")
+    results = []
+    for county_number in counties:
+        result = {"county": f"{state_number}{county_number}", "years": years}
+        if status["status"] == "ok":
+            result["written"] = {
+                year: county_written.get(county_number, [])
+                for year, county_written in written.items()
+            }
+        result.update(status, elapsed_seconds=elapsed)
+        results.append(result)
+    return results
+
+
+def run_county(state_number, county_number, years, fetch, options):
+    """Run the fetch pipeline for one county over every year and summarize the outcome"""
+    result = {"county": f"{state_number}{county_number}", "years": years}
+
+    started = time.time()
+    try:
+        # Years run in order within a county since they share output paths
+        result["written"] = {}
+        for year in years:
+            result["written"][year] = fetch(
+                state_number, county_number, year, **options
+            )
+
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+
+    result["elapsed_seconds"] = round(time.time() - started, 2)
+    return result
+
+
+def fetch_counties(
+    state_number,
+    counties,
+    years,
+    workers=8,
+    statewide=False,
+    rebuild=False,
+    columnar=None,
+    incremental=False,
+    color_ranges=False,
+    report_path="data/census/fetch_report.json",
+):
+    """Fetch census data for a list of counties (or * for all) on a bounded thread pool"""
+    if counties == ["*"]:
+        counties = list_counties(state_number, years[-1])
+
+    # Size the connection pool to the worker count so connections are reused
+    get_session(pool_size=workers)
+
+    print(
+        f"Fetching {len(counties)} counties in state:{state_number} for years:{','.join(years)} with {workers} workers"
+    )
+
+    started = time.time()
+
+    options = {"rebuild": rebuild, "columnar": columnar, "incremental": incremental}
+    if statewide:
+        # One request per variable batch covers every county, so there is nothing left for a pool
+        results = run_statewide(state_number, counties, years, options)
+    else:
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    run_county,
+                    state_number,
+                    county_number,
+                    years,
+                    fetch_all_data,
+                    options,
+                )
+                for county_number in counties
+            ]
+
+            for i, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                results.append(result)
+                print(
+                    f"[{i}/{len(counties)}] {result['county']} {result['status']} ({result['elapsed_seconds']}s)"
+                )
+
+    census_manifest.flush()
+    failed = [r for r in results if r["status"] != "ok"]
+
+    if color_ranges:
+        # One vectorized pass over every county that fetched, plus the state-level ranges
+        calculate_all_color_ranges(
+            state_number,
+            [r["county"][2:] for r in results if r["status"] == "ok"],
+            incremental=incremental,
+        )
+    report = {
+        "state": state_number,
+        "years": years,
+        "workers": workers,
+        "statewide": statewide,
+        "incremental": incremental,
+        "elapsed_seconds": round(time.time() - started, 2),
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "counties": sorted(results, key=lambda r: r["county"]),
+    }
+
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(
+        f"\n{report['succeeded']} succeeded, {report['failed']} failed in {report['elapsed_seconds']}s"
+    )
+    for r in failed:
+        print(f"  {r['county']}: {r['error']}")
+    print(f"Report saved to {report_path}")
+
+    return report
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    census_cache.configure_from_args(args)
+    census_profile.configure_from_args(args)
+    fetch_counties(
+        args.state,
+        args.counties,
+        args.years,
+        workers=args.workers,
+        statewide=args.statewide,
+        rebuild=args.rebuild,
+        columnar=args.columnar,
+        incremental=args.incremental,
+        color_ranges=args.color_ranges,
+        report_path=args.report,
+    )
+    census_profile.write_report()
@@ -1,50 +1,94 @@
+import argparse
 import pandas as pd
 
+import geoid_codec
+
 STATE_NUMBER = "06"  # Cali
 COUNTY_NUMBER = "037"  # LA
 YEAR = "2017"
 
+LATCH_FILE = "data/raw/latch_2017-b.csv"
 
-def get_nhts_data():
-    df = pd.read_csv("data/raw/latch_2017-b.csv")
+# Same assumptions as the commute model (see emissions_scenarios.BASELINE)
+GRAMS_PER_MILE = 400
+DAYS_PER_YEAR = 250
 
-    print("Columns:", df.columns.tolist())
-    print("\nFirst few rows:")
-    print(df.head())
+# Rows of the national LATCH file held in memory at once
+CHUNK_SIZE = 200_000
 
-    geo_columns = [
-        col
-        for col in df.columns
-        if any(
-            term in col.lower()
-            for term in ["geoid", "state", "county", "tract", "fips"]
-        )
-    ]
-    print("\nGeographic columns found:", geo_columns)
 
-    df["geocode"] = df["geocode"].astype(str).str.zfill(11)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="extract LATCH vehicle miles for counties or whole states in one pass"
+    )
+    parser.add_argument(
+        "--prefixes",
+        nargs="+",
+        default=[f"{STATE_NUMBER}{COUNTY_NUMBER}"],
+        help="State (e.g., 06) or state+county (e.g., 06037) FIPS prefixes (default: 06037)",
+    )
+    parser.add_argument(
+        "--input", default=LATCH_FILE, help=f"LATCH csv (default: {LATCH_FILE})"
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=CHUNK_SIZE,
+        help=f"Rows read per chunk (default: {CHUNK_SIZE})",
+    )
+    return parser.parse_args()
+
 
-    la_county_data = df[df["geocode"].str.startswith("06037")]
-    print(f"LA County records: {len(la_county_data)}")
+def get_nhts_data(prefixes=None, input_file=LATCH_FILE, chunksize=CHUNK_SIZE):
+    """Stream the national LATCH file once and write latch_emissions for every county matching prefixes"""
+    if prefixes is None:
+        prefixes = [f"{STATE_NUMBER}{COUNTY_NUMBER}"]
 
-    vmiles_df = la_county_data[["geocode", "est_vmiles"]].copy()
+    county_chunks = {}
+    rows_read = 0
 
-    vmiles_df.rename(
-        columns={"geocode": "GEOID", "est_vmiles": "est_vmiles"}, inplace=True
+    reader = pd.read_csv(
+        input_file,
+        usecols=["geocode", "est_vmiles"],
+        dtype={"est_vmiles": "float64"},
+        chunksize=chunksize,
     )
+    for chunk in reader:
+        rows_read += len(chunk)
 
-    vmiles_df_clean = vmiles_df.dropna(subset=["est_vmiles"])
+        # A blank or malformed geocode skips its row rather than failing the whole pass
+        geocodes = pd.to_numeric(chunk["geocode"], errors="coerce")
+        chunk = chunk[geocodes.notna()].assign(
+            geocode=geocodes.dropna().astype("int64")
+        )
 
-    vmiles_df_clean = vmiles_df_clean.reset_index(drop=True)
+        # geocode is the tract GEOID as an integer, so prefixes are range checks
+        chunk = chunk[geoid_codec.in_prefixes(chunk["geocode"].to_numpy(), prefixes)]
+        chunk = chunk.dropna(subset=["est_vmiles"])
+        if chunk.empty:
+            continue
 
-    vmiles_df_clean["co2_metric_tons_per_household"] = (
-        vmiles_df_clean["est_vmiles"] * 400 * 250 / 1000000
-    ).round(3)
+        counties = geoid_codec.county_codes(chunk["geocode"].to_numpy())
+        for county, county_chunk in chunk.groupby(counties, sort=False):
+            county_chunks.setdefault(county, []).append(county_chunk)
 
-    vmiles_df_clean[["co2_metric_tons_per_household", "GEOID"]].to_csv(
-        f"data/census/{STATE_NUMBER}{COUNTY_NUMBER}_latch_emissions.csv", index=False
-    )
+    print(f"Read {rows_read} LATCH records, matched {len(county_chunks)} counties")
+
+    for county, chunks in sorted(county_chunks.items()):
+        vmiles_df = pd.concat(chunks, ignore_index=True)
+
+        vmiles_df["GEOID"] = geoid_codec.decode(vmiles_df["geocode"]).to_numpy()
+        vmiles_df["co2_metric_tons_per_household"] = (
+            vmiles_df["est_vmiles"] * GRAMS_PER_MILE * DAYS_PER_YEAR / 1000000
+        ).round(3)
+
+        geoid_prefix = f"{county:05d}"
+        vmiles_df[["co2_metric_tons_per_household", "GEOID"]].to_csv(
+            f"data/census/{geoid_prefix}_latch_emissions.csv", index=False
+        )
+        print(f"{geoid_prefix} records: {len(vmiles_df)}")
 
 
 if __name__ == "__main__":
-    get_nhts_data()
+    args = parse_args()
+    get_nhts_data(args.prefixes, args.input, args.chunksize)
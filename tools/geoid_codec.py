@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+# An 11 digit tract GEOID is state (2) + county (3) + tract (6) digits, so it
+# fits an int64 as state * 10^9 + county * 10^6 + tract. Sorting the integers
+# sorts the GEOIDs, and a state or county is one contiguous range of them.
+GEOID_LENGTH = 11
+STATE_SCALE = 1_000_000_000
+COUNTY_SCALE = 1_000_000
+
+
+def encode(geoids):
+    """int64 codes of GEOID strings (or numbers)"""
+    if isinstance(geoids, np.ndarray) and geoids.dtype.kind in "iu":
+        return geoids.astype(np.int64, copy=False)
+    return pd.to_numeric(pd.Series(geoids)).to_numpy(dtype=np.int64)
+
+
+def encode_parts(state, county, tract):
+    """int64 codes from the state, county and tract columns of a Census API response"""
+    return encode(state) * STATE_SCALE + encode(county) * COUNTY_SCALE + encode(tract)
+
+
+def decode(codes):
+    """Zero padded GEOID strings, for CSVs and GeoJSON properties"""
+    return (
+        pd.Series(np.asarray(codes, dtype=np.int64)).astype(str).str.zfill(GEOID_LENGTH)
+    )
+
+
+def county_codes(codes):
+    """5 digit state + county number of every code"""
+    return np.asarray(codes) // COUNTY_SCALE
+
+
+def prefix_bounds(prefix):
+    """[low, high) codes of every tract under a state (2 digit) or state + county (5 digit) prefix"""
+    scale = 10 ** (GEOID_LENGTH - len(prefix))
+    return int(prefix) * scale, (int(prefix) + 1) * scale
+
+
+def in_prefixes(codes, prefixes):
+    mask = np.zeros(len(codes), dtype=bool)
+    for prefix in prefixes:
+        low, high = prefix_bounds(prefix)
+        mask |= (codes >= low) & (codes < high)
+    return mask
+
+
+def prefix_rows(sorted_codes, prefix):
+    """Row range of a prefix's tracts in sorted codes"""
+    low, high = prefix_bounds(prefix)
+    return slice(*np.searchsorted(sorted_codes, [low, high]))
+
+
+def positions(sorted_codes, codes):
+    """Index of each code in sorted_codes, -1 where it isn't there"""
+    codes = np.asarray(codes)
+    if len(sorted_codes) == 0:
+        return np.full(len(codes), -1)
+    found = np.minimum(np.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+    return np.where(sorted_codes[found] == codes, found, -1)
+
+
+def align(codes, values, sorted_codes):
+    """Rows of values (one per code) placed on sorted_codes, NaN where a code has no row"""
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(codes, kind="stable")
+    rows = positions(np.asarray(codes)[order], sorted_codes)
+    aligned = np.full((len(sorted_codes),) + values.shape[1:], np.nan)
+    aligned[rows >= 0] = values[order[rows[rows >= 0]]]
+    return aligned
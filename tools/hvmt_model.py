@@ -0,0 +1,301 @@
+import os
+import glob
+import json
+import hashlib
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import census_manifest
+import geoid_codec
+from census_fetch import METRICS, build_metrics_table, load_metric_frames, output_path
+from fetch_color_ranges import list_fetched_counties
+from fetch_nhts_data import DAYS_PER_YEAR, GRAMS_PER_MILE
+
+MODEL_PATH = "data/models/hvmt_census_linear.json"
+FEATURE_CACHE_DIR = "data/cache/hvmt"
+
+# NHTS codes for missing or refused answers (as in the HVMT notebooks)
+SENTINELS = [-9, -8, -7, -1]
+
+# NHTS household income categories (HHFAMINC) and their dollar ranges
+INCOME_BRACKETS = {
+    1: (0, 10_000),
+    2: (10_000, 15_000),
+    3: (15_000, 25_000),
+    4: (25_000, 35_000),
+    5: (35_000, 50_000),
+    6: (50_000, 75_000),
+    7: (75_000, 100_000),
+    8: (100_000, 125_000),
+    9: (125_000, 150_000),
+    10: (150_000, 200_000),
+    11: (200_000, float("inf")),
+}
+
+# HOMEOWN: 1 owns, 2 rents
+OWNER, RENTER = 1, 2
+
+# The census-only linear model of the notebook: numeric features standardized,
+# categoricals one-hot. Each one is read from the tract metric that supplies it.
+NUMERIC_FEATURES = {"HHSIZE": "avg_household_size", "NUMVEH": "vehicles_per_household"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="fit the census-only HVMT linear model and score every tract with it"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fit = commands.add_parser("fit", help="Fit the model from NHTS public use files")
+    fit.add_argument("--households", required=True, help="NHTS hhpub csv")
+    fit.add_argument("--trips", required=True, help="NHTS trippub csv")
+    fit.add_argument(
+        "--keep-zero-vmt",
+        action="store_true",
+        help="Train on households without trips too (the notebook drops them)",
+    )
+    fit.add_argument("--model", default=MODEL_PATH)
+
+    score = commands.add_parser("score", help="Score every tract of fetched counties")
+    score.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    score.add_argument(
+        "--counties",
+        nargs="+",
+        default=["*"],
+        help="County FIPS codes (default: every fetched county)",
+    )
+    score.add_argument("--model", default=MODEL_PATH)
+    return parser.parse_args()
+
+
+def household_vmt(households_path, trips_path, keep_zero_vmt=False):
+    """Household features and total trip miles, cleaned as in the HVMT notebooks"""
+    households = pd.read_csv(households_path)
+    households = households.rename(columns={"HHVEHCNT": "NUMVEH"})
+    households = households[["HOUSEID", "HHSIZE", "NUMVEH", "HHFAMINC", "HOMEOWN"]]
+    households = households.replace(SENTINELS, np.nan)
+
+    trips = pd.read_csv(trips_path, usecols=["HOUSEID", "TRPMILES"])
+    miles = pd.to_numeric(trips["TRPMILES"], errors="coerce")
+    miles = miles.where(~miles.isin(SENTINELS))
+    vmt = miles.groupby(trips["HOUSEID"]).sum(min_count=1).rename("HH_VMT")
+
+    households = households.join(vmt, on="HOUSEID")
+    households["HH_VMT"] = households["HH_VMT"].fillna(0.0)
+    if not keep_zero_vmt:
+        households = households[households["HH_VMT"] > 0]
+    return households
+
+
+def design_matrix(numeric, homeown, income, model):
+    """Feature columns in model order: standardized numerics, then one-hot (or share) columns"""
+    columns = [
+        (numeric[name] - model["means"][name]) / model["scales"][name]
+        for name in NUMERIC_FEATURES
+    ]
+    columns += [homeown[code] for code in model["homeown_codes"]]
+    columns += [income[code] for code in model["income_codes"]]
+    return np.column_stack(columns)
+
+
+def fit_model(households_path, trips_path, keep_zero_vmt=False, model_path=MODEL_PATH):
+    """Least-squares fit of log1p(daily household VMT) with the notebook's smearing correction"""
+    households = household_vmt(households_path, trips_path, keep_zero_vmt)
+    households = households.dropna(subset=list(NUMERIC_FEATURES))
+
+    model = {
+        "target": "log1p_daily_household_vmt",
+        "means": {n: float(households[n].mean()) for n in NUMERIC_FEATURES},
+        "bounds": {
+            n: [float(households[n].min()), float(households[n].max())]
+            for n in NUMERIC_FEATURES
+        },
+        "scales": {
+            n: float(households[n].std(ddof=0)) or 1.0 for n in NUMERIC_FEATURES
+        },
+        "homeown_codes": sorted(
+            int(c) for c in households["HOMEOWN"].dropna().unique()
+        ),
+        "income_codes": sorted(
+            int(c) for c in households["HHFAMINC"].dropna().unique()
+        ),
+    }
+    homeown = {
+        c: (households["HOMEOWN"] == c).to_numpy(float) for c in model["homeown_codes"]
+    }
+    income = {
+        c: (households["HHFAMINC"] == c).to_numpy(float) for c in model["income_codes"]
+    }
+    X = design_matrix(households, homeown, income, model)
+    X = np.column_stack([np.ones(len(X)), X])
+    y = np.log1p(households["HH_VMT"].clip(lower=0).to_numpy())
+
+    # One-hot groups are collinear with the intercept; lstsq picks the minimum norm solution
+    coefficients, *_ = np.linalg.lstsq(X, y, rcond=None)
+    residuals = y - X @ coefficients
+    model["intercept"] = float(coefficients[0])
+    model["coefficients"] = coefficients[1:].tolist()
+    model["smearing_variance"] = float(np.var(residuals))
+    model["training_households"] = len(households)
+    model["r2_log"] = float(1 - residuals.var() / y.var())
+
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    with open(model_path, "w") as f:
+        f.write(json.dumps(model, indent=2))
+    print(
+        f"Model fit on {len(households)} households (R² {model['r2_log']:.3f} in log space), saved to {model_path}"
+    )
+    return model
+
+
+def load_model(model_path=MODEL_PATH):
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(
+            f"No model at {model_path}, run hvmt_model.py fit with the NHTS files first"
+        )
+    with open(model_path) as f:
+        return json.load(f)
+
+
+def tract_features(table, model):
+    """Tract-average design matrix: the mean of a one-hot column over a tract's
+    households is the share of households in that category, so home ownership
+    becomes owner/renter shares and median income picks its income bracket"""
+    numeric = {
+        name: table[metric].to_numpy(dtype=float)
+        for name, metric in NUMERIC_FEATURES.items()
+    }
+    # The model is log-linear, so keep tracts inside the range it was fit on
+    clipped = {
+        name: np.clip(values, *model["bounds"][name])
+        for name, values in numeric.items()
+    }
+    owner_share = table["home_ownership_rate"].to_numpy(dtype=float)
+    shares = {OWNER: owner_share, RENTER: 1 - owner_share}
+    homeown = {
+        code: shares.get(code, np.zeros(len(table))) for code in model["homeown_codes"]
+    }
+
+    income = table["median_household_income"].to_numpy(dtype=float)
+    income_columns = {}
+    for code in model["income_codes"]:
+        low, high = INCOME_BRACKETS.get(code, (np.nan, np.nan))
+        with np.errstate(invalid="ignore"):
+            income_columns[code] = ((income >= low) & (income < high)).astype(float)
+
+    X = design_matrix(clipped, homeown, income_columns, model)
+    # Suppressed estimates (negative ACS sentinels) leave the tract unscored
+    with np.errstate(invalid="ignore"):
+        unusable = ~(income >= 0) | ~(np.column_stack(list(numeric.values())) >= 0).all(
+            axis=1
+        )
+    X[unusable] = np.nan
+    return X
+
+
+def county_tables(state_number, counties):
+    tables = []
+    for county_number in counties:
+        frames = load_metric_frames(state_number, county_number)
+        if frames:
+            tables.append(build_metrics_table(frames))
+    return pd.concat(tables, ignore_index=True)
+
+
+def metric_inputs(state_number, county_number):
+    """Content hashes of the county's current metric CSVs, which the features are built from"""
+    inputs = {}
+    for metric_name in METRICS:
+        content_hash = census_manifest.file_hash(
+            output_path(state_number, county_number, metric_name)
+        )
+        if content_hash is not None:
+            inputs[metric_name] = content_hash
+    return inputs
+
+
+def load_features(state_number, counties, model):
+    """(int64 GEOIDs, design matrix), reused from the cache while the metric files
+    and the model's feature layout are unchanged"""
+    inputs = {c: metric_inputs(state_number, c) for c in counties}
+    layout = {
+        k: model[k]
+        for k in ["means", "bounds", "scales", "homeown_codes", "income_codes"]
+    }
+    key = hashlib.sha256(
+        json.dumps([state_number, inputs, layout], sort_keys=True).encode()
+    ).hexdigest()
+    cache_path = os.path.join(FEATURE_CACHE_DIR, f"{state_number}_{key[:16]}.npz")
+
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as f:
+            return f["geoid"], f["features"]
+
+    table = county_tables(state_number, counties)
+    geoids = geoid_codec.encode(table["GEOID"])
+    features = tract_features(table, model)
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=FEATURE_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, geoid=geoids, features=features)
+    os.replace(tmp_path, cache_path)
+
+    # Only the newest features of a state are ever read again
+    for stale_path in glob.glob(
+        os.path.join(FEATURE_CACHE_DIR, f"{state_number}_*.npz")
+    ):
+        if stale_path != cache_path:
+            os.remove(stale_path)
+    return geoids, features
+
+
+def predict_daily_vmt(features, model):
+    with np.errstate(invalid="ignore"):
+        log_vmt = model["intercept"] + features @ np.asarray(model["coefficients"])
+    return np.expm1(log_vmt + 0.5 * model["smearing_variance"])
+
+
+def hvmt_emissions_path(geoid_prefix):
+    # Beside latch_emissions, which it replaces as the non-commute travel estimate
+    return f"data/census/{geoid_prefix}_hvmt_emissions.csv"
+
+
+def score_tracts(state_number, counties, model_path=MODEL_PATH):
+    """Predict daily household VMT for every tract in one batch and write per-county
+    emissions with the same assumptions as the LATCH extract"""
+    if counties == ["*"]:
+        counties = list_fetched_counties(state_number)
+
+    model = load_model(model_path)
+    geoids, features = load_features(state_number, counties, model)
+    daily_vmt = predict_daily_vmt(features, model)
+    tons = daily_vmt * GRAMS_PER_MILE * DAYS_PER_YEAR / 1_000_000
+    print(
+        f"Scored {len(geoids)} tracts, {np.isnan(daily_vmt).sum()} without usable metrics"
+    )
+
+    order = np.argsort(geoids, kind="stable")
+    geoids, daily_vmt, tons = geoids[order], daily_vmt[order], tons[order]
+    for county_code in np.unique(geoid_codec.county_codes(geoids)):
+        geoid_prefix = f"{county_code:05d}"
+        rows = geoid_codec.prefix_rows(geoids, geoid_prefix)
+        pd.DataFrame(
+            {
+                "co2_metric_tons_per_household": tons[rows].round(3),
+                "daily_vmt_per_household": daily_vmt[rows].round(2),
+                "GEOID": geoid_codec.decode(geoids[rows]),
+            }
+        ).to_csv(hvmt_emissions_path(geoid_prefix), index=False)
+        print(f"HVMT emissions saved to {hvmt_emissions_path(geoid_prefix)}")
+    return daily_vmt
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "fit":
+        fit_model(args.households, args.trips, args.keep_zero_vmt, args.model)
+    else:
+        score_tracts(args.state, args.counties, args.model)
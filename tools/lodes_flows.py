@@ -0,0 +1,295 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import geoid_codec
+from census_fetch import build_metrics_table, load_metric_frames
+from emissions_scenarios import BASELINE, tons_per_commuter_minute
+
+# Rows of the LODES OD csv read at once
+CHUNK_SIZE = 2_000_000
+
+# Tract pairs buffered from chunks before they are merged again
+MERGE_THRESHOLD = 20_000_000
+
+# 15 digit block geocode = tract GEOID (11 digits) + block (4 digits)
+BLOCK_DIGITS = 10_000
+
+# Commuters per tract pair to count as a heavy corridor (README_transit_flow_analysis.md)
+MIN_JOBS = 10
+
+OUTPUT_DIR = "data/lodes"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="roll LODES block origin-destination flows up to a sparse tract x tract matrix and summarize it"
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="LODES OD csv(.gz) files, e.g. ca_od_main_JT00_2022.csv.gz ca_od_aux_JT00_2022.csv.gz",
+    )
+    parser.add_argument(
+        "--matrix",
+        default=None,
+        help="Load a matrix saved by an earlier run instead of reading inputs",
+    )
+    parser.add_argument(
+        "--name", default=None, help="Output name (default: the first input's name)"
+    )
+    parser.add_argument(
+        "--min-block-jobs",
+        type=int,
+        default=0,
+        help="Drop block pairs with fewer commuters before rolling up, as the notebook does (default: 0)",
+    )
+    parser.add_argument(
+        "--min-jobs",
+        type=int,
+        default=MIN_JOBS,
+        help=f"Commuters for a tract pair to count as a corridor (default: {MIN_JOBS})",
+    )
+    parser.add_argument(
+        "--top", type=int, default=100, help="Corridors to list (default: 100)"
+    )
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    if not args.inputs and not args.matrix:
+        parser.error("give LODES OD files or --matrix")
+    return args
+
+
+def merge_pairs(origins, destinations, jobs):
+    """Sum jobs over duplicate (origin, destination) pairs, sorted by origin then destination"""
+    if len(origins) == 0:
+        return origins, destinations, jobs
+    order = np.lexsort((destinations, origins))
+    origins, destinations, jobs = origins[order], destinations[order], jobs[order]
+
+    changed = (origins[1:] != origins[:-1]) | (destinations[1:] != destinations[:-1])
+    starts = np.flatnonzero(np.concatenate([[True], changed]))
+    return origins[starts], destinations[starts], np.add.reduceat(jobs, starts)
+
+
+def read_od(input_files, chunksize=CHUNK_SIZE, min_block_jobs=0):
+    """Stream LODES OD files and return tract-level (origin, destination, jobs) pairs"""
+    buffered = []
+    buffered_rows = 0
+    rows_read = 0
+
+    for input_file in input_files:
+        reader = pd.read_csv(
+            input_file,
+            usecols=["w_geocode", "h_geocode", "S000"],
+            dtype={"w_geocode": "int64", "h_geocode": "int64", "S000": "int64"},
+            chunksize=chunksize,
+        )
+        for chunk in reader:
+            rows_read += len(chunk)
+            if min_block_jobs:
+                chunk = chunk[chunk["S000"].to_numpy() >= min_block_jobs]
+
+            pairs = merge_pairs(
+                chunk["h_geocode"].to_numpy() // BLOCK_DIGITS,
+                chunk["w_geocode"].to_numpy() // BLOCK_DIGITS,
+                chunk["S000"].to_numpy(),
+            )
+            buffered.append(pairs)
+            buffered_rows += len(pairs[0])
+
+            # Chunks repeat many tract pairs, so merging keeps memory bounded by distinct pairs
+            if buffered_rows > MERGE_THRESHOLD:
+                buffered = [merge_pairs(*map(np.concatenate, zip(*buffered)))]
+                buffered_rows = len(buffered[0][0])
+
+        print(f"Read {rows_read} block pairs through {input_file}")
+
+    if not buffered:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    return merge_pairs(*map(np.concatenate, zip(*buffered)))
+
+
+def build_matrix(origins, destinations, jobs):
+    """CSR matrix of jobs with origin tracts as rows and destination tracts as columns.
+
+    Returns {"tracts": sorted tract codes, "indptr", "indices", "data"} with
+    int32 indices and jobs. Pairs must be sorted by origin (as merge_pairs returns them)."""
+    tracts = np.unique(np.concatenate([origins, destinations]))
+    rows = np.searchsorted(tracts, origins).astype(np.int32)
+    indptr = np.zeros(len(tracts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(tracts)), out=indptr[1:])
+    return {
+        "tracts": tracts,
+        "indptr": indptr,
+        "indices": np.searchsorted(tracts, destinations).astype(np.int32),
+        "data": jobs.astype(np.int32),
+    }
+
+
+def save_matrix(matrix, file_path):
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    np.savez_compressed(file_path, **matrix)
+
+
+def load_matrix(file_path):
+    with np.load(file_path) as f:
+        return {key: f[key] for key in ["tracts", "indptr", "indices", "data"]}
+
+
+def matrix_rows(matrix):
+    """Origin index of every stored pair (the COO row array)"""
+    return np.repeat(
+        np.arange(len(matrix["tracts"]), dtype=np.int32), np.diff(matrix["indptr"])
+    )
+
+
+def tract_flows(matrix):
+    """Outflow, inflow and within-tract commuters of every tract"""
+    n = len(matrix["tracts"])
+    rows = matrix_rows(matrix)
+    data = matrix["data"].astype(np.int64)
+    internal = rows == matrix["indices"]
+    return pd.DataFrame(
+        {
+            "GEOID": geoid_codec.decode(matrix["tracts"]),
+            "outflow": np.bincount(rows, weights=data, minlength=n).astype(np.int64),
+            "inflow": np.bincount(matrix["indices"], weights=data, minlength=n).astype(
+                np.int64
+            ),
+            "internal": np.bincount(
+                rows[internal], weights=data[internal], minlength=n
+            ).astype(np.int64),
+        }
+    )
+
+
+def top_corridors(matrix, n=100, min_jobs=MIN_JOBS, include_internal=False):
+    """The n tract pairs with the most commuters (at least min_jobs)"""
+    rows = matrix_rows(matrix)
+    keep = matrix["data"] >= min_jobs
+    if not include_internal:
+        keep &= rows != matrix["indices"]
+    candidates = np.flatnonzero(keep)
+
+    if len(candidates) > n:
+        top = np.argpartition(matrix["data"][candidates], -n)[-n:]
+        candidates = candidates[top]
+    candidates = candidates[np.argsort(-matrix["data"][candidates], kind="stable")]
+
+    return pd.DataFrame(
+        {
+            "origin": geoid_codec.decode(matrix["tracts"][rows[candidates]]),
+            "destination": geoid_codec.decode(
+                matrix["tracts"][matrix["indices"][candidates]]
+            ),
+            "jobs": matrix["data"][candidates],
+        }
+    )
+
+
+def origin_commute_tons(tracts):
+    """Expected annual car commute tons per worker living in each tract: average car
+    commute minutes x share commuting by car x the baseline tons per commuter minute.
+
+    Read from each county's metric CSVs, NaN where a county hasn't been fetched."""
+    tons = np.full(len(tracts), np.nan)
+    factor = tons_per_commuter_minute(BASELINE)
+
+    counties = np.unique(geoid_codec.county_codes(tracts))
+    for county in counties:
+        geoid_prefix = f"{county:05d}"
+        frames = load_metric_frames(geoid_prefix[:2], geoid_prefix[2:])
+        if "car_commute_time" not in frames or "car_commuter_percentage" not in frames:
+            continue
+        table = build_metrics_table(
+            {m: frames[m] for m in ["car_commute_time", "car_commuter_percentage"]}
+        )
+        positions = geoid_codec.positions(tracts, geoid_codec.encode(table["GEOID"]))
+        found = positions >= 0
+        with np.errstate(invalid="ignore"):
+            tons[positions[found]] = (
+                table["car_commute_time"].to_numpy()
+                * table["car_commuter_percentage"].to_numpy()
+                * factor
+            )[found]
+    return tons
+
+
+def emissions_by_destination(matrix, origin_tons):
+    """Commute emissions arriving at each destination tract: every flow weighted by
+    its origin tract's tons per worker (flows from tracts without data are counted separately)"""
+    n = len(matrix["tracts"])
+    rows = matrix_rows(matrix)
+    data = matrix["data"].astype(float)
+    weights = origin_tons[rows]
+    known = ~np.isnan(weights)
+
+    tons = np.bincount(
+        matrix["indices"][known], weights=data[known] * weights[known], minlength=n
+    )
+    covered = np.bincount(matrix["indices"][known], weights=data[known], minlength=n)
+    inflow = np.bincount(matrix["indices"], weights=data, minlength=n)
+    return pd.DataFrame(
+        {
+            "GEOID": geoid_codec.decode(matrix["tracts"]),
+            "commute_co2_metric_tons": tons.round(2),
+            "commuters_with_data": covered.astype(np.int64),
+            "commuters": inflow.astype(np.int64),
+        }
+    )
+
+
+def lodes_flows(
+    input_files,
+    matrix_path=None,
+    name=None,
+    min_block_jobs=0,
+    min_jobs=MIN_JOBS,
+    top=100,
+    chunksize=CHUNK_SIZE,
+):
+    name = name or os.path.basename(input_files[0] if input_files else matrix_path)
+    name = name.split(".")[0]
+
+    if matrix_path:
+        matrix = load_matrix(matrix_path)
+    else:
+        matrix = build_matrix(*read_od(input_files, chunksize, min_block_jobs))
+        matrix_path = os.path.join(OUTPUT_DIR, f"{name}_tracts.npz")
+        save_matrix(matrix, matrix_path)
+        print(f"Matrix saved to {matrix_path}")
+
+    print(
+        f"{len(matrix['tracts'])} tracts, {len(matrix['data'])} tract pairs, {int(matrix['data'].sum(dtype=np.int64))} commuters"
+    )
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    outputs = {
+        "corridors": top_corridors(matrix, top, min_jobs),
+        "tract_flows": tract_flows(matrix),
+        "emissions_by_destination": emissions_by_destination(
+            matrix, origin_commute_tons(matrix["tracts"])
+        ),
+    }
+    for output_name, df in outputs.items():
+        file_path = os.path.join(OUTPUT_DIR, f"{name}_{output_name}.csv")
+        df.to_csv(file_path, index=False)
+        print(f"{output_name} saved to {file_path}")
+    return matrix
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    lodes_flows(
+        args.inputs,
+        args.matrix,
+        args.name,
+        args.min_block_jobs,
+        args.min_jobs,
+        args.top,
+        args.chunksize,
+    )
@@ -0,0 +1,226 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import geoid_codec
+from census_fetch import METRICS, build_metrics_table, load_metric_frames
+from fetch_color_ranges import list_fetched_counties
+
+# ACS releases from 2020 on are tabulated on 2020 tracts, earlier ones on 2010 tracts
+VINTAGE_CHANGE_YEAR = 2020
+
+# Fewest years a tract needs for a linear trend
+MIN_TREND_YEARS = 3
+
+OUTPUT_DIR = "data/census/cube"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="stack every fetched year into a tract x metric x year cube and compute changes and trends"
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument(
+        "--counties",
+        nargs="+",
+        default=["*"],
+        help="County FIPS codes (default: every fetched county)",
+    )
+    parser.add_argument(
+        "--years",
+        nargs="+",
+        type=int,
+        default=None,
+        help="ACS years (default: every year fetched for the counties)",
+    )
+    parser.add_argument(
+        "--crosswalk",
+        default=None,
+        help="Census 2020-to-2010 tract relationship file (tab20_tract20_tract10_natl.txt), needed when years span both tract vintages",
+    )
+    return parser.parse_args()
+
+
+def tract_vintage(year):
+    return 2020 if year >= VINTAGE_CHANGE_YEAR else 2010
+
+
+def fetched_years(state_number, counties):
+    """Every year census_fetch.py wrote for any of the counties"""
+    years = set()
+    for county_number in counties:
+        county_dir = f"data/census/{state_number}{county_number}"
+        if os.path.isdir(county_dir):
+            years.update(int(name) for name in os.listdir(county_dir) if name.isdigit())
+    return sorted(years)
+
+
+def load_year_values(state_number, counties, year, metric_names):
+    """Sorted int64 GEOIDs and a (tract, metric) array of one year's metrics, NaN where missing"""
+    tables = []
+    for county_number in counties:
+        frames = load_metric_frames(state_number, county_number, year=year)
+        if frames:
+            tables.append(build_metrics_table(frames))
+    if not tables:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, len(metric_names)))
+
+    table = pd.concat(tables, ignore_index=True).sort_values("GEOID")
+    table = table.reindex(columns=["GEOID"] + metric_names)
+    values = table[metric_names].to_numpy(dtype=float)
+    # The ACS reports missing estimates as large negative sentinels
+    with np.errstate(invalid="ignore"):
+        values[values < 0] = np.nan
+    return geoid_codec.encode(table["GEOID"]), values
+
+
+def load_crosswalk(file_path, state_number):
+    """(2010 tract, 2020 tract, shared land area) rows of the Census tract relationship file"""
+    df = pd.read_csv(
+        file_path,
+        sep="|",
+        usecols=["GEOID_TRACT_10", "GEOID_TRACT_20", "AREALAND_PART"],
+        dtype={"GEOID_TRACT_10": "int64", "GEOID_TRACT_20": "int64"},
+    )
+    df = df[geoid_codec.in_prefixes(df["GEOID_TRACT_20"].to_numpy(), [state_number])]
+    # All-water overlaps carry no population to move between tracts
+    df = df[df["AREALAND_PART"] > 0]
+    return {
+        "from": df["GEOID_TRACT_10"].to_numpy(),
+        "to": df["GEOID_TRACT_20"].to_numpy(),
+        "weight": df["AREALAND_PART"].to_numpy(dtype=float),
+    }
+
+
+def apply_crosswalk(geoids, values, crosswalk, target_geoids):
+    """Move (tract, metric) values onto the target tracts as an area-weighted average of the
+    source tracts overlapping each one. Every metric is a rate, mean or median, so it is
+    averaged rather than split; NaN sources are left out of each target's weights."""
+    sources = geoid_codec.positions(geoids, crosswalk["from"])
+    targets = geoid_codec.positions(target_geoids, crosswalk["to"])
+    keep = (sources >= 0) & (targets >= 0)
+    sources, targets, weight = sources[keep], targets[keep], crosswalk["weight"][keep]
+
+    order = np.argsort(targets, kind="stable")
+    sources, targets, weight = sources[order], targets[order], weight[order]
+    source_values = values[sources]
+    valid = ~np.isnan(source_values)
+    weights = weight[:, None] * valid
+
+    result = np.full((len(target_geoids), values.shape[1]), np.nan)
+    if len(targets) == 0:
+        return result
+    # One reduceat per target tract run covers every metric at once
+    starts = np.flatnonzero(np.concatenate([[True], targets[1:] != targets[:-1]]))
+    numerator = np.add.reduceat(weights * np.where(valid, source_values, 0), starts)
+    denominator = np.add.reduceat(weights, starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result[targets[starts]] = numerator / denominator
+    return result
+
+
+def build_cube(state_number, counties, years, crosswalk=None):
+    """Dense (tract, metric, year) array on the tracts of the latest year.
+
+    Years tabulated on an older tract vintage are moved onto the latest
+    vintage through the crosswalk. Returns the cube, its int64 GEOIDs and the metric names."""
+    metric_names = list(METRICS)
+    latest = max(years)
+    target_geoids, _ = load_year_values(state_number, counties, latest, metric_names)
+
+    cube = np.full((len(target_geoids), len(metric_names), len(years)), np.nan)
+    for k, year in enumerate(years):
+        geoids, values = load_year_values(state_number, counties, year, metric_names)
+        if tract_vintage(year) == tract_vintage(latest):
+            cube[:, :, k] = geoid_codec.align(geoids, values, target_geoids)
+        elif crosswalk is None:
+            raise ValueError(
+                f"{year} uses {tract_vintage(year)} tracts and {latest} uses {tract_vintage(latest)} tracts, pass --crosswalk"
+            )
+        else:
+            cube[:, :, k] = apply_crosswalk(geoids, values, crosswalk, target_geoids)
+        print(f"{year}: {len(geoids)} tracts")
+
+    # Drop metrics none of the years were fetched with
+    present = ~np.isnan(cube).all(axis=(0, 2))
+    metric_names = [m for m, p in zip(metric_names, present) if p]
+    return cube[:, present], target_geoids, metric_names
+
+
+def delta(cube, start=0, end=-1):
+    """Change between two year slices for every (tract, metric)"""
+    return cube[..., end] - cube[..., start]
+
+
+def percent_change(cube, start=0, end=-1):
+    base = cube[..., start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(base != 0, delta(cube, start, end) / np.abs(base) * 100, np.nan)
+
+
+def linear_trend(cube, years, min_years=MIN_TREND_YEARS):
+    """Least-squares slope per year of every (tract, metric) series, skipping missing years"""
+    x = np.asarray(years, dtype=float)
+    valid = ~np.isnan(cube)
+    counts = valid.sum(axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = (valid * x).sum(axis=-1) / counts
+        y_mean = np.nansum(cube, axis=-1) / counts
+        dx = np.where(valid, x - x_mean[..., None], 0)
+        dy = np.where(valid, cube - y_mean[..., None], 0)
+        slope = (dx * dy).sum(axis=-1) / (dx * dx).sum(axis=-1)
+    slope[counts < min_years] = np.nan
+    return slope
+
+
+def trend_layer(cube, geoids, metric_names, years):
+    """One row per tract with the change, percent change and yearly trend of every metric"""
+    layer = {"GEOID": geoid_codec.decode(geoids)}
+    for name, values in [
+        ("change", delta(cube)),
+        ("pct_change", percent_change(cube)),
+        ("trend", linear_trend(cube, years)),
+    ]:
+        for j, metric_name in enumerate(metric_names):
+            layer[f"{metric_name}_{name}"] = values[:, j]
+    return pd.DataFrame(layer).round(4)
+
+
+def metric_cube(state_number, counties, years=None, crosswalk_path=None):
+    if counties == ["*"]:
+        counties = list_fetched_counties(state_number)
+    years = sorted(years or fetched_years(state_number, counties))
+    if not years:
+        raise FileNotFoundError(
+            "No per-year outputs found, run census_fetch.py for the years first"
+        )
+
+    crosswalk = load_crosswalk(crosswalk_path, state_number) if crosswalk_path else None
+    cube, geoids, metric_names = build_cube(state_number, counties, years, crosswalk)
+    print(
+        f"Cube of {cube.shape[0]} tracts x {cube.shape[1]} metrics x {cube.shape[2]} years"
+    )
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    name = f"{state_number}_{years[0]}_{years[-1]}"
+    cube_path = os.path.join(OUTPUT_DIR, f"{name}.npz")
+    np.savez_compressed(
+        cube_path,
+        geoid=geoids,
+        metrics=np.array(metric_names),
+        years=np.array(years),
+        values=cube,
+    )
+    # Dollar metrics are in each year's dollars, not adjusted for inflation
+    trends_path = os.path.join(OUTPUT_DIR, f"{name}_trends.csv")
+    trend_layer(cube, geoids, metric_names, years).to_csv(trends_path, index=False)
+    print(f"Cube saved to {cube_path}, trends to {trends_path}")
+    return cube
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    metric_cube(args.state, args.counties, args.years, args.crosswalk)
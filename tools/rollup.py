@@ -0,0 +1,205 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import census_cache
+import geoid_codec
+from census_fetch import METRICS, numeric, plan_metrics, request_acs
+
+# Published medians and averages can't be summed, so a county's value is the
+# mean of its tracts' values weighted by the universe each one is measured over
+VALUE_WEIGHTS = {
+    "median_household_income": "B25003_001E",  # occupied housing units = households
+    "avg_household_size": "B25003_001E",  # exact: household population / households
+    "median_rooms_per_household": "B25001_001E",  # all housing units
+}
+DEFAULT_VALUE_WEIGHT = "B25003_001E"
+
+# Metropolitan planning regions; counties not listed roll up into "Other"
+REGIONS = {
+    "06": {
+        "Bay Area": ["001", "013", "041", "055", "075", "081", "085", "095", "097"],
+        "Sacramento": ["017", "061", "067", "101", "113", "115"],
+        "San Diego": ["073"],
+        "Southern California": ["025", "037", "059", "065", "071", "111"],
+    }
+}
+OTHER_REGION = "Other"
+
+LEVELS = ["tract", "county", "region", "state"]
+
+OUTPUT_DIR = "data/census/rollups"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="aggregate every metric from tracts to counties, regions and the state from its numerators and denominators"
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument("--year", default="2023", help="ACS year (default: 2023)")
+    parser.add_argument(
+        "--regions",
+        default=None,
+        help="CSV with county (5 digit state + county FIPS) and region columns (default: the built-in regions for the state)",
+    )
+    census_cache.add_cache_args(parser)
+    return parser.parse_args()
+
+
+def value_weight(metric_name):
+    return VALUE_WEIGHTS.get(metric_name, DEFAULT_VALUE_WEIGHT)
+
+
+def value_components(df, spec, metric_name):
+    values = numeric(df, [spec["variable"]]).iloc[:, 0].to_numpy(dtype=float)
+    weights = numeric(df, [value_weight(metric_name)]).iloc[:, 0].to_numpy(dtype=float)
+    # Negative values are ACS sentinels for suppressed estimates
+    with np.errstate(invalid="ignore"):
+        usable = (values >= 0) & (weights > 0)
+    return np.where(usable, values * weights, 0), np.where(usable, weights, 0)
+
+
+def weighted_ratio_components(df, spec, metric_name):
+    weights = spec["weights"]
+    counts = numeric(df, list(weights)).to_numpy(dtype=float)
+    denominator = numeric(df, [spec["denominator"]]).iloc[:, 0].to_numpy(dtype=float)
+    # A tract missing any count has no ratio, so it leaves the denominator too
+    usable = ~np.isnan(counts).any(axis=1) & ~np.isnan(denominator)
+    numerator = np.nan_to_num(counts) @ list(weights.values())
+    return np.where(usable, numerator, 0), np.where(usable, denominator, 0)
+
+
+def midpoint_mean_components(df, spec, metric_name):
+    midpoints = spec["midpoints"]
+    counts = numeric(df, list(midpoints)).fillna(0).to_numpy()
+    total = numeric(df, [spec["total"]]).iloc[:, 0].fillna(0)
+    return counts @ list(midpoints.values()), total.to_numpy(dtype=float)
+
+
+def commute_emissions_components(df, spec, metric_name):
+    """Total tons (unrounded mean commute minutes x car commuters x tons per minute) over households"""
+    time_spec = METRICS[spec["depends_on"][0]]
+    minutes, total = midpoint_mean_components(df, time_spec, spec["depends_on"][0])
+    commuters = numeric(df, [spec["commuters"]]).iloc[:, 0].fillna(0).to_numpy()
+    households = numeric(df, [spec["households"]]).iloc[:, 0].fillna(0)
+
+    mean_minutes = minutes / np.where(total == 0, 1, total)
+    tons = mean_minutes * commuters * spec["tons_per_commuter_minute"]
+    return tons, households.to_numpy(dtype=float)
+
+
+COMPONENTS = {
+    "value": value_components,
+    "weighted_ratio": weighted_ratio_components,
+    "midpoint_mean": midpoint_mean_components,
+    "commute_emissions": commute_emissions_components,
+}
+
+
+def load_components(state_number, year):
+    """Sorted int64 tract codes and (tract, metric) numerator and denominator arrays,
+    from the same (cached) statewide ACS request fetch_state_data makes"""
+    _, variables = plan_metrics(METRICS)
+    variables += [
+        value_weight(m) for m in METRICS if METRICS[m]["derivation"] == "value"
+    ]
+    df = request_acs(state_number, None, year, variables)
+
+    codes = geoid_codec.encode(df["GEOID"])
+    order = np.argsort(codes, kind="stable")
+    numerators = np.zeros((len(df), len(METRICS)))
+    denominators = np.zeros((len(df), len(METRICS)))
+    for j, (metric_name, spec) in enumerate(METRICS.items()):
+        numerators[:, j], denominators[:, j] = COMPONENTS[spec["derivation"]](
+            df, spec, metric_name
+        )
+    return codes[order], numerators[order], denominators[order]
+
+
+def load_regions(state_number, regions_path=None):
+    """{5 digit county GEOID: region}"""
+    if regions_path:
+        regions = pd.read_csv(regions_path, dtype=str)
+        return dict(zip(regions["county"], regions["region"]))
+    return {
+        f"{state_number}{county_number}": region
+        for region, counties in REGIONS.get(state_number, {}).items()
+        for county_number in counties
+    }
+
+
+def group_sums(keys, values):
+    """Sorted unique keys and the column sums of values over each, in one pass"""
+    unique_keys, groups = np.unique(keys, return_inverse=True)
+    sums = np.zeros((len(unique_keys), values.shape[1]))
+    np.add.at(sums, groups, values)
+    return unique_keys, sums
+
+
+def build_pyramid(codes, numerators, denominators, regions, state_number):
+    """{level: (keys, numerators, denominators)} with every level summed from the one below"""
+    components = np.hstack([numerators, denominators])
+    n = numerators.shape[1]
+
+    # Tracts are sorted by code, so each county is one contiguous run
+    counties = geoid_codec.county_codes(codes)
+    starts = np.flatnonzero(np.concatenate([[True], counties[1:] != counties[:-1]]))
+    county_sums = np.add.reduceat(components, starts) if len(codes) else components
+    county_keys = np.array([f"{c:05d}" for c in counties[starts]])
+
+    region_keys, region_sums = group_sums(
+        np.array([regions.get(c, OTHER_REGION) for c in county_keys]), county_sums
+    )
+    state_sums = county_sums.sum(axis=0, keepdims=True)
+
+    pyramid = {"tract": (geoid_codec.decode(codes).to_numpy(), components)}
+    pyramid["county"] = (county_keys, county_sums)
+    pyramid["region"] = (region_keys, region_sums)
+    pyramid["state"] = (np.array([state_number]), state_sums)
+    return {
+        level: (keys, sums[:, :n], sums[:, n:])
+        for level, (keys, sums) in pyramid.items()
+    }
+
+
+def level_table(level, keys, numerators, denominators):
+    """Each metric's weighted value plus the numerator and denominator it came from,
+    so a custom grouping can be aggregated further without going back to tracts"""
+    key_column = "GEOID" if level in ("tract", "county", "state") else "region"
+    table = {key_column: keys}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values = np.where(denominators > 0, numerators / denominators, np.nan)
+    for j, (metric_name, spec) in enumerate(METRICS.items()):
+        table[metric_name] = values[:, j].round(spec.get("round", 2))
+    for j, metric_name in enumerate(METRICS):
+        table[f"{metric_name}_numerator"] = numerators[:, j].round(3)
+        table[f"{metric_name}_denominator"] = denominators[:, j].round(3)
+    return pd.DataFrame(table)
+
+
+def rollup(state_number, year, regions_path=None):
+    codes, numerators, denominators = load_components(state_number, year)
+    pyramid = build_pyramid(
+        codes,
+        numerators,
+        denominators,
+        load_regions(state_number, regions_path),
+        state_number,
+    )
+
+    output_dir = os.path.join(OUTPUT_DIR, str(year))
+    os.makedirs(output_dir, exist_ok=True)
+    for level in LEVELS:
+        table = level_table(level, *pyramid[level])
+        file_path = os.path.join(output_dir, f"{state_number}_{level}.csv")
+        table.to_csv(file_path, index=False)
+        print(f"{len(table)} {level} rows saved to {file_path}")
+    return pyramid
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    census_cache.configure_from_args(args)
+    rollup(args.state, args.year, args.regions)
@@ -0,0 +1,552 @@
+import os
+import gzip
+import json
+import math
+import time
+import argparse
+
+import numpy as np
+
+from tiger_shapes import read_tracts
+
+# Grid points per axis coordinates are snapped to (like topojson -q)
+QUANTIZATION = 100_000
+
+# Douglas-Peucker tolerance in screen pixels at each output zoom level
+ZOOM_TOLERANCES = {6: 1.0, 9: 1.0, 12: 0.5}
+
+TILE_SIZE = 256
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="simplify tract GeoJSON along shared borders and quantize it for several zoom levels"
+    )
+    parser.add_argument(
+        "input",
+        help="Tract GeoJSON (e.g., from fetch_all_data.sh), or a TIGER/Line .shp with --county",
+    )
+    parser.add_argument(
+        "--county",
+        default=None,
+        help="County FIPS code to read from a .shp input, without extracting GeoJSON first",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=None,
+        help="Where to write {name}.z{zoom}.geojson (default: beside the input)",
+    )
+    parser.add_argument(
+        "--zooms",
+        nargs="+",
+        default=[f"{z}:{px}" for z, px in ZOOM_TOLERANCES.items()],
+        help="Zoom levels with their tolerance in pixels as zoom:px (default: 6:1 9:1 12:0.5)",
+    )
+    parser.add_argument(
+        "--quantization",
+        type=int,
+        default=QUANTIZATION,
+        help=f"Grid points per axis (default: {QUANTIZATION})",
+    )
+    parser.add_argument(
+        "--topojson",
+        action="store_true",
+        help="Also write the simplified topology as {name}.z{zoom}.topojson",
+    )
+    args = parser.parse_args()
+    if args.input.endswith(".shp") and not args.county:
+        parser.error("--county is required with a .shp input")
+
+    zoom_tolerances = {}
+    for value in args.zooms:
+        zoom, _, pixels = value.partition(":")
+        zoom_tolerances[int(zoom)] = float(pixels) if pixels else 1.0
+    args.zooms = zoom_tolerances
+    return args
+
+
+def polygons(geometry):
+    """Rings of every polygon of a Polygon or MultiPolygon geometry"""
+    if geometry is None:
+        return []
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    raise ValueError(f"Unsupported geometry type {geometry['type']}")
+
+
+def quantize_rings(features, quantization):
+    """Snap every ring onto an integer grid over the collection's bounding box.
+
+    Returns the open rings (closing point dropped, consecutive duplicates
+    removed), the polygon structure as lists of ring indices per feature,
+    and the grid transform."""
+    raw_rings = []
+    shapes = []
+    for feature in features:
+        feature_polygons = []
+        for polygon in polygons(feature["geometry"]):
+            ring_indices = []
+            for ring in polygon:
+                ring_indices.append(len(raw_rings))
+                raw_rings.append(np.asarray(ring, dtype=float)[:, :2])
+            feature_polygons.append(ring_indices)
+        shapes.append(feature_polygons)
+
+    points = np.concatenate(raw_rings) if raw_rings else np.zeros((0, 2))
+    translate = points.min(axis=0) if len(points) else np.zeros(2)
+    extent = points.max(axis=0) - translate if len(points) else np.zeros(2)
+    scale = np.where(extent > 0, extent / (quantization - 1), 1.0)
+
+    rings = []
+    for ring in raw_rings:
+        grid = np.round((ring - translate) / scale).astype(np.int64)
+        if len(grid) > 1 and (grid[0] == grid[-1]).all():
+            grid = grid[:-1]
+        # Vertices closer than a grid cell land on the same point
+        changed = (grid != np.roll(grid, 1, axis=0)).any(axis=1)
+        if changed.any():
+            grid = grid[changed]
+        else:
+            grid = grid[:1]
+        rings.append(grid)
+
+    transform = {"scale": scale.tolist(), "translate": translate.tolist()}
+    return rings, shapes, transform
+
+
+def find_junctions(rings):
+    """Boolean mask per ring of the points where borders between tracts start or end.
+
+    A point is a junction when it has different neighbors in different rings,
+    so every stretch of border between two junctions is shared as a whole."""
+    lengths = np.array([len(r) for r in rings])
+    points = np.concatenate(rings)
+    keys = (points[:, 0] << 32) | points[:, 1]
+
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    sizes = np.repeat(lengths, lengths)
+    local = np.arange(len(points)) - starts
+    previous = keys[starts + (local - 1) % sizes]
+    following = keys[starts + (local + 1) % sizes]
+    low = np.minimum(previous, following)
+    high = np.maximum(previous, following)
+
+    order = np.lexsort((high, low, keys))
+    keys_sorted, low_sorted, high_sorted = keys[order], low[order], high[order]
+    same_point = keys_sorted[1:] == keys_sorted[:-1]
+    other_neighbors = (low_sorted[1:] != low_sorted[:-1]) | (
+        high_sorted[1:] != high_sorted[:-1]
+    )
+    junction_keys = np.unique(keys_sorted[1:][same_point & other_neighbors])
+
+    is_junction = np.isin(keys, junction_keys)
+    return np.split(is_junction, np.cumsum(lengths)[:-1])
+
+
+def build_topology(features, quantization=QUANTIZATION):
+    """Split every ring into arcs shared between neighboring tracts (as in TopoJSON).
+
+    Returns a dict with the integer "arcs", each feature's polygons as lists of
+    rings of arc references ("shapes", where ~i is arc i reversed) and the grid
+    "transform", plus the "latitude" of its middle."""
+    rings, shapes, transform = quantize_rings(features, quantization)
+    middle_latitude = (
+        transform["translate"][1] + transform["scale"][1] * (quantization - 1) / 2
+    )
+    junctions = find_junctions(rings) if rings else []
+
+    arcs = []
+    arc_index = {}
+
+    def add_arc(arc):
+        forward = arc.tobytes()
+        if forward in arc_index:
+            return arc_index[forward]
+        backward = arc[::-1].tobytes()
+        if backward in arc_index:
+            return ~arc_index[backward]
+        arc_index[forward] = len(arcs)
+        arcs.append(arc)
+        return len(arcs) - 1
+
+    ring_arcs = []
+    for ring, is_junction in zip(rings, junctions):
+        cuts = np.flatnonzero(is_junction)
+        if len(cuts) == 0:
+            # A ring touching no other ring is one closed arc, started at its
+            # smallest point so an identical ring elsewhere maps to the same arc
+            keys = (ring[:, 0] << 32) | ring[:, 1]
+            cuts = [int(np.argmin(keys))]
+
+        rotated = np.roll(ring, -cuts[0], axis=0)
+        closed = np.concatenate([rotated, rotated[:1]])
+        bounds = list(np.asarray(cuts) - cuts[0]) + [len(ring)]
+        ring_arcs.append(
+            [add_arc(closed[a : b + 1]) for a, b in zip(bounds[:-1], bounds[1:])]
+        )
+
+    return {
+        "arcs": arcs,
+        "shapes": [
+            [[ring_arcs[r] for r in polygon] for polygon in feature_polygons]
+            for feature_polygons in shapes
+        ],
+        "transform": transform,
+        "latitude": middle_latitude,
+    }
+
+
+def arc_importance(arc, factors):
+    """Douglas-Peucker importance of every vertex of an arc: the largest
+    tolerance at which it survives simplification (inf for the endpoints)"""
+    points = arc * factors
+    importance = np.zeros(len(arc))
+    importance[0] = importance[-1] = np.inf
+
+    stack = [(0, len(arc) - 1, np.inf)]
+    while stack:
+        first, last, ceiling = stack.pop()
+        if last - first < 2:
+            continue
+
+        start, end = points[first], points[last]
+        inner = points[first + 1 : last]
+        segment = end - start
+        length = np.dot(segment, segment)
+        if length == 0:
+            distances = np.hypot(*(inner - start).T)
+        else:
+            t = np.clip((inner - start) @ segment / length, 0, 1)
+            distances = np.hypot(*(inner - start - np.outer(t, segment)).T)
+
+        split = int(np.argmax(distances))
+        # A vertex never outlives the vertex whose split made it a candidate
+        value = min(distances[split], ceiling)
+        importance[first + 1 + split] = value
+        stack.append((first, first + 1 + split, value))
+        stack.append((first + 1 + split, last, value))
+
+    return importance
+
+
+def topology_factors(topology):
+    """Scale from grid units to degrees of latitude, so distances match on screen at the collection's latitude"""
+    scale = topology["transform"]["scale"]
+    return np.array([scale[0] * math.cos(math.radians(topology["latitude"])), scale[1]])
+
+
+def zoom_tolerance(zoom, pixels, topology):
+    """A tolerance in screen pixels at a zoom level as degrees of latitude"""
+    degrees_per_pixel = 360 / (TILE_SIZE * 2**zoom)
+    return pixels * degrees_per_pixel * math.cos(math.radians(topology["latitude"]))
+
+
+def candidate_pairs(p, q):
+    """Pairs (i < j) of segments whose bounding boxes share a grid cell.
+
+    The cell size starts at the median segment span and doubles until the
+    segments cover at most a few cells each, so long segments stay cheap."""
+    low, high = np.minimum(p, q), np.maximum(p, q)
+    span = (high - low).max(axis=1)
+    cell = max(int(np.median(span)) if len(span) else 1, 1)
+    while True:
+        lo, hi = low // cell, high // cell
+        counts = (hi[:, 0] - lo[:, 0] + 1) * (hi[:, 1] - lo[:, 1] + 1)
+        if counts.sum() <= 8 * len(p) or counts.max() == 1:
+            break
+        cell *= 2
+
+    segment = np.repeat(np.arange(len(p)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    width = (hi[:, 0] - lo[:, 0] + 1)[segment]
+    keys = ((lo[segment, 0] + k % width) << 32) | (lo[segment, 1] + k // width)
+
+    order = np.argsort(keys, kind="stable")
+    keys, segment = keys[order], segment[order]
+    pairs = []
+    # Entries of a cell are adjacent after sorting, so stop at the first offset with no shared cell
+    for offset in range(1, len(keys)):
+        same = keys[:-offset] == keys[offset:]
+        if not same.any():
+            break
+        pairs.append(np.column_stack([segment[:-offset][same], segment[offset:][same]]))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+
+
+def orientation(a, b, c):
+    """Sign of the turn a -> b -> c (exact on the integer grid)"""
+    return np.sign(
+        (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1])
+        - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])
+    )
+
+
+def on_segment(a, b, c):
+    """Whether c, collinear with a and b, lies within their bounding box"""
+    return (np.minimum(a, b) <= c).all(axis=1) & (c <= np.maximum(a, b)).all(axis=1)
+
+
+def crossing_arcs(arcs):
+    """Indices of arcs with a segment that crosses, overlaps or touches another
+    segment anywhere but at an endpoint they share"""
+    lengths = np.array([max(len(arc) - 1, 0) for arc in arcs])
+    if lengths.sum() == 0:
+        return set()
+    p = np.concatenate([arc[:-1] for arc in arcs if len(arc) > 1])
+    q = np.concatenate([arc[1:] for arc in arcs if len(arc) > 1])
+    arc_ids = np.repeat(np.arange(len(arcs)), lengths)
+
+    i, j = candidate_pairs(p, q).T
+    a, b, c, d = p[i], q[i], p[j], q[j]
+    o1, o2 = orientation(a, b, c), orientation(a, b, d)
+    o3, o4 = orientation(c, d, a), orientation(c, d, b)
+
+    # Segments meeting at a shared endpoint are fine unless they fold onto each other
+    shared = np.zeros(len(i), dtype=bool)
+    overlap = np.zeros(len(i), dtype=bool)
+    for x, y, u, v in [(a, c, b, d), (a, d, b, c), (b, c, a, d), (b, d, a, c)]:
+        meet = (x == y).all(axis=1)
+        folded = (orientation(x, u, v) == 0) & (((u - x) * (v - x)).sum(axis=1) > 0)
+        shared |= meet
+        overlap |= meet & folded
+
+    crossing = (o1 * o2 < 0) & (o3 * o4 < 0)
+    touching = (
+        ((o1 == 0) & on_segment(a, b, c))
+        | ((o2 == 0) & on_segment(a, b, d))
+        | ((o3 == 0) & on_segment(c, d, a))
+        | ((o4 == 0) & on_segment(c, d, b))
+    )
+    invalid = overlap | (~shared & (crossing | touching))
+    return set(arc_ids[i[invalid]].tolist()) | set(arc_ids[j[invalid]].tolist())
+
+
+def simplify_topology(topology, tolerance, importances=None):
+    """Simplified copy of every arc. Shared borders are simplified once so
+    neighbors stay gap free, arcs of rings that would collapse keep
+    their most important vertices so every tract survives, and arcs that
+    would cross themselves or another arc get dropped vertices back until
+    they don't (or nothing is left to restore)."""
+    if importances is None:
+        factors = topology_factors(topology)
+        importances = [arc_importance(arc, factors) for arc in topology["arcs"]]
+    thresholds = np.full(len(topology["arcs"]), tolerance, dtype=float)
+
+    rings = [
+        ring for shape in topology["shapes"] for polygon in shape for ring in polygon
+    ]
+    while True:
+        kept = [importance >= t for importance, t in zip(importances, thresholds)]
+        lowered = False
+        for ring in rings:
+            ring_arcs = [~a if a < 0 else a for a in ring]
+            if sum(kept[a].sum() - 1 for a in ring_arcs) >= 3:
+                continue
+            for a in ring_arcs:
+                dropped = importances[a][~kept[a]]
+                if len(dropped):
+                    thresholds[a] = dropped.max()
+                    lowered = True
+        if not lowered:
+            break
+
+    # Restoring vertices only moves arcs back toward the valid original, so each
+    # round brings back the most important dropped vertex of every offending arc
+    while True:
+        lowered = False
+        for a in crossing_arcs(
+            [arc[mask] for arc, mask in zip(topology["arcs"], kept)]
+        ):
+            dropped = importances[a][~kept[a]]
+            if len(dropped):
+                thresholds[a] = dropped.max()
+                kept[a] = importances[a] >= thresholds[a]
+                lowered = True
+        if not lowered:
+            break
+
+    return [arc[mask] for arc, mask in zip(topology["arcs"], kept)]
+
+
+def ring_coordinates(ring, arcs):
+    parts = []
+    for i, a in enumerate(ring):
+        arc = arcs[~a][::-1] if a < 0 else arcs[a]
+        parts.append(arc if i == 0 else arc[1:])
+    return np.concatenate(parts)
+
+
+def to_geojson(topology, arcs, features):
+    """Rebuild a GeoJSON FeatureCollection (with the features' properties) from simplified arcs"""
+    scale = np.array(topology["transform"]["scale"])
+    translate = np.array(topology["transform"]["translate"])
+    # Enough decimals to tell grid points apart, and no more
+    decimals = max(0, math.ceil(-math.log10(scale.min()))) + 1
+
+    output = []
+    for feature, shape in zip(features, topology["shapes"]):
+        coordinates = [
+            [
+                np.round(
+                    ring_coordinates(ring, arcs) * scale + translate, decimals
+                ).tolist()
+                for ring in polygon
+            ]
+            for polygon in shape
+        ]
+        if len(coordinates) == 1:
+            geometry = {"type": "Polygon", "coordinates": coordinates[0]}
+        else:
+            geometry = {"type": "MultiPolygon", "coordinates": coordinates}
+        output.append(
+            {
+                "type": "Feature",
+                "geometry": geometry if coordinates else None,
+                "properties": feature.get("properties", {}),
+            }
+        )
+    return {"type": "FeatureCollection", "features": output}
+
+
+def to_topojson(topology, arcs, features, name="tracts"):
+    """Quantized TopoJSON with delta-encoded arcs"""
+    geometries = []
+    for feature, shape in zip(features, topology["shapes"]):
+        if len(shape) == 1:
+            geometry = {"type": "Polygon", "arcs": shape[0]}
+        else:
+            geometry = {"type": "MultiPolygon", "arcs": shape}
+        geometry["properties"] = feature.get("properties", {})
+        geometries.append(geometry)
+
+    return {
+        "type": "Topology",
+        "transform": topology["transform"],
+        "objects": {name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": [
+            np.concatenate([arc[:1], np.diff(arc, axis=0)]).tolist() for arc in arcs
+        ],
+    }
+
+
+def geojson_vertices(collection):
+    return sum(
+        len(ring)
+        for feature in collection["features"]
+        for polygon in polygons(feature["geometry"])
+        for ring in polygon
+    )
+
+
+def size_report(content):
+    return {"bytes": len(content), "gzip_bytes": len(gzip.compress(content, mtime=0))}
+
+
+def simplify_tracts(
+    input_file,
+    output_dir=None,
+    zoom_tolerances=ZOOM_TOLERANCES,
+    quantization=QUANTIZATION,
+    topojson=False,
+    county_number=None,
+):
+    """Write a simplified, quantized GeoJSON per zoom level and a size/vertex report"""
+    started = time.perf_counter()
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    if input_file.endswith(".shp"):
+        # Rings come straight from the mapped shapefile as NumPy views
+        features = list(read_tracts(input_file, [county_number]))
+        collection = {"type": "FeatureCollection", "features": features}
+        name = f"{name}_{county_number}"
+    else:
+        with open(input_file) as f:
+            collection = json.load(f)
+        features = collection["features"]
+
+    output_dir = output_dir or os.path.dirname(input_file) or "."
+    os.makedirs(output_dir, exist_ok=True)
+
+    topology = build_topology(features, quantization)
+    factors = topology_factors(topology)
+    importances = [arc_importance(arc, factors) for arc in topology["arcs"]]
+    references = np.zeros(len(topology["arcs"]), dtype=int)
+    for shape in topology["shapes"]:
+        for polygon in shape:
+            for ring in polygon:
+                for a in ring:
+                    references[~a if a < 0 else a] += 1
+
+    report = {
+        "input": input_file,
+        "features": len(features),
+        "arcs": len(topology["arcs"]),
+        "shared_arcs": int((references > 1).sum()),
+        "quantization": quantization,
+        "original": dict(
+            size_report(
+                json.dumps(
+                    collection, separators=(",", ":"), default=np.ndarray.tolist
+                ).encode()
+            ),
+            vertices=geojson_vertices(collection),
+        ),
+        "zooms": {},
+    }
+
+    for zoom, pixels in sorted(zoom_tolerances.items()):
+        tolerance = zoom_tolerance(zoom, pixels, topology)
+        arcs = simplify_topology(topology, tolerance, importances)
+
+        simplified = to_geojson(topology, arcs, features)
+        content = json.dumps(simplified, separators=(",", ":")).encode()
+        output_file = os.path.join(output_dir, f"{name}.z{zoom}.geojson")
+        with open(output_file, "wb") as f:
+            f.write(content)
+
+        zoom_report = dict(
+            size_report(content),
+            tolerance_px=pixels,
+            vertices=geojson_vertices(simplified),
+            arc_vertices=sum(len(arc) for arc in arcs),
+            # Arcs still crossing after repair (only where the input itself does)
+            crossing_arcs=len(crossing_arcs(arcs)),
+        )
+        if topojson:
+            content = json.dumps(
+                to_topojson(topology, arcs, features), separators=(",", ":")
+            ).encode()
+            with open(os.path.join(output_dir, f"{name}.z{zoom}.topojson"), "wb") as f:
+                f.write(content)
+            zoom_report["topojson"] = size_report(content)
+        report["zooms"][str(zoom)] = zoom_report
+
+        original = report["original"]
+        print(
+            f"z{zoom}: {zoom_report['vertices']}/{original['vertices']} vertices, "
+            f"{zoom_report['bytes'] / 1024:.0f}/{original['bytes'] / 1024:.0f} KB "
+            f"({zoom_report['gzip_bytes'] / 1024:.0f} KB gzipped) -> {output_file}"
+        )
+
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    report_file = os.path.join(output_dir, f"{name}_simplify_report.json")
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {report_file}")
+    return report
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    simplify_tracts(
+        args.input,
+        args.output_dir,
+        args.zooms,
+        args.quantization,
+        args.topojson,
+        args.county,
+    )
@@ -0,0 +1,236 @@
+import os
+import json
+import tempfile
+import argparse
+
+import numpy as np
+
+SHAPEFILE = "data/raw/tl_2023_06_tract.shp"
+OUTPUT_DIR = "data/processed"
+
+# Main file header and record header sizes in bytes (.shp offsets are in 16 bit words)
+FILE_HEADER_SIZE = 100
+RECORD_HEADER_SIZE = 8
+
+NULL_SHAPE = 0
+# Polygon, PolygonZ and PolygonM, whose x and y come first alike
+POLYGON_SHAPES = {5, 15, 25}
+
+# dBase encoding when the shapefile has no .cpg
+DEFAULT_ENCODING = "latin-1"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="extract tract GeoJSON for counties from a TIGER/Line shapefile in one pass"
+    )
+    parser.add_argument(
+        "--shapefile", default=SHAPEFILE, help=f"Tract .shp (default: {SHAPEFILE})"
+    )
+    parser.add_argument(
+        "--counties",
+        nargs="+",
+        default=["*"],
+        help="County FIPS codes, optionally with a file name label as 075:sf (default: every county)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=OUTPUT_DIR,
+        help=f"Where to write {{state}}_{{county}}_{{label}}_census_tracts.geojson (default: {OUTPUT_DIR})",
+    )
+    return parser.parse_args()
+
+
+def read_dbf(dbf_path):
+    """Memory-mapped record array of a .dbf (one bytes column per field) and its field specs"""
+    header = np.fromfile(dbf_path, dtype=np.uint8, count=32)
+    record_count = int(header[4:8].view("<u4")[0])
+    header_length = int(header[8:10].view("<u2")[0])
+
+    descriptors = np.fromfile(dbf_path, dtype=np.uint8, count=header_length)[32:]
+    fields = {}
+    dtype = [("deleted", "S1")]
+    for offset in range(0, len(descriptors) - 1, 32):
+        descriptor = descriptors[offset : offset + 32]
+        if descriptor[0] == 0x0D:
+            break
+        name = descriptor[:11].tobytes().split(b"\0")[0].decode("ascii")
+        fields[name] = {
+            "type": chr(descriptor[11]),
+            "length": int(descriptor[16]),
+            "decimals": int(descriptor[17]),
+        }
+        dtype.append((name, f"S{descriptor[16]}"))
+
+    records = np.memmap(
+        dbf_path, dtype=dtype, mode="r", offset=header_length, shape=(record_count,)
+    )
+    return records, fields
+
+
+def dbf_encoding(shp_path):
+    cpg_path = os.path.splitext(shp_path)[0] + ".cpg"
+    if not os.path.exists(cpg_path):
+        return DEFAULT_ENCODING
+    with open(cpg_path) as f:
+        return f.read().strip() or DEFAULT_ENCODING
+
+
+def field_value(raw, spec, encoding):
+    """A dBase field as the JSON type mapshaper gives it"""
+    text = raw.decode(encoding).strip()
+    if spec["type"] in "NF":
+        if not text:
+            return None
+        if spec["type"] == "N" and spec["decimals"] == 0:
+            return int(text)
+        return float(text)
+    return text
+
+
+def ring_area(ring):
+    """Signed shoelace area, negative for the clockwise rings shapefiles use as outer rings"""
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * (np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def read_geometry(shp, offset):
+    """GeoJSON geometry of the record at a byte offset, with each ring a read-only
+    (n, 2) view into the mapped .shp rather than a copy"""
+    content = offset + RECORD_HEADER_SIZE
+    shape_type = int(np.frombuffer(shp, "<i4", 1, content)[0])
+    if shape_type == NULL_SHAPE:
+        return None
+    if shape_type not in POLYGON_SHAPES:
+        raise ValueError(f"Unsupported shape type {shape_type} at byte {offset}")
+
+    # Shape type, then a bounding box of 4 doubles, then the part and point counts
+    part_count, point_count = np.frombuffer(shp, "<i4", 2, content + 36)
+    parts = np.frombuffer(shp, "<i4", part_count, content + 44)
+    points = np.frombuffer(
+        shp, "<f8", 2 * point_count, content + 44 + 4 * part_count
+    ).reshape(-1, 2)
+
+    # Holes (counterclockwise) follow the outer ring (clockwise) they belong to
+    polygons = []
+    for start, end in zip(parts, list(parts[1:]) + [point_count]):
+        ring = points[start:end]
+        if ring_area(ring) <= 0 or not polygons:
+            polygons.append([ring])
+        else:
+            polygons[-1].append(ring)
+
+    if len(polygons) == 1:
+        return {"type": "Polygon", "coordinates": polygons[0]}
+    return {"type": "MultiPolygon", "coordinates": polygons}
+
+
+def county_rows(records, county_numbers=None):
+    """Indices of the live records of the given counties (all of them for None),
+    in file order so the .shp is read front to back"""
+    live = records["deleted"] != b"*"
+    if county_numbers is None:
+        return np.flatnonzero(live)
+    wanted = np.array([c.encode() for c in county_numbers])
+    return np.flatnonzero(live & np.isin(records["COUNTYFP"], wanted))
+
+
+def read_tracts(shp_path, county_numbers=None):
+    """Yield GeoJSON features (properties from the .dbf) of the tracts of the given
+    counties, seeking to each through the .shx. Ring coordinates are NumPy views,
+    so the geometry stages can use them directly; call .tolist() to serialize."""
+    base = os.path.splitext(shp_path)[0]
+    records, fields = read_dbf(base + ".dbf")
+    encoding = dbf_encoding(shp_path)
+
+    # .shx: (offset, content length) in 16 bit words per record, big endian
+    index = np.memmap(base + ".shx", dtype=">i4", mode="r", offset=FILE_HEADER_SIZE)
+    offsets = index.reshape(-1, 2)[:, 0].astype(np.int64) * 2
+    shp = np.memmap(shp_path, dtype=np.uint8, mode="r")
+
+    rows = county_rows(records, county_numbers)
+    for row in rows[np.argsort(offsets[rows], kind="stable")]:
+        record = records[row]
+        properties = {
+            name: field_value(record[name], spec, encoding)
+            for name, spec in fields.items()
+        }
+        yield {
+            "type": "Feature",
+            "properties": properties,
+            "geometry": read_geometry(shp, offsets[row]),
+        }
+
+
+def county_counts(shp_path):
+    """{COUNTYFP: tract count} of a shapefile, from the .dbf column alone"""
+    records, _ = read_dbf(os.path.splitext(shp_path)[0] + ".dbf")
+    counties, counts = np.unique(
+        records["COUNTYFP"][county_rows(records)], return_counts=True
+    )
+    return {c.decode(): int(n) for c, n in zip(counties, counts)}
+
+
+def output_file(output_dir, state_number, county_number, label=None):
+    # Same names as fetch_all_data.sh, so find_tracts_geojson picks them up
+    name = f"{state_number}_{county_number}_{label}_census_tracts.geojson"
+    if not label:
+        name = f"{state_number}_{county_number}_census_tracts.geojson"
+    return os.path.join(output_dir, name)
+
+
+def extract_counties(shp_path, counties=None, output_dir=OUTPUT_DIR):
+    """Stream the tracts of every county in {COUNTYFP: label} (all counties for None)
+    into its own GeoJSON file in one sequential pass over the shapefile"""
+    labels = counties or {c: None for c in county_counts(shp_path)}
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Features are written as they are read, so memory stays flat however many
+    # counties are extracted; each file replaces the old one only when complete
+    outputs = {}
+    try:
+        for feature in read_tracts(shp_path, list(labels)):
+            properties = feature["properties"]
+            county_number = properties["COUNTYFP"]
+            if county_number not in outputs:
+                fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+                f = os.fdopen(fd, "w")
+                f.write('{"type":"FeatureCollection","features":[\n')
+                outputs[county_number] = [f, tmp_path, properties["STATEFP"], 0]
+            output = outputs[county_number]
+            if output[3]:
+                output[0].write(",\n")
+            output[0].write(
+                json.dumps(feature, separators=(",", ":"), default=np.ndarray.tolist)
+            )
+            output[3] += 1
+
+        written = {}
+        for county_number, (f, tmp_path, state_number, count) in outputs.items():
+            f.write("\n]}\n")
+            f.close()
+            os.chmod(tmp_path, 0o644)
+            file_path = output_file(
+                output_dir, state_number, county_number, labels.get(county_number)
+            )
+            os.replace(tmp_path, file_path)
+            written[county_number] = file_path
+            print(f"{count} tracts saved to {file_path}")
+    finally:
+        for f, tmp_path, _, _ in outputs.values():
+            f.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    missing = sorted(set(labels) - set(outputs))
+    if missing:
+        print(f"No tracts in {shp_path} for counties {', '.join(missing)}")
+    return written
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    counties = None
+    if args.counties != ["*"]:
+        counties = dict(c.partition(":")[::2] for c in args.counties)
+    extract_counties(args.shapefile, counties, args.output_dir)
@@ -0,0 +1,382 @@
+import os
+import gzip
+import json
+import hashlib
+import argparse
+import tempfile
+import threading
+import collections
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import geoid_codec
+from export_bundles import display_values, find_tracts_geojson, load_county_table
+from fetch_color_ranges import color_ranges_path, list_fetched_counties
+
+STORE_DIR = "data/store"
+STORE_META = "meta.json"
+
+# Hot responses kept in memory, least recently used evicted first
+CACHE_ENTRIES = 256
+
+# Responses smaller than this aren't worth gzipping
+GZIP_MIN_BYTES = 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="serve tract metric slices from a memory-mapped store over HTTP"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser(
+        "build", help="Build the store from census_fetch.py outputs"
+    )
+    build.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    build.add_argument(
+        "--counties",
+        nargs="+",
+        default=["*"],
+        help="County FIPS codes (default: every fetched county)",
+    )
+    build.add_argument("--store-dir", default=STORE_DIR)
+
+    serve = commands.add_parser("serve", help="Serve the store")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--store-dir", default=STORE_DIR)
+    serve.add_argument(
+        "--cache-entries",
+        type=int,
+        default=CACHE_ENTRIES,
+        help=f"Responses kept in memory (default: {CACHE_ENTRIES})",
+    )
+    return parser.parse_args()
+
+
+def tract_points(geojson_path):
+    """{GEOID: (lat, lon)} of every tract's internal point"""
+    with open(geojson_path) as f:
+        features = json.load(f)["features"]
+    points = {}
+    for feature in features:
+        properties = feature["properties"]
+        if "INTPTLAT" in properties:
+            geoid = properties.get("GEOID") or properties.get("geoid")
+            points[geoid] = (
+                float(properties["INTPTLAT"]),
+                float(properties["INTPTLON"]),
+            )
+    return points
+
+
+def save_array(store_dir, name, values):
+    # Replaced atomically so a running server keeps its mapping of the old file
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, values)
+    os.replace(tmp_path, os.path.join(store_dir, name))
+
+
+def build_store(state_number, counties, store_dir=STORE_DIR):
+    """Write every county's metrics as one sorted GEOID column plus one column per metric.
+
+    Columns are plain .npy files so the server memory-maps them and only touches
+    the pages a query reads. Tract internal points are stored for bbox queries."""
+    if counties == ["*"]:
+        counties = list_fetched_counties(state_number)
+
+    tables, color_ranges, points = [], {}, {}
+    for county_number in counties:
+        geoid_prefix = f"{state_number}{county_number}"
+        try:
+            tables.append(load_county_table(state_number, county_number))
+        except FileNotFoundError as e:
+            print(f"Skipping {geoid_prefix}: {e}")
+            continue
+
+        ranges_path = color_ranges_path(geoid_prefix)
+        if os.path.exists(ranges_path):
+            with open(ranges_path) as f:
+                color_ranges[geoid_prefix] = json.load(f)
+        try:
+            points.update(
+                tract_points(find_tracts_geojson(state_number, county_number))
+            )
+        except FileNotFoundError:
+            print(
+                f"No tract GeoJSON for {geoid_prefix}, its tracts won't match bbox queries"
+            )
+
+    if not tables:
+        raise FileNotFoundError("No county metrics found, run census_fetch.py first")
+    state_ranges_path = color_ranges_path(state_number)
+    if os.path.exists(state_ranges_path):
+        with open(state_ranges_path) as f:
+            color_ranges[state_number] = json.load(f)
+
+    table = pd.concat(tables, ignore_index=True).sort_values("GEOID")
+    table = table.drop_duplicates("GEOID").reset_index(drop=True)
+    metrics = [c for c in table.columns if c != "GEOID"]
+
+    os.makedirs(store_dir, exist_ok=True)
+    save_array(store_dir, "geoid.npy", geoid_codec.encode(table["GEOID"]))
+    for metric_name in metrics:
+        save_array(store_dir, f"{metric_name}.npy", table[metric_name].to_numpy(float))
+    located = [points.get(geoid, (np.nan, np.nan)) for geoid in table["GEOID"]]
+    save_array(store_dir, "points.npy", np.array(located, dtype=float).reshape(-1, 2))
+
+    meta = {
+        "state": state_number,
+        "counties": sorted({geoid[:5] for geoid in table["GEOID"]}),
+        "metrics": metrics,
+        "tracts": len(table),
+        "color_ranges": color_ranges,
+    }
+    content = json.dumps(meta, sort_keys=True)
+    # The version changes with any input, so clients' ETags from an older store never match
+    meta["version"] = hashlib.sha256(
+        content.encode() + table.to_csv(index=False).encode()
+    ).hexdigest()[:16]
+
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(meta, indent=2, sort_keys=True))
+    os.replace(tmp_path, os.path.join(store_dir, STORE_META))
+    print(
+        f"Store with {len(table)} tracts x {len(metrics)} metrics saved to {store_dir}"
+    )
+    return meta
+
+
+def open_store(store_dir=STORE_DIR):
+    """Memory-map the store's columns"""
+    meta_path = os.path.join(store_dir, STORE_META)
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    def column(name):
+        return np.load(os.path.join(store_dir, name), mmap_mode="r")
+
+    return {
+        "meta": meta,
+        "meta_mtime": os.stat(meta_path).st_mtime_ns,
+        "geoid": column("geoid.npy"),
+        "points": column("points.npy"),
+        "columns": {m: column(f"{m}.npy") for m in meta["metrics"]},
+    }
+
+
+def split_list(values):
+    return [v for value in values for v in value.split(",") if v]
+
+
+def select_rows(store, query):
+    """Sorted row numbers matching the county, geoids and bbox filters (all of them when none is given)"""
+    geoid = store["geoid"]
+    rows = np.arange(len(geoid))
+
+    if "county" in query:
+        rows = np.concatenate(
+            [
+                rows[geoid_codec.prefix_rows(geoid, prefix)]
+                for prefix in split_list(query["county"])
+            ]
+            + [rows[:0]]
+        )
+
+    if "geoids" in query:
+        codes = geoid_codec.encode(split_list(query["geoids"]))
+        found = geoid_codec.positions(geoid, codes)
+        rows = np.intersect1d(rows, found[found >= 0])
+
+    if "bbox" in query:
+        west, south, east, north = map(float, query["bbox"][0].split(","))
+        points = store["points"][rows]
+        with np.errstate(invalid="ignore"):
+            inside = (
+                (points[:, 0] >= south)
+                & (points[:, 0] <= north)
+                & (points[:, 1] >= west)
+                & (points[:, 1] <= east)
+            )
+        rows = rows[inside]
+
+    return np.unique(rows)
+
+
+def query_tracts(store, query):
+    """{"metrics", "tracts": {GEOID: {metric: value}}} for the rows and metrics a query asks for"""
+    metrics = store["meta"]["metrics"]
+    if "metrics" in query:
+        requested = split_list(query["metrics"])
+        unknown = [m for m in requested if m not in store["columns"]]
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+        metrics = requested
+
+    rows = select_rows(store, query)
+    table = pd.DataFrame({"GEOID": geoid_codec.decode(store["geoid"][rows])})
+    for metric_name in metrics:
+        table[metric_name] = store["columns"][metric_name][rows]
+    return {"metrics": metrics, "tracts": display_values(table)}
+
+
+def query_color_ranges(store, query):
+    county = query.get("county", [store["meta"]["state"]])[0]
+    return store["meta"]["color_ranges"].get(county, {})
+
+
+ROUTES = {
+    "/tracts": query_tracts,
+    "/color_ranges": query_color_ranges,
+    "/meta": lambda store, query: {
+        k: v for k, v in store["meta"].items() if k != "color_ranges"
+    },
+}
+
+
+class ResponseCache:
+    """Thread-safe LRU of rendered responses keyed by (store version, path, query)"""
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def canonical_query(query_string):
+    """Query parameters in a fixed order, so equivalent URLs share a cache entry and ETag"""
+    query = parse_qs(query_string)
+    return {
+        key: sorted(set(split_list(values)))
+        if key in ("county", "geoids", "metrics")
+        else values
+        for key, values in sorted(query.items())
+    }
+
+
+def render(store, path, query, key):
+    """(etag, body, gzipped body or None) of a response"""
+    body = json.dumps(ROUTES[path](store, query), separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha256(key.encode()).hexdigest()[:20] + '"'
+    compressed = gzip.compress(body, mtime=0) if len(body) >= GZIP_MIN_BYTES else None
+    return etag, body, compressed
+
+
+class TractRequestHandler(BaseHTTPRequestHandler):
+    # Set by serve()
+    server_state = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path not in ROUTES:
+            return self.send_json_error(404, f"Unknown path {url.path}")
+
+        store = current_store(self.server_state)
+        query = canonical_query(url.query)
+        key = json.dumps([store["meta"]["version"], url.path, query], sort_keys=True)
+
+        entry = self.server_state["cache"].get(key)
+        if entry is None:
+            try:
+                entry = render(store, url.path, query, key)
+            except ValueError as e:
+                return self.send_json_error(400, str(e))
+            self.server_state["cache"].put(key, entry)
+        etag, body, compressed = entry
+
+        # The gzip and identity bodies differ byte for byte, so each gets its own strong ETag
+        gzipped = compressed is not None and "gzip" in self.headers.get(
+            "Accept-Encoding", ""
+        )
+        if gzipped:
+            body = compressed
+            etag = etag[:-1] + '-gz"'
+
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        # Revalidate every time; an unchanged store answers 304 without a body
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json_error(self, status, message):
+        body = json.dumps({"error": message}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def current_store(state):
+    """The open store, reopened when build_store has replaced it"""
+    store = state["store"]
+    meta_path = os.path.join(state["store_dir"], STORE_META)
+    if os.stat(meta_path).st_mtime_ns != store["meta_mtime"]:
+        with state["lock"]:
+            if state["store"] is store:
+                state["store"] = open_store(state["store_dir"])
+                print(f"Reopened store version {state['store']['meta']['version']}")
+        store = state["store"]
+    return store
+
+
+def serve(
+    host="127.0.0.1", port=8765, store_dir=STORE_DIR, cache_entries=CACHE_ENTRIES
+):
+    store = open_store(store_dir)
+    TractRequestHandler.server_state = {
+        "store": store,
+        "store_dir": store_dir,
+        "lock": threading.Lock(),
+        "cache": ResponseCache(cache_entries),
+    }
+    server = ThreadingHTTPServer((host, port), TractRequestHandler)
+    print(
+        f"Serving {store['meta']['tracts']} tracts x {len(store['meta']['metrics'])} metrics on http://{host}:{port}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "build":
+        build_store(args.state, args.counties, args.store_dir)
+    else:
+        serve(args.host, args.port, args.store_dir, args.cache_entries)
@@ -0,0 +1,338 @@
+import os
+import glob
+import json
+import math
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import geoid_codec
+from lodes_flows import MIN_JOBS, load_matrix, matrix_rows
+
+# Walking distance to a stop (README_transit_flow_analysis.md)
+RADIUS_MILES = 0.5
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE = EARTH_RADIUS_MILES * math.pi / 180
+
+# Query points compared against their candidate stops at once
+BATCH_SIZE = 100_000
+
+# Weekday morning peak used to count departures per stop
+PEAK_START = "07:00:00"
+PEAK_END = "09:00:00"
+
+OUTPUT_DIR = "data/transit"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="flag tracts and commute corridors far from transit stops with a grid index over GTFS stops"
+    )
+    parser.add_argument(
+        "--gtfs",
+        nargs="+",
+        required=True,
+        help="GTFS feed directories (each with a stops.txt)",
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument(
+        "--tracts",
+        nargs="+",
+        default=None,
+        help="Tract GeoJSON files (default: data/processed/{state}_*census_tracts.geojson)",
+    )
+    parser.add_argument(
+        "--matrix",
+        default=None,
+        help="Tract flow matrix from lodes_flows.py, to flag underserved corridors",
+    )
+    parser.add_argument(
+        "--radius-miles",
+        type=float,
+        default=RADIUS_MILES,
+        help=f"Walking distance to a stop (default: {RADIUS_MILES})",
+    )
+    parser.add_argument(
+        "--min-peak-departures",
+        type=float,
+        default=0,
+        help="Only count stops with at least this many weekday departures per hour between 7 and 9am (needs stop_times.txt and trips.txt)",
+    )
+    parser.add_argument(
+        "--min-jobs",
+        type=int,
+        default=MIN_JOBS,
+        help=f"Commuters for a corridor to count as heavy (default: {MIN_JOBS})",
+    )
+    return parser.parse_args()
+
+
+def weekday_trips(gtfs_dir):
+    """trip_ids running on a Wednesday, or None when the feed has no calendar.txt"""
+    calendar_path = os.path.join(gtfs_dir, "calendar.txt")
+    if not os.path.exists(calendar_path):
+        return None
+    calendar = pd.read_csv(calendar_path, dtype={"service_id": str})
+    services = calendar.loc[calendar["wednesday"] == 1, "service_id"]
+    trips = pd.read_csv(
+        os.path.join(gtfs_dir, "trips.txt"),
+        usecols=["trip_id", "service_id"],
+        dtype=str,
+    )
+    return trips.loc[trips["service_id"].isin(services), "trip_id"]
+
+
+def peak_departures_per_hour(gtfs_dir, chunksize=1_000_000):
+    """Weekday departures per hour at every stop during the morning peak"""
+    trips = weekday_trips(gtfs_dir)
+    hours = (pd.Timedelta(PEAK_END) - pd.Timedelta(PEAK_START)).total_seconds() / 3600
+
+    counts = []
+    reader = pd.read_csv(
+        os.path.join(gtfs_dir, "stop_times.txt"),
+        usecols=["trip_id", "stop_id", "departure_time"],
+        dtype=str,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        # GTFS times are zero padded (and can pass 24:00:00), so they compare as strings
+        times = chunk["departure_time"].str.strip().str.zfill(8)
+        in_peak = (times >= PEAK_START) & (times < PEAK_END)
+        if trips is not None:
+            in_peak &= chunk["trip_id"].isin(trips)
+        counts.append(chunk.loc[in_peak, "stop_id"].value_counts())
+
+    if not counts:
+        return pd.Series(dtype=float)
+    return pd.concat(counts).groupby(level=0).sum() / hours
+
+
+def load_stops(gtfs_dirs, min_peak_departures=0):
+    """Stop locations of every feed, optionally only stops served often enough in the peak"""
+    feeds = []
+    for gtfs_dir in gtfs_dirs:
+        stops = pd.read_csv(os.path.join(gtfs_dir, "stops.txt"), dtype={"stop_id": str})
+        # Stations (location_type 1) and entrances are not boarding points
+        if "location_type" in stops.columns:
+            stops = stops[stops["location_type"].fillna(0).isin([0])]
+
+        if min_peak_departures:
+            departures = peak_departures_per_hour(gtfs_dir)
+            rate = stops["stop_id"].map(departures).fillna(0)
+            stops = stops[rate >= min_peak_departures]
+
+        stops = stops[["stop_id", "stop_name", "stop_lat", "stop_lon"]].copy()
+        stops["feed"] = os.path.basename(os.path.normpath(gtfs_dir))
+        feeds.append(stops)
+        print(f"{len(stops)} stops from {gtfs_dir}")
+
+    return pd.concat(feeds, ignore_index=True)
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+def cell_keys(cx, cy):
+    # Offset so negative cell numbers (west or south of 0,0) pack into one int64
+    return ((cx + (1 << 30)) << 31) | (cy + (1 << 30))
+
+
+def build_index(lat, lon, radius_miles=RADIUS_MILES):
+    """Grid index over points with cells at least radius_miles wide, so every point
+    within radius of a query lies in the query's cell or one of its 8 neighbors"""
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+
+    cell_lat = radius_miles / MILES_PER_DEGREE
+    # Degrees of longitude shrink toward the poles, so size cells for the
+    # highest latitude a point within radius of any stop can have
+    highest = min(np.abs(lat).max() + cell_lat, 89.0) if len(lat) else 0.0
+    cell_lon = cell_lat / math.cos(math.radians(highest))
+
+    keys = cell_keys(
+        np.floor(lon / cell_lon).astype(np.int64),
+        np.floor(lat / cell_lat).astype(np.int64),
+    )
+    order = np.argsort(keys, kind="stable")
+    unique_keys, starts, counts = np.unique(
+        keys[order], return_index=True, return_counts=True
+    )
+    return {
+        "lat": lat,
+        "lon": lon,
+        "radius_miles": radius_miles,
+        "cell_lat": cell_lat,
+        "cell_lon": cell_lon,
+        "order": order,
+        "keys": unique_keys,
+        "starts": starts,
+        "counts": counts,
+    }
+
+
+def candidate_pairs(index, lat, lon):
+    """(query, point) index pairs for every indexed point in the 3x3 cells around each query"""
+    cx = np.floor(lon / index["cell_lon"]).astype(np.int64)
+    cy = np.floor(lat / index["cell_lat"]).astype(np.int64)
+
+    queries, points = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys = cell_keys(cx + dx, cy + dy)
+            cells = np.searchsorted(index["keys"], keys)
+            cells = np.minimum(cells, len(index["keys"]) - 1)
+            found = index["keys"][cells] == keys
+            counts = np.where(found, index["counts"][cells], 0)
+            starts = index["starts"][cells]
+
+            # Expand every query into one pair per point of its cell
+            query = np.repeat(np.arange(len(lat)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            queries.append(query)
+            points.append(index["order"][np.repeat(starts, counts) + offsets])
+
+    return np.concatenate(queries), np.concatenate(points)
+
+
+def nearby(index, lat, lon, batch_size=BATCH_SIZE):
+    """For every query point: indexed points within the index radius, and the nearest
+    of them with its distance in miles (-1 and NaN when none is in range)"""
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    within = np.zeros(len(lat), dtype=np.int64)
+    nearest = np.full(len(lat), -1, dtype=np.int64)
+    distance = np.full(len(lat), np.nan)
+    if len(index["keys"]) == 0:
+        return within, nearest, distance
+
+    for first in range(0, len(lat), batch_size):
+        batch = slice(first, first + batch_size)
+        queries, points = candidate_pairs(index, lat[batch], lon[batch])
+        miles = haversine_miles(
+            lat[batch][queries],
+            lon[batch][queries],
+            index["lat"][points],
+            index["lon"][points],
+        )
+        close = miles <= index["radius_miles"]
+        queries, points, miles = queries[close], points[close], miles[close]
+
+        within[batch] = np.bincount(queries, minlength=len(lat[batch]))
+        order = np.lexsort((miles, queries))
+        found, first_pair = np.unique(queries[order], return_index=True)
+        nearest[first + found] = points[order][first_pair]
+        distance[first + found] = miles[order][first_pair]
+
+    return within, nearest, distance
+
+
+def tract_points(geojson_files):
+    """Internal point of every tract from TIGER's INTPTLAT/INTPTLON properties"""
+    rows = []
+    for file_path in geojson_files:
+        with open(file_path) as f:
+            for feature in json.load(f)["features"]:
+                properties = feature["properties"]
+                rows.append(
+                    (
+                        properties.get("GEOID") or properties.get("geoid"),
+                        float(properties["INTPTLAT"]),
+                        float(properties["INTPTLON"]),
+                    )
+                )
+    return pd.DataFrame(rows, columns=["GEOID", "lat", "lon"]).drop_duplicates("GEOID")
+
+
+def tract_access(stops, tracts, radius_miles=RADIUS_MILES):
+    index = build_index(stops["stop_lat"], stops["stop_lon"], radius_miles)
+    within, nearest, distance = nearby(index, tracts["lat"], tracts["lon"])
+
+    access = tracts[["GEOID"]].copy()
+    access["stops_within_radius"] = within
+    access["nearest_stop_id"] = np.where(
+        nearest >= 0, stops["stop_id"].to_numpy()[np.maximum(nearest, 0)], None
+    )
+    access["nearest_stop_miles"] = distance.round(3)
+    return access
+
+
+def underserved_corridors(matrix, access, min_jobs=MIN_JOBS):
+    """Heavy tract-to-tract corridors with no stop within walking distance of either end"""
+    codes = geoid_codec.encode(access["GEOID"])
+    order = np.argsort(codes, kind="stable")
+    positions = geoid_codec.positions(codes[order], matrix["tracts"])
+    served = access["stops_within_radius"].to_numpy()[order] > 0
+    # Tracts without a location can't be judged either way
+    unserved = (positions >= 0) & ~served[np.maximum(positions, 0)]
+
+    rows = matrix_rows(matrix)
+    columns = matrix["indices"]
+    heavy = (matrix["data"] >= min_jobs) & (rows != columns)
+    flagged = np.flatnonzero(heavy & unserved[rows] & unserved[columns])
+    flagged = flagged[np.argsort(-matrix["data"][flagged], kind="stable")]
+
+    return pd.DataFrame(
+        {
+            "origin": geoid_codec.decode(matrix["tracts"][rows[flagged]]),
+            "destination": geoid_codec.decode(matrix["tracts"][columns[flagged]]),
+            "jobs": matrix["data"][flagged],
+        }
+    )
+
+
+def transit_access(
+    gtfs_dirs,
+    state_number="06",
+    tract_files=None,
+    matrix_path=None,
+    radius_miles=RADIUS_MILES,
+    min_peak_departures=0,
+    min_jobs=MIN_JOBS,
+):
+    stops = load_stops(gtfs_dirs, min_peak_departures)
+    tract_files = tract_files or sorted(
+        glob.glob(f"data/processed/{state_number}_*census_tracts.geojson")
+    )
+    tracts = tract_points(tract_files)
+
+    access = tract_access(stops, tracts, radius_miles)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    access_path = os.path.join(OUTPUT_DIR, f"{state_number}_tract_transit_access.csv")
+    access.to_csv(access_path, index=False)
+    print(
+        f"{(access['stops_within_radius'] == 0).sum()}/{len(access)} tracts have no stop within {radius_miles} miles, saved to {access_path}"
+    )
+
+    if matrix_path:
+        corridors = underserved_corridors(load_matrix(matrix_path), access, min_jobs)
+        corridors_path = os.path.join(
+            OUTPUT_DIR, f"{state_number}_underserved_corridors.csv"
+        )
+        corridors.to_csv(corridors_path, index=False)
+        print(
+            f"{len(corridors)} corridors with {min_jobs}+ commuters lack transit at both ends, saved to {corridors_path}"
+        )
+    return access
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    transit_access(
+        args.gtfs,
+        args.state,
+        args.tracts,
+        args.matrix,
+        args.radius_miles,
+        args.min_peak_departures,
+        args.min_jobs,
+    )
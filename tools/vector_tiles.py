@@ -0,0 +1,491 @@
+import os
+import glob
+import gzip
+import json
+import math
+import sqlite3
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+from export_bundles import display_values, find_tracts_geojson, load_county_table
+from simplify_tracts import (
+    QUANTIZATION,
+    arc_importance,
+    build_topology,
+    crossing_arcs,
+    ring_coordinates,
+    simplify_topology,
+    topology_factors,
+    zoom_tolerance,
+)
+
+LAYER_NAME = "tracts"
+
+# Tile coordinate space and the margin kept around it so strokes don't end at tile edges
+EXTENT = 4096
+BUFFER = 64
+
+MIN_ZOOM = 4
+MAX_ZOOM = 12
+
+# Simplification tolerance in screen pixels at every zoom
+TOLERANCE_PX = 1.0
+
+# MVT geometry commands and feature type
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+POLYGON = 3
+
+# Per worker process, set once by init_worker instead of pickled with every tile
+_zoom_geometries = None
+_properties = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="cut tract shapes and metrics into a zoom pyramid of Mapbox Vector Tiles in one MBTiles file"
+    )
+    parser.add_argument("--state", default="06", help="State FIPS code (default: 06)")
+    parser.add_argument(
+        "--counties",
+        nargs="+",
+        default=["*"],
+        help="County FIPS codes (e.g., 037 075), or * for every processed county in the state (default: *)",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="MBTiles file (default: data/tiles/{state}_tracts.mbtiles)",
+    )
+    parser.add_argument("--min-zoom", type=int, default=MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=MAX_ZOOM)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE_PX,
+        help=f"Simplification tolerance in pixels (default: {TOLERANCE_PX})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes encoding tiles (default: one per CPU)",
+    )
+    return parser.parse_args()
+
+
+def tract_geojson_files(state_number, counties):
+    if counties == ["*"]:
+        return sorted(
+            glob.glob(f"data/processed/{state_number}_*census_tracts.geojson")
+        )
+    return [find_tracts_geojson(state_number, c) for c in counties]
+
+
+def load_tracts(state_number, counties):
+    """Every tract feature of the counties with its metrics as properties"""
+    features = []
+    for file_path in tract_geojson_files(state_number, counties):
+        with open(file_path) as f:
+            features += json.load(f)["features"]
+
+    county_values = {}
+    tracts = []
+    for feature in features:
+        geoid = feature["properties"].get("GEOID") or feature["properties"]["geoid"]
+        geoid_prefix = geoid[:5]
+        if geoid_prefix not in county_values:
+            try:
+                table = load_county_table(geoid_prefix[:2], geoid_prefix[2:])
+                county_values[geoid_prefix] = display_values(table)
+            except FileNotFoundError as e:
+                print(f"{e}, its tracts will have no metrics")
+                county_values[geoid_prefix] = {}
+
+        properties = {"GEOID": geoid}
+        properties.update(county_values[geoid_prefix].get(geoid, {}))
+        tracts.append({"geometry": feature["geometry"], "properties": properties})
+    return tracts
+
+
+def mercator(lon_lat):
+    """Longitude/latitude to Web Mercator world coordinates in [0, 1], y down"""
+    x = (lon_lat[:, 0] + 180) / 360
+    sin_lat = np.sin(np.radians(np.clip(lon_lat[:, 1], -85.0511, 85.0511)))
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return np.column_stack([x, y])
+
+
+def world_geometries(topology, arcs):
+    """Each feature's polygons as lists of rings in world coordinates"""
+    scale = np.array(topology["transform"]["scale"])
+    translate = np.array(topology["transform"]["translate"])
+    return [
+        [
+            [
+                mercator(ring_coordinates(ring, arcs) * scale + translate)
+                for ring in polygon
+            ]
+            for polygon in shape
+        ]
+        for shape in topology["shapes"]
+    ]
+
+
+def tile_features(geometries, zoom):
+    """{(x, y): [feature index]} for every tile a feature's bounding box (plus buffer) touches"""
+    tiles = {}
+    margin = BUFFER / EXTENT
+    last = 2**zoom - 1
+    for i, polygons in enumerate(geometries):
+        points = np.concatenate([ring for polygon in polygons for ring in polygon])
+        low = np.floor(points.min(axis=0) * 2**zoom - margin).astype(int)
+        high = np.floor(points.max(axis=0) * 2**zoom + margin).astype(int)
+        for x in range(max(low[0], 0), min(high[0], last) + 1):
+            for y in range(max(low[1], 0), min(high[1], last) + 1):
+                tiles.setdefault((x, y), []).append(i)
+    return tiles
+
+
+def clip_ring(ring, low, high):
+    """Sutherland-Hodgman clip of a closed ring to the square [low, high], one side at a time"""
+    for axis in (0, 1):
+        for bound, keep_below in ((low, False), (high, True)):
+            if len(ring) == 0:
+                return ring
+            inside = ring[:, axis] <= bound if keep_below else ring[:, axis] >= bound
+            if inside.all():
+                continue
+            following = np.roll(ring, -1, axis=0)
+            following_inside = np.roll(inside, -1)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                t = (bound - ring[:, axis]) / (following[:, axis] - ring[:, axis])
+                crossing = ring + (following - ring) * t[:, None]
+            crossing[:, axis] = bound
+
+            # Each edge contributes its crossing point (if it crosses) and then
+            # its end point (if that is inside)
+            points = np.stack([crossing, following], axis=1).reshape(-1, 2)
+            keep = np.stack([inside != following_inside, following_inside], axis=1)
+            ring = points[keep.reshape(-1)]
+    return ring
+
+
+def ring_area(ring):
+    """Twice the signed area, positive for clockwise rings in y-down tile coordinates"""
+    x, y = ring[:, 0], ring[:, 1]
+    return np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+
+
+def tile_polygon(polygon, zoom, origin):
+    """Clip and snap one polygon's rings to the tile grid, dropping rings that
+    collapse; empty when its exterior does"""
+    rings = []
+    for ring in polygon:
+        local = (ring * 2**zoom - origin) * EXTENT
+        local = clip_ring(local, -BUFFER, EXTENT + BUFFER)
+        local = np.round(local).astype(np.int64)
+        if len(local):
+            changed = (local != np.roll(local, 1, axis=0)).any(axis=1)
+            local = local[changed]
+
+        if len(local) < 3 or ring_area(local) == 0:
+            if not rings:
+                # Without its exterior the polygon's holes mean nothing
+                break
+            continue
+        rings.append(local)
+    return rings
+
+
+def repair_polygon(rings):
+    """Split a self-intersecting snapped polygon into valid polygons on the
+    integer grid, as lists of rings without closing points"""
+    import shapely
+
+    polygon = shapely.Polygon(rings[0], rings[1:])
+    if polygon.is_valid:
+        return [rings]
+    # make_valid can add crossing points between grid cells, so snap again
+    # with GEOS keeping the result valid
+    repaired = shapely.set_precision(shapely.make_valid(polygon), 1.0)
+    parts = []
+    for part in shapely.get_parts(repaired):
+        if part.geom_type == "MultiPolygon":
+            parts += list(part.geoms)
+        elif part.geom_type == "Polygon" and part.area > 0:
+            parts.append(part)
+    return [
+        [
+            np.asarray(ring.coords, dtype=np.int64)[:-1]
+            for ring in [part.exterior, *part.interiors]
+        ]
+        for part in parts
+    ]
+
+
+def tile_rings(polygons, zoom, x, y, repair=False):
+    """Clip a feature's polygons to a tile and return its rings in tile coordinates
+    (exteriors clockwise, each followed by its holes counterclockwise)"""
+    origin = np.array([x, y])
+    rings = []
+    for polygon in polygons:
+        tiled = tile_polygon(polygon, zoom, origin)
+        if not tiled:
+            continue
+        for part in repair_polygon(tiled) if repair else [tiled]:
+            for ring_number, ring in enumerate(part):
+                exterior = ring_number == 0
+                if (ring_area(ring) > 0) != exterior:
+                    ring = ring[::-1]
+                rings.append(ring)
+    return rings
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def field(number, wire_type, payload):
+    """A protobuf field, length-prefixing bytes payloads"""
+    key = varint((number << 3) | wire_type)
+    if wire_type == 2:
+        return key + varint(len(payload)) + payload
+    return key + payload
+
+
+def packed(values):
+    return b"".join(varint(v) for v in values)
+
+
+def encode_geometry(rings):
+    commands = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for ring in rings:
+        deltas = np.diff(np.vstack([cursor, ring]), axis=0)
+        zigzagged = [zigzag(int(d)) for d in deltas.reshape(-1)]
+        commands.append((1 << 3) | MOVE_TO)
+        commands += zigzagged[:2]
+        commands.append(((len(ring) - 1) << 3) | LINE_TO)
+        commands += zigzagged[2:]
+        commands.append((1 << 3) | CLOSE_PATH)
+        cursor = ring[-1]
+    return commands
+
+
+def encode_value(value):
+    if isinstance(value, str):
+        return field(1, 2, value.encode())
+    if isinstance(value, bool):
+        return field(7, 0, varint(int(value)))
+    if isinstance(value, int):
+        return field(6, 0, varint(zigzag(value)))
+    return field(3, 1, np.float64(value).tobytes())
+
+
+def encode_tile(task):
+    """Encode one tile as a gzipped MVT with a single layer"""
+    zoom, x, y, feature_ids = task
+    geometries = _zoom_geometries[zoom]
+
+    keys, key_index = [], {}
+    values, value_index = [], {}
+    features = []
+    for i in feature_ids:
+        rings = tile_rings(geometries[i], zoom, x, y, _repair)
+        if not rings:
+            continue
+
+        tags = []
+        for key, value in _properties[i].items():
+            if value is None:
+                continue
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            value_key = (type(value).__name__, value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(value)
+            tags += [key_index[key], value_index[value_key]]
+
+        feature = b""
+        geoid = _properties[i]["GEOID"]
+        if geoid.isdigit():
+            feature += field(1, 0, varint(int(geoid)))
+        feature += field(2, 2, packed(tags))
+        feature += field(3, 0, varint(POLYGON))
+        feature += field(4, 2, packed(encode_geometry(rings)))
+        features.append(feature)
+
+    if not features:
+        return zoom, x, y, None
+
+    layer = field(15, 0, varint(2)) + field(1, 2, LAYER_NAME.encode())
+    layer += b"".join(field(2, 2, feature) for feature in features)
+    layer += b"".join(field(3, 2, key.encode()) for key in keys)
+    layer += b"".join(field(4, 2, encode_value(value)) for value in values)
+    layer += field(5, 0, varint(EXTENT))
+    return zoom, x, y, gzip.compress(field(3, 2, layer), mtime=0)
+
+
+def init_worker(zoom_geometries, properties, repair):
+    global _zoom_geometries, _properties, _repair
+    _zoom_geometries = zoom_geometries
+    _properties = properties
+    _repair = repair
+
+
+def create_mbtiles(file_path):
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    db = sqlite3.connect(file_path)
+    db.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    db.execute(
+        "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+    )
+    db.execute(
+        "CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)"
+    )
+    return db
+
+
+def write_metadata(db, state_number, zooms, bounds, properties):
+    fields = {}
+    for tract_properties in properties:
+        for key, value in tract_properties.items():
+            if value is not None:
+                fields.setdefault(key, "String" if isinstance(value, str) else "Number")
+
+    west, south, east, north = bounds
+    metadata = {
+        "name": f"{state_number} tracts",
+        "format": "pbf",
+        "type": "overlay",
+        "version": "1",
+        "minzoom": str(min(zooms)),
+        "maxzoom": str(max(zooms)),
+        "bounds": f"{west:.6f},{south:.6f},{east:.6f},{north:.6f}",
+        "center": f"{(west + east) / 2:.6f},{(south + north) / 2:.6f},{min(zooms)}",
+        "json": json.dumps(
+            {
+                "vector_layers": [
+                    {
+                        "id": LAYER_NAME,
+                        "fields": fields,
+                        "minzoom": min(zooms),
+                        "maxzoom": max(zooms),
+                    }
+                ]
+            }
+        ),
+    }
+    db.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+
+
+def build_vector_tiles(
+    state_number,
+    counties,
+    output=None,
+    min_zoom=MIN_ZOOM,
+    max_zoom=MAX_ZOOM,
+    tolerance=TOLERANCE_PX,
+    workers=None,
+):
+    """Write every tract (with its metrics) as a zoom pyramid of vector tiles to one MBTiles file"""
+    output = output or f"data/tiles/{state_number}_tracts.mbtiles"
+    tracts = load_tracts(state_number, counties)
+    if not tracts:
+        print(f"No tract GeoJSON for state {state_number} in data/processed")
+        return None
+    properties = [tract["properties"] for tract in tracts]
+
+    # Borders are simplified once per zoom on the shared topology, so
+    # neighboring tracts line up in every tile
+    topology = build_topology(tracts, QUANTIZATION)
+    factors = topology_factors(topology)
+    importances = [arc_importance(arc, factors) for arc in topology["arcs"]]
+
+    zooms = list(range(min_zoom, max_zoom + 1))
+    zoom_geometries = {}
+    tasks = []
+    for zoom in zooms:
+        arcs = simplify_topology(
+            topology, zoom_tolerance(zoom, tolerance, topology), importances
+        )
+        zoom_geometries[zoom] = world_geometries(topology, arcs)
+        tiles = tile_features(zoom_geometries[zoom], zoom)
+        tasks += [(zoom, x, y, ids) for (x, y), ids in sorted(tiles.items())]
+        # Only arcs that already cross in the input can still cross here
+        crossing = len(crossing_arcs(arcs))
+        print(f"z{zoom}: {len(tiles)} tiles, {crossing} crossing arcs")
+
+    # Snapping to the tile grid can make rings cross at low zooms
+    try:
+        import shapely  # noqa: F401
+    except ImportError:
+        print(
+            "shapely not installed, invalid tile polygons are kept (pip install shapely)"
+        )
+        repair = False
+    else:
+        repair = True
+
+    db = create_mbtiles(output)
+    tile_count = 0
+    tile_bytes = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(zoom_geometries, properties, repair),
+    ) as executor:
+        for zoom, x, y, data in executor.map(
+            encode_tile, tasks, chunksize=max(1, len(tasks) // (8 * (workers or 8)))
+        ):
+            if data is None:
+                continue
+            # MBTiles rows count from the bottom of the map (TMS)
+            db.execute(
+                "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                (zoom, x, 2**zoom - 1 - y, data),
+            )
+            tile_count += 1
+            tile_bytes += len(data)
+
+    scale = np.array(topology["transform"]["scale"])
+    translate = np.array(topology["transform"]["translate"])
+    extent = np.concatenate(topology["arcs"]).max(axis=0) * scale
+    bounds = [*translate, *(translate + extent)]
+    write_metadata(db, state_number, zooms, bounds, properties)
+    db.commit()
+    db.close()
+
+    print(
+        f"{tile_count} tiles ({tile_bytes / 1024 / 1024:.1f} MB) for {len(tracts)} tracts saved to {output}"
+    )
+    return output
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    build_vector_tiles(
+        args.state,
+        args.counties,
+        args.output,
+        args.min_zoom,
+        args.max_zoom,
+        args.tolerance,
+        args.workers,
+    )